@@ -3,13 +3,21 @@
 
 Moacir P. de Sá Pereira
 
-This module contains a function that plots the top ten features by permutation importance for all four models.
+This module contains a function that plots the top ten features by importance for all four models. The SVM and Random Forest importances are permutation importances, while the LSTM and XGBoost importances are mean absolute SHAP values (see `utils/explain.py`), so each panel is labeled with its own measure.
 """
 
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
+# What the `Importance` column of each model's table measures
+IMPORTANCE_MEASURES = {
+    "LSTM": "SHAP",
+    "SVM": "Permutation",
+    "Random Forest": "Permutation",
+    "XGBoost": "SHAP",
+}
+
 
 def permutation_importance(results_df):
     perm_imps = {
@@ -30,12 +38,16 @@ def permutation_importance(results_df):
         ax = sns.barplot(
             data=avg_perm_imp_df.head(10), y="Importance", x="Feature", ax=axes[i]
         )
-        ax.set_title(model)
-        ax.set_ylabel("Average Importance")
+        measure = IMPORTANCE_MEASURES[model]
+        ax.set_title(f"{model} ({measure})")
+        if measure == "SHAP":
+            ax.set_ylabel("Average Mean |SHAP Value|")
+        else:
+            ax.set_ylabel("Average Permutation Importance")
         ax.set_xlabel("Feature")
         ax.tick_params(axis="x", rotation=90)
     plt.suptitle(
-        "Top Average Permutation Importance across Four Machine Learning Techniques"
+        "Top Average Feature Importance across Four Machine Learning Techniques"
     )
     path = "plots/average_permutation_importance.png"
     plt.savefig(
@@ -43,4 +55,4 @@ def permutation_importance(results_df):
         dpi=300,
         bbox_inches="tight",
     )
-    print(f"Saved permutation importance plot to {path}.")
+    print(f"Saved feature importance plot to {path}.")
@@ -0,0 +1,84 @@
+"""
+# Sentiment Backends
+
+Moacir P. de Sá Pereira
+
+This module compares the backends of the sentiment engine (see
+`preprocessing/sentiment_engine.py`) on a sample of articles held out from
+the corpus. Every backend scores the same texts, and its `text_sentiment` and
+`text_error` are compared with those of the `fp32` backend:
+
+- the largest and mean absolute difference in sentiment,
+- the share of articles whose sentiment changes sign,
+- the correlation of the sentiments, and
+- the largest and mean relative difference in error.
+
+It also records each backend’s time to load (including exporting and
+quantizing the ONNX graph the first time) and its throughput in articles
+per second, and per core, on the engine’s threads, after a warm-up pass.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.sentiment_engine import BACKENDS, SentimentAnalysisEngine
+
+
+def compare_backends(texts, backends=BACKENDS, warmup=8, **engine_options):
+    texts = list(texts)
+    results = []
+    scores = {}
+    for backend in backends:
+        start = time.perf_counter()
+        engine = SentimentAnalysisEngine(backend=backend, **engine_options)
+        load_seconds = time.perf_counter() - start
+        engine.analyze_batch(texts[:warmup])
+
+        start = time.perf_counter()
+        scores[backend] = engine.analyze_batch(texts)
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "backend": backend,
+                "articles": len(texts),
+                "tokens": int(scores[backend].text_input_tokens.sum()),
+                "threads": engine.threads,
+                "load_seconds": load_seconds,
+                "seconds": seconds,
+                "articles_per_second": len(texts) / seconds,
+                "articles_per_core_second": len(texts) / seconds / engine.threads,
+                **parity(scores[backend], scores.get("fp32")),
+            }
+        )
+        print(
+            f"{backend}: {results[-1]['articles_per_second']:.2f} articles/s, "
+            f"largest sentiment difference "
+            f"{results[-1]['max_sentiment_difference']:.4f}"
+        )
+
+    results_df = pd.DataFrame(results)
+    if "fp32" in scores:
+        fp32_seconds = results_df.set_index("backend").seconds["fp32"]
+        results_df["speedup"] = fp32_seconds / results_df.seconds
+    return results_df
+
+
+def parity(scores, reference):
+    if reference is None:
+        return {}
+    sentiment = scores.text_sentiment.to_numpy()
+    reference_sentiment = reference.text_sentiment.to_numpy()
+    error = scores.text_error.to_numpy()
+    reference_error = reference.text_error.to_numpy()
+    sentiment_difference = np.abs(sentiment - reference_sentiment)
+    error_difference = np.abs(error - reference_error) / np.abs(reference_error)
+    return {
+        "max_sentiment_difference": sentiment_difference.max(),
+        "mean_sentiment_difference": sentiment_difference.mean(),
+        "sign_changes": (np.sign(sentiment) != np.sign(reference_sentiment)).mean(),
+        "sentiment_correlation": np.corrcoef(sentiment, reference_sentiment)[0, 1],
+        "max_error_difference": error_difference.max(),
+        "mean_error_difference": error_difference.mean(),
+    }
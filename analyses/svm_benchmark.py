@@ -0,0 +1,116 @@
+"""
+# SVM Benchmark
+
+Moacir P. de Sá Pereira
+
+This module compares the two SVM backends (the exact RBF SVC and the
+Nystroem approximation with a linear SVM, see `models/svm.py`) as the number
+of training rows grows. The rows of every company are pooled: each company
+is split 80/20 chronologically as in the SVM model, the training sets keep
+their most recent rows up to each size, and every model is tested on all
+the companies' test rows.
+
+For each size and backend it records the fit time, how much the peak
+resident memory grew during the fit (each fit runs in a fresh process, so
+libsvm's own allocations count too), the size of the pickled pipeline, and
+the F1 score and ROC AUC on the test rows.
+"""
+
+import multiprocessing
+import os
+import pickle
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import seaborn as sns
+from sklearn.metrics import f1_score, roc_auc_score
+
+from models.svm import SVMAnalyzer
+from utils.load_data import load_data
+from utils.split_data import split_data
+
+
+def pooled_rows(companies):
+    splits = []
+    for company in companies:
+        df = load_data(company).dropna()
+        splits.append(split_data(df))
+    X_trains, X_tests, y_trains, y_tests = zip(*splits)
+    return X_trains, pd.concat(X_tests), y_trains, pd.concat(y_tests)
+
+
+def fit_backend(backend, X_train, y_train):
+    # In kilobytes on Linux
+    with open("/proc/self/statm") as f:
+        resident = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    analyzer = SVMAnalyzer(backend=backend)
+    start = time.perf_counter()
+    analyzer.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return analyzer.pipeline, fit_seconds, max(0, peak - resident) / 1024
+
+
+def svm_benchmark(companies, sizes=None, backends=("exact", "approx")):
+    X_trains, X_test, y_trains, y_test = pooled_rows(companies)
+    total = sum(len(X) for X in X_trains)
+    sizes = sizes or [size for size in [500, 1000, 2000, 4000] if size < total]
+    sizes = sizes + [total] if total not in sizes else sizes
+
+    results = []
+    for size in sizes:
+        # The most recent rows of each company, in equal shares
+        rows = size // len(companies)
+        X_train = pd.concat([X.tail(rows) for X in X_trains])
+        y_train = pd.concat([y.tail(rows) for y in y_trains])
+        for backend in backends:
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                pipeline, fit_seconds, peak_mb = pool.submit(
+                    fit_backend, backend, X_train, y_train
+                ).result()
+
+            probs = pipeline.predict_proba(X_test)[:, 1]
+            y_pred = pipeline.predict(X_test)
+            results.append(
+                {
+                    "backend": backend,
+                    "rows": len(X_train),
+                    "fit_seconds": fit_seconds,
+                    "peak_mb": peak_mb,
+                    "model_mb": len(pickle.dumps(pipeline)) / 1024**2,
+                    "f1score": f1_score(y_test, y_pred),
+                    "roc_auc": roc_auc_score(y_test, probs),
+                }
+            )
+            print(
+                f"{backend} SVM on {len(X_train)} rows: {fit_seconds:.2f}s, "
+                f"F1 {results[-1]['f1score']:.3f}, AUC {results[-1]['roc_auc']:.3f}"
+            )
+    return pd.DataFrame(results)
+
+
+def plot_svm_benchmark(results_df):
+    fig, axes = plt.subplots(1, 4, figsize=(20, 4))
+    for ax, (column, label) in zip(
+        axes,
+        [
+            ("fit_seconds", "Fit time (s)"),
+            ("peak_mb", "Peak memory during the fit (MB)"),
+            ("f1score", "F1 score"),
+            ("roc_auc", "ROC AUC"),
+        ],
+    ):
+        sns.lineplot(
+            data=results_df, x="rows", y=column, hue="backend", marker="o", ax=ax
+        )
+        ax.set_xlabel("Training rows")
+        ax.set_ylabel(label)
+    plt.suptitle("Exact and Approximate SVMs as the Training Rows Grow")
+    path = "plots/svm_benchmark.png"
+    plt.savefig(path, dpi=300, bbox_inches="tight")
+    print(f"Saved SVM benchmark plot to {path}.")
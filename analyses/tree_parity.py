@@ -0,0 +1,111 @@
+"""
+# Tree Parity
+
+Moacir P. de Sá Pereira
+
+This module checks the tree compiler (`utils/tree_compiler.py`) against
+`predict_proba` on small synthetic models, independently of the stored
+ones. It fits random forests and XGBoost classifiers on random rows with
+missing values, some trained with missing values and some without (so that
+missing values only appear when scoring), and an XGBoost model that stops
+early at its best iteration.
+
+Each model is scored on held-out rows with missing values and on rows whose
+values sit exactly on the models’ split thresholds and on the 32-bit floats
+next to them, where a rounded threshold would send a row the wrong way. It
+returns the largest difference in probability per model and raises a
+`ValueError` if any is above `tolerance`. `python main.py tree_parity` runs
+it.
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from xgboost import XGBClassifier
+
+from utils.tree_compiler import compile_trees
+
+
+def synthetic_rows(rows, features, missing, rng):
+    X = rng.normal(size=(rows, features)).astype(np.float32)
+    y = (X[:, 0] + X[:, 1] * X[:, 2] + rng.normal(0, 0.5, rows) > 0).astype(int)
+    X[rng.random(X.shape) < missing] = np.nan
+    return X, y
+
+
+def threshold_rows(compiled, X, rng):
+    # Rows copied from X with one feature set to a split threshold, or to the
+    # 32-bit floats just below and above it
+    # (scikit-learn splits missing from present values at an infinite one)
+    splits = (compiled.left != np.arange(len(compiled.left))) & np.isfinite(
+        compiled.threshold
+    )
+    features = compiled.feature[splits]
+    thresholds = compiled.threshold[splits]
+    picks = rng.choice(len(features), size=min(len(features), 500), replace=False)
+    edges = []
+    for threshold in [
+        thresholds[picks],
+        np.nextafter(thresholds[picks], np.float32(-np.inf)),
+        np.nextafter(thresholds[picks], np.float32(np.inf)),
+    ]:
+        rows = X[rng.integers(len(X), size=len(picks))].copy()
+        rows[np.arange(len(picks)), features[picks]] = threshold
+        edges.append(rows)
+    return np.concatenate(edges)
+
+
+def check_tree_parity(rows=2000, features=8, missing=0.1, tolerance=1e-5):
+    rng = np.random.default_rng(42)
+    X, y = synthetic_rows(rows, features, missing, rng)
+    X_clean = np.where(np.isnan(X), 0, X)
+    train = np.arange(rows) < rows * 3 // 4
+    test = ~train
+
+    models = {
+        "random_forest": (RandomForestClassifier(n_estimators=50, random_state=42), X),
+        "random_forest trained without missing values": (
+            RandomForestClassifier(n_estimators=50, random_state=42),
+            X_clean,
+        ),
+        "xgboost": (XGBClassifier(n_estimators=50, max_depth=4), X),
+        "xgboost trained without missing values": (
+            XGBClassifier(n_estimators=50, max_depth=4),
+            X_clean,
+        ),
+        "xgboost with early stopping": (
+            XGBClassifier(n_estimators=200, max_depth=4, early_stopping_rounds=5),
+            X,
+        ),
+    }
+
+    report = []
+    for name, (model, X_train) in models.items():
+        if "early stopping" in name:
+            model.fit(
+                X_train[train], y[train], eval_set=[(X[test], y[test])], verbose=False
+            )
+        else:
+            model.fit(X_train[train], y[train])
+        compiled = compile_trees(model)
+        X_check = np.concatenate([X[test], threshold_rows(compiled, X[test], rng)])
+        difference = np.abs(
+            compiled.predict_proba(X_check)[:, 1] - model.predict_proba(X_check)[:, 1]
+        )
+        report.append(
+            {
+                "model": name,
+                "rows": len(X_check),
+                "missing_values": int(np.isnan(X_check).sum()),
+                "trees": len(compiled.roots),
+                "max_difference": difference.max(),
+            }
+        )
+
+    report_df = pd.DataFrame(report)
+    failed = report_df[report_df.max_difference > tolerance]
+    if len(failed):
+        raise ValueError(
+            "The compiled models differ from predict_proba:\n" + failed.to_string()
+        )
+    return report_df
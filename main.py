@@ -4,16 +4,25 @@
 by Ruibin Lyu, Vi Mai, Julie Meunier, Tuba Opel, Moacir P. de Sá Pereira
 """
 
+import os
 import sys
-import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from preprocessing.external_indicators import get_external_indicators
-from preprocessing.share_prices import get_share_prices
+from preprocessing.share_prices import get_all_share_prices
+from preprocessing.downloads import Downloader
+from preprocessing.download_cache import DownloadCache
 from preprocessing.sentiment import get_daily_sentiment
-from preprocessing.expand_financial_data import expand_financial_data
+from preprocessing.expand_financial_data import (
+    expand_financial_data,
+    prepare_share_prices,
+    PRICE_COLUMNS,
+)
+from preprocessing.rolling_state import RollingState
 from preprocessing.eda import eda
 from models.random_forest import random_forest_classifier
 from models.svm import svm_classifier
@@ -21,8 +30,20 @@ from models.lstm import lstm_classifier
 from models.xgboost import xgboost_classifier
 from analyses.permutation_importance import permutation_importance
 from analyses.roc_curve import plot_roc_curves
-
-from utils.load_data import load_data
+from analyses.svm_benchmark import svm_benchmark, plot_svm_benchmark
+from analyses.tree_parity import check_tree_parity
+
+from utils.load_data import load_data, load_columns, data_files
+from utils.feature_store import has_company_data, write_company_data
+from utils.watermarks import read_watermarks, write_watermarks
+from utils.task_graph import TaskGraph
+from utils import cpu_budget
+from utils.search import read_traces
+from utils.walk_forward import walk_forward, summarize
+from utils.model_updates import update_models
+from utils.scoring import ScoringService, serve
+from utils.tree_compiler import compile_stored_models
+from utils.results_store import MODEL_NAMES, load_model, read_results, write_results
 
 companies = ["dltr", "lulu", "ulta", "wba", "wmt"]
 
@@ -31,22 +52,62 @@ end_date = "2024-10-16"
 date_range = pd.date_range(start=start_date, end=end_date, freq="D")
 
 rerun = False
+incremental = False
+offline = False
+workers = None
+search_options = {}
+svm_options = {}
+walk_forward_options = {}
+update_options = {}
+port = 8000
+indicator_lookback_days = 120
+
+
+fill_na = {
+    "analyzed_bpe_tokens": 0,
+    "weighted_sentiment": 0,
+    "weighted_error": 0,
+    "analyzed_naive_tokens": 0,
+    "daily_naive_token_sum": 0,
+    "analyzed_article_count": 0,
+    "daily_article_count": 0,
+}
 
 
 def collect_data():
+    if incremental:
+        update_data()
+        return
+
     # Create a dictionary to store the data
     data = {}
 
-    # Collect external indicators
-    data["external_indicators"] = get_external_indicators(
-        start_date, end_date, date_range
-    )
+    # Collect external indicators and share prices at the same time.
+    downloader = Downloader(cache=DownloadCache(offline=offline))
+    with downloader, ThreadPoolExecutor(max_workers=2) as executor:
+        indicators = executor.submit(
+            get_external_indicators,
+            start_date,
+            end_date,
+            date_range,
+            downloader=downloader,
+        )
+        share_prices = executor.submit(
+            get_all_share_prices,
+            companies,
+            start_date,
+            end_date,
+            downloader=downloader,
+        )
+    data["external_indicators"] = indicators.result()
+    share_prices = share_prices.result()
+    watermarks = {"external_indicators": pd.Timestamp(end_date)}
 
     # Collect share prices and sentiment analyses for our companies.
     # Then merge the data with the external indicators.
     # Save the merged data to a parquet file.
     for company in companies:
-        data[company] = get_share_prices(company, start_date, end_date)
+        data[company] = share_prices[company]
         data[f"{company}_sent"] = get_daily_sentiment(company)
         data[company] = expand_financial_data(data[company])
 
@@ -61,18 +122,129 @@ def collect_data():
         merged_df = merged_df.merge(
             data[company], how="left", left_index=True, right_index=True
         )
-        fill_na = {
-            "analyzed_bpe_tokens": 0,
-            "weighted_sentiment": 0,
-            "weighted_error": 0,
-            "analyzed_naive_tokens": 0,
-            "daily_naive_token_sum": 0,
-            "analyzed_article_count": 0,
-            "daily_article_count": 0,
-        }
         merged_df.fillna(fill_na, inplace=True)
-        merged_df.to_parquet(f"data/{company}_merged_data.parquet")
+        write_company_data(company, merged_df, replace=True)
         data[company] = merged_df
+        watermarks[company] = merged_df.close.last_valid_index()
+
+    write_watermarks(watermarks)
+
+
+# Incremental data collection
+def update_data():
+    today = pd.Timestamp.today().normalize()
+    watermarks = read_watermarks()
+
+    # FRED files monthly and quarterly values under dates that are well in
+    # the past by the time they are published, so the indicators are
+    # refetched over a lookback window rather than from the watermark.
+    indicators_start = watermarks.get(
+        "external_indicators", pd.Timestamp(end_date)
+    ) - pd.Timedelta(days=indicator_lookback_days)
+
+    merged_dfs = {}
+    for company in companies:
+        if has_company_data(company):
+            # Only whole years from a little before the oldest row that can
+            # change are read, and only those year partitions are rewritten.
+            read_start = min(
+                indicators_start, watermarks.get(company, indicators_start)
+            ) - pd.Timedelta(days=60)
+            merged_dfs[company] = load_data(company, start=f"{read_start.year}-01-01")
+        elif os.path.exists(f"data/{company}_merged_data.parquet"):
+            merged_dfs[company] = load_data(company)
+        else:
+            print(
+                f"No merged data for {company}. Run collect_data without incremental."
+            )
+            continue
+        if company not in watermarks:
+            watermarks[company] = merged_dfs[company].close.last_valid_index()
+    if not merged_dfs:
+        return
+
+    # One bulk download covers every company from the oldest watermark on.
+    downloader = Downloader(cache=DownloadCache(offline=offline))
+    with downloader, ThreadPoolExecutor(max_workers=2) as executor:
+        indicators = executor.submit(
+            get_external_indicators,
+            indicators_start,
+            today,
+            pd.date_range(start=indicators_start, end=today, freq="D"),
+            save=False,
+            downloader=downloader,
+        )
+        share_prices = executor.submit(
+            get_all_share_prices,
+            list(merged_dfs),
+            min(watermarks[company] for company in merged_dfs) + pd.Timedelta(days=1),
+            today,
+            save=False,
+            downloader=downloader,
+        )
+    indicators = indicators.result()
+    share_prices = share_prices.result()
+    watermarks["external_indicators"] = today
+
+    for company, merged_df in merged_dfs.items():
+        merged_df = update_company_data(
+            company,
+            merged_df,
+            watermarks[company],
+            indicators,
+            share_prices[company],
+            today,
+        )
+        write_company_data(company, merged_df)
+        watermarks[company] = merged_df.close.last_valid_index()
+        print(f"{company} data updated through {watermarks[company]:%Y-%m-%d}.")
+
+    write_watermarks(watermarks)
+
+
+def update_company_data(company, merged_df, watermark, indicators, prices, today):
+    new_dates = pd.date_range(
+        start=merged_df.index.max() + pd.Timedelta(days=1), end=today, freq="D"
+    )
+    merged_df = merged_df.reindex(merged_df.index.union(new_dates))
+    merged_df.index.name = "date"
+
+    # Indicators that have no observation inside the lookback window keep
+    # the value that was carried into it.
+    carried = (
+        merged_df.loc[merged_df.index < indicators.index.min(), indicators.columns]
+        .ffill()
+        .iloc[-1]
+    )
+    merged_df.loc[indicators.index, indicators.columns] = indicators.fillna(carried)
+
+    sentiment_df = get_daily_sentiment(company).reindex(new_dates)
+    merged_df.loc[new_dates, sentiment_df.columns] = sentiment_df
+    merged_df.loc[new_dates] = merged_df.loc[new_dates].fillna(fill_na)
+
+    prices = prepare_share_prices(prices)
+    prices = prices.loc[prices.index > watermark, PRICE_COLUMNS]
+    if prices.empty:
+        return merged_df
+
+    # Only the last stored trading day (whose target depended on the next
+    # close) and the new days change, and each new day is a constant-time
+    # update of the rolling windows.
+    state = RollingState.from_history(
+        merged_df.loc[merged_df.index <= watermark, PRICE_COLUMNS]
+    )
+    financial_df = state.update_many(prices)
+    merged_df.loc[financial_df.index, financial_df.columns] = financial_df
+
+    return merged_df
+
+
+# Move the merged parquet files into the feature store
+def build_feature_store():
+    for company in companies:
+        df = pd.read_parquet(f"data/{company}_merged_data.parquet")
+        write_company_data(company, df, replace=True)
+        print(f"Wrote {company} to the feature store.")
 
 
 # Exploratory Data Analysis
@@ -82,10 +254,11 @@ def print_eda():
     print(eda_df)
 
 
-def rerun_model(company, model_function):
-    model, cm, accuracy, f1score, probs, roc_auc, y_test, perm_imp_df = model_function(
-        company
-    )
+def rerun_model(company, model_function, options=None):
+    with cpu_budget.stage(f"{model_function.__name__} {company}"):
+        model, cm, accuracy, f1score, probs, roc_auc, y_test, perm_imp_df = (
+            model_function(company, **(options or {}))
+        )
     return {
         "company": company,
         "model": model,
@@ -107,8 +280,7 @@ def lstm():
         results = []
         for company in companies:
             results.append(rerun_model(company, lstm_classifier))
-        with open("data/model_metadata/lstm_results.pkl", "wb") as f:
-            pickle.dump(results, f)
+        save_results("lstm", *results)
 
 
 # SVM Model
@@ -117,9 +289,8 @@ def svm():
         print("Rerunning SVM model")
         results = []
         for company in companies:
-            results.append(rerun_model(company, svm_classifier))
-        with open("data/model_metadata/svm_results.pkl", "wb") as f:
-            pickle.dump(results, f)
+            results.append(rerun_model(company, svm_classifier, svm_options))
+        save_results("svm", *results)
 
 
 # Random Forest model
@@ -128,15 +299,16 @@ def random_forest():
         print("Rerunning Random Forest model")
         results = []
         for company in companies:
-            results.append(rerun_model(company, random_forest_classifier))
-        with open("data/model_metadata/random_forest_results.pkl", "wb") as f:
-            pickle.dump(results, f)
+            results.append(
+                rerun_model(company, random_forest_classifier, search_options)
+            )
+        save_results("random_forest", *results)
     else:
-        with open("data/model_metadata/random_forest_results.pkl", "rb") as f:
-            results = pickle.load(f)
-            df = load_data("dltr")  # Load arbitrary dataset to get column names
-            df.insert(0, "Index", range(len(df)))  # Add index column
-            extract_feature_importances(results, df.columns, "Random Forest")
+        results = [
+            {"company": company, "model": load_model("random_forest", company)}
+            for company in companies
+        ]
+        explain_random_forest(*results)
 
 
 # XGBoost model
@@ -145,21 +317,42 @@ def xgboost():
         print("Rerunning XGBoost model")
         results = []
         for company in companies:
-            results.append(rerun_model(company, xgboost_classifier))
-        with open("data/model_metadata/xgboost_results.pkl", "wb") as f:
-            pickle.dump(results, f)
+            results.append(rerun_model(company, xgboost_classifier, search_options))
+        save_results("xgboost", *results)
     else:
-        with open("data/model_metadata/xgboost_results.pkl", "rb") as f:
-            results = pickle.load(f)
-            df = load_data("dltr")  # Load arbitrary dataset to get column names
-            extract_feature_importances(results, df.columns, "XGBoost")
+        results = [
+            {"company": company, "model": load_model("xgboost", company)}
+            for company in companies
+        ]
+        explain_xgboost(*results)
+
+
+def save_results(family, *results):
+    results = list(results)
+    write_results(family, results)
+    return results
+
+
+def explain_random_forest(*results):
+    # Column names of an arbitrary dataset, plus the index column
+    columns = ["Index"] + load_columns("dltr")
+    extract_feature_importances(results, columns, "Random Forest")
+
+
+def explain_xgboost(*results):
+    columns = load_columns("dltr")  # Column names of an arbitrary dataset
+    extract_feature_importances(results, columns, "XGBoost")
 
 
 # Extract feature importances.
 def extract_feature_importances(results, columns, technique):
     dfs = []
     for result in results:
-        feat_imps = zip(columns, result["model"].feature_importances_)
+        model = result["model"]
+        # The XGBoost pipeline's classifier
+        if hasattr(model, "named_steps"):
+            model = model.named_steps["classifier"]
+        feat_imps = zip(columns, model.feature_importances_)
         feat_imp_df = pd.DataFrame(feat_imps, columns=["feature", "importance"])
         feat_imp_df["company"] = result["company"]
         feat_imp_df["rank"] = feat_imp_df["importance"].rank(ascending=False)
@@ -182,30 +375,28 @@ def extract_feature_importances(results, columns, technique):
 
 
 def extract_results():
-    with open("data/model_metadata/lstm_results.pkl", "rb") as f:
-        lstm_results = pickle.load(f)
-        for company in lstm_results:
-            company["model_name"] = "LSTM"
-    with open("data/model_metadata/svm_results.pkl", "rb") as f:
-        svm_results = pickle.load(f)
-        for company in svm_results:
-            company["model_name"] = "SVM"
-    with open("data/model_metadata/random_forest_results.pkl", "rb") as f:
-        random_forest_results = pickle.load(f)
-        for company in random_forest_results:
-            company["model_name"] = "Random Forest"
-    with open("data/model_metadata/xgboost_results.pkl", "rb") as f:
-        xgboost_results = pickle.load(f)
-        for company in xgboost_results:
-            company["model_name"] = "XGBoost"
-
-    results = lstm_results + svm_results + random_forest_results + xgboost_results
-    return pd.DataFrame(results)
+    return read_results()
+
+
+def results_frame(lstm_results, svm_results, random_forest_results, xgboost_results):
+    results = {
+        "lstm": lstm_results,
+        "svm": svm_results,
+        "random_forest": random_forest_results,
+        "xgboost": xgboost_results,
+    }
+    for family, family_results in results.items():
+        for company in family_results:
+            company["model_name"] = MODEL_NAMES[family]
+    return pd.DataFrame(
+        lstm_results + svm_results + random_forest_results + xgboost_results
+    )
 
 
 # Compile report on all models
-def report():
-    results_df = extract_results()
+def report(results_df=None):
+    if results_df is None:
+        results_df = extract_results()
     summary_df = results_df.groupby(["model_name"]).agg(
         avg_f1score=("f1score", "mean"),
         avg_accuracy=("accuracy", "mean"),
@@ -266,16 +457,175 @@ def report():
     )
 
 
-def permutation_importance_report():
-    results_df = extract_results()
+def permutation_importance_report(results_df=None):
+    if results_df is None:
+        results_df = extract_results()
     permutation_importance(results_df)
 
 
-def roc_analysis():
-    results_df = extract_results()
+def roc_analysis(results_df=None):
+    if results_df is None:
+        results_df = extract_results()
     plot_roc_curves(results_df, companies)
 
 
+# Compare the cost and the score of the hyperparameter searches
+def search_report():
+    traces = read_traces()
+    if traces.empty:
+        print("No search traces yet. Rerun random_forest or xgboost.")
+        return
+    # The cost of a search is its last row, and its score that of the best
+    # configuration at the last rung.
+    searches = traces.groupby(["model", "mode", "company"])
+    summary_df = pd.DataFrame(
+        {
+            "fits": searches["fits"].max(),
+            "fit_seconds": searches["fit_seconds"].sum(),
+            "best_score": searches.apply(
+                lambda trace: trace.loc[
+                    trace["rung"] == trace["rung"].max(), "score"
+                ].max()
+            ),
+        }
+    )
+    print(summary_df)
+    print(summary_df.groupby(["model", "mode"]).mean())
+
+
+# Walk-forward backtest of every model for every company
+def walk_forward_report():
+    results_df = walk_forward(companies, **walk_forward_options)
+    results_df.to_parquet("data/model_metadata/walk_forward.parquet")
+    print(
+        results_df[
+            [
+                "model",
+                "company",
+                "fold",
+                "test_start",
+                "test_end",
+                "f1score",
+                "accuracy",
+            ]
+        ].to_string()
+    )
+    print("\nSummary:\n")
+    print(summarize(results_df))
+
+
+# Bring the stored models up to date with the days collected since their last
+# update, retraining from scratch only on schedule or on drift.
+def update():
+    log_df = update_models(companies, **update_options)
+    print(log_df.to_string())
+    print(f"\nUpdated {len(log_df)} models in {log_df['seconds'].sum():.1f}s.")
+
+
+# Predict the next day for every company with every model.
+def predict():
+    start = time.perf_counter()
+    service = ScoringService(companies)
+    print(f"Loaded the models and rows in {time.perf_counter() - start:.2f}s.")
+    predictions = service.score()
+    print(predictions.to_string())
+    print(
+        f"\nScored {len(predictions)} predictions in {service.stats()['max_ms']:.1f}ms."
+    )
+
+
+# Compare the exact and approximate SVMs on growing pooled training sets.
+def svm_benchmark_report():
+    results_df = svm_benchmark(companies)
+    results_df.to_parquet("data/model_metadata/svm_benchmark.parquet")
+    print(results_df.to_string())
+    plot_svm_benchmark(results_df)
+
+
+# Export the tree models as arrays, checking them against the originals.
+def compile_trees():
+    report_df = compile_stored_models(companies)
+    print(report_df.to_string())
+
+
+# Check the tree compiler against predict_proba on synthetic models.
+def tree_parity():
+    print(check_tree_parity().to_string())
+
+
+# Keep the models in memory and answer prediction requests over HTTP.
+def serve_predictions():
+    serve(ScoringService(companies), port=port)
+
+
+# Train every model for every company, then report on them. Fits run in
+# parallel on `workers` processes, and each save, explanation and report
+# runs as soon as the results it needs are in, without rereading the results store.
+def run_all():
+    model_functions = {
+        "lstm": lstm_classifier,
+        "svm": svm_classifier,
+        "random_forest": random_forest_classifier,
+        "xgboost": xgboost_classifier,
+    }
+    # The tree models take the hyperparameter search options.
+    options = {
+        "svm": svm_options,
+        "random_forest": search_options,
+        "xgboost": search_options,
+    }
+    # Rough relative fit times, used to start the slowest fits first.
+    costs = {"lstm": 20, "svm": 4, "random_forest": 3, "xgboost": 2}
+    explanations = {
+        "random_forest": explain_random_forest,
+        "xgboost": explain_xgboost,
+    }
+
+    # Each worker process gets an equal share of the core budget. Every fit
+    # is ready from the start, and there are no more processes than fits, so
+    # with more cores than fits each fit gets several threads.
+    fit_tasks = len(model_functions) * len(companies)
+    processes = min(workers or cpu_budget.cores(), fit_tasks)
+    graph = TaskGraph(
+        processes,
+        initializer=cpu_budget.configure,
+        initargs=(cpu_budget.split(processes),),
+    )
+    saves = []
+    for family, model_function in model_functions.items():
+        fits = [
+            graph.add(
+                f"{family} {company}",
+                rerun_model,
+                company,
+                model_function,
+                options.get(family),
+                inputs=data_files(company),
+                cost=costs[family],
+            )
+            for company in companies
+        ]
+        saves.append(
+            graph.add(
+                f"save {family}", save_results, family, dependencies=fits, local=True
+            )
+        )
+        if family in explanations:
+            graph.add(
+                f"explain {family}",
+                explanations[family],
+                dependencies=fits,
+                local=True,
+            )
+    graph.add("results", results_frame, dependencies=saves, local=True)
+    graph.add("report", report, dependencies=["results"], local=True)
+    graph.add(
+        "perm_imp", permutation_importance_report, dependencies=["results"], local=True
+    )
+    graph.add("roc", roc_analysis, dependencies=["results"], local=True)
+    graph.run()
+
+
 # def create_roc_curves(results):
 #     fig, axes = plt.subplots(1, 4, figsize=(20, 4))
 #     for i, result in enumerate(results):
@@ -301,12 +651,41 @@ def roc_analysis():
 
 if __name__ == "__main__":
     # Check if an argument is passed
-    if len(sys.argv) > 2 and sys.argv[2] == "rerun":
+    if "rerun" in sys.argv[2:]:
         rerun = True
+    if "incremental" in sys.argv[2:]:
+        incremental = True
+    if "offline" in sys.argv[2:]:
+        offline = True
+    for arg in sys.argv[2:]:
+        if arg.startswith("workers="):
+            workers = int(arg.split("=")[1])
+        if arg.startswith("cpus="):
+            cpu_budget.configure(int(arg.split("=")[1]))
+        if arg.startswith("search="):
+            search_options["search"] = arg.split("=")[1]
+        if arg.startswith("search_seconds="):
+            search_options["search_seconds"] = float(arg.split("=")[1])
+        if arg.startswith("search_fits="):
+            search_options["search_fits"] = int(arg.split("=")[1])
+        if arg.startswith("folds="):
+            walk_forward_options["folds"] = int(arg.split("=")[1])
+        if arg == "rolling":
+            walk_forward_options["mode"] = "rolling"
+        if arg == "full":
+            update_options["full"] = True
+        if arg.startswith("full_every="):
+            update_options["full_every_days"] = int(arg.split("=")[1])
+        if arg.startswith("svm_backend="):
+            svm_options["backend"] = arg.split("=")[1]
+        if arg.startswith("port="):
+            port = int(arg.split("=")[1])
     if len(sys.argv) > 1:
         argument = sys.argv[1]
         if argument == "collect_data":
             collect_data()
+        elif argument == "feature_store":
+            build_feature_store()
         elif argument == "eda":
             print_eda()
         elif argument == "random_forest":
@@ -323,15 +702,25 @@ if __name__ == "__main__":
             permutation_importance_report()
         elif argument == "roc":
             roc_analysis()
+        elif argument == "search_report":
+            search_report()
+        elif argument == "walk_forward":
+            walk_forward_report()
+        elif argument == "update":
+            update()
+        elif argument == "predict":
+            predict()
+        elif argument == "serve":
+            serve_predictions()
+        elif argument == "compile_trees":
+            compile_trees()
+        elif argument == "tree_parity":
+            tree_parity()
+        elif argument == "svm_benchmark":
+            svm_benchmark_report()
         elif argument == "run_all":
             rerun = True
-            random_forest()
-            svm()
-            lstm()
-            xgboost()
-            report()
-            permutation_importance_report()
-            roc_analysis()
+            run_all()
         else:
             print("Invalid argument. See README for available arguments.")
     else:
@@ -5,24 +5,38 @@ Tuba Opel
 
 This module trains an LSTM classifier on each of our target companies.
 It returns the data to make a confusion matrix.
+
+The 30-day input windows are never materialized as an N × 30 × F array.
+The features are stored once as an N × F array, and `GridSearchCV` only sees
+the index of each window’s first day. `WindowedLSTMClassifier` builds each
+training or prediction batch from a strided sliding-window view of the
+feature array, so only one batch of windows exists in memory at a time.
+
+Each company's tuned network is saved to
+`data/model_metadata/lstm_{company}.keras`. The feature importances are
+expected-gradient SHAP values (see `utils/explain.py`).
 """
 
+from utils.explain import explain_network
 from utils.load_data import load_data
-from utils.permutation_importance import permutation_importance
 from utils.split_data import split_data
+from utils import cpu_budget
+
+import math
 
 import pandas as pd
 import numpy as np
-import shap
 
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import confusion_matrix, accuracy_score, f1_score, roc_auc_score
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, ParameterGrid
+from sklearn.base import BaseEstimator, ClassifierMixin
 
+import keras
+import tensorflow as tf
 from keras.models import Sequential
 from keras.layers import LSTM, Dense
-
-from scikeras.wrappers import KerasClassifier
+from keras.utils import PyDataset
 
 
 def lstm_classifier(company):
@@ -44,33 +58,34 @@ def lstm_classifier(company):
 
     columns = X.columns
 
-    # Reshape data for LSTM input (samples, timesteps, features)
+    # Each sample is the window of timesteps days starting at its index
+    # (samples, timesteps, features). Only the start indexes are split.
     timesteps = 30  # Number of timesteps to look back
-    features = X.shape[1]
-    X = np.array([X[i : i + timesteps] for i in range(len(X) - timesteps)])
+    values = SharedArray(X.to_numpy(dtype=np.float32))
+    X = np.arange(len(X) - timesteps).reshape(-1, 1)
     y = y[timesteps:]
 
     # Structured Train Test Split
     X_dev, X_test = np.split(X, [int(0.8 * len(X))])
     y_dev, y_test = np.split(y, [int(0.8 * len(y))])
 
-    # Build LSTM model
-    def create_model():
-        model = Sequential()
-        model.add(LSTM(units=64, input_shape=(timesteps, features), seed=42))
-        model.add(Dense(1, activation="sigmoid"))  # Binary classification
-        # Compile the model
-        model.compile(
-            loss="binary_crossentropy", optimizer="adam", metrics=["accuracy"]
-        )
-        return model
-
     # Hyper Parameter Tuning
     param_grid = {"epochs": [10, 20], "batch_size": [16, 32]}
-    clf = KerasClassifier(model=create_model, verbose=0, random_state=42)
-    grid = GridSearchCV(estimator=clf, param_grid=param_grid, n_jobs=-1, cv=5)
+    # One job per fit in the search, up to the core budget, and each job's
+    # TensorFlow threads get an equal share of the rest.
+    fits = len(ParameterGrid(param_grid)) * 5
+    with cpu_budget.stage("search", jobs=fits) as allocation:
+        clf = WindowedLSTMClassifier(
+            values=values,
+            timesteps=timesteps,
+            random_state=42,
+            threads=allocation["threads"],
+        )
+        grid = GridSearchCV(
+            estimator=clf, param_grid=param_grid, n_jobs=allocation["jobs"], cv=5
+        )
 
-    grid.fit(X_dev, y_dev)
+        grid.fit(X_dev, y_dev)
 
     print(f"\n\n{company.upper()} model selection")
     print("Best Train Accuracy score:", grid.best_score_)
@@ -80,7 +95,7 @@ def lstm_classifier(company):
     tuned_model = grid.best_estimator_
     y_pred = tuned_model.predict(X_test)
 
-    tuned_model.model_.save("data/model_metadata/lstm.h5")
+    tuned_model.model_.save(f"data/model_metadata/lstm_{company}.keras")
 
     accuracy = accuracy_score(y_test, y_pred)
 
@@ -93,18 +108,16 @@ def lstm_classifier(company):
     roc_auc = roc_auc_score(y_test, lstm_probs)
 
     keras_model = tuned_model.model_
-    explainer = shap.GradientExplainer(keras_model, X_dev)
-    shap_values = explainer.shap_values(X_test)
-
-    # Calculate the average absolute SHAP value for each feature
-    shap_mean = np.mean(np.abs(shap_values[0]), axis=0)  # For the first class output
-    # Create a dataframe to hold the feature importances
-    perm_imp_df = pd.DataFrame(
-        {"Feature": columns, "Importance": shap_mean.flatten()}
-    ).sort_values(by="Importance", ascending=False)
+    windows = tuned_model.windows()
+    # The average absolute SHAP value of each feature over the test windows
+    # and their days, against a summary of the development windows
+    with cpu_budget.stage("shap"):
+        perm_imp_df = explain_network(
+            keras_model, windows[X_dev.ravel()], windows[X_test.ravel()], columns
+        )
 
     return (
-        "model not saveable. See lstm.h5",
+        tuned_model,
         cm,
         accuracy,
         f1score,
@@ -113,3 +126,136 @@ def lstm_classifier(company):
         y_test,
         perm_imp_df,
     )
+
+
+class SharedArray:
+    # scikit-learn deep-copies estimator parameters whenever it clones an
+    # estimator. Wrapping the feature array keeps every clone pointing at
+    # the same memory.
+    def __init__(self, array):
+        self.array = array
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class WindowSequence(PyDataset):
+    def __init__(
+        self, windows, starts, y=None, batch_size=32, shuffle=False, seed=None
+    ):
+        super().__init__()
+        self.windows = windows
+        self.starts = starts
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(starts))
+        self.rng = np.random.default_rng(seed)
+        if shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return math.ceil(len(self.starts) / self.batch_size)
+
+    def __getitem__(self, i):
+        batch = self.order[i * self.batch_size : (i + 1) * self.batch_size]
+        # Fancy indexing the strided view copies just this batch's windows.
+        X = self.windows[self.starts[batch]]
+        if self.y is None:
+            return (X,)
+        return X, self.y[batch]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+class WindowedLSTMClassifier(ClassifierMixin, BaseEstimator):
+    def __init__(
+        self,
+        values=None,
+        timesteps=30,
+        epochs=10,
+        batch_size=32,
+        random_state=None,
+        threads=None,
+    ):
+        self.values = values
+        self.timesteps = timesteps
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.threads = threads
+
+    def windows(self):
+        # A (samples, timesteps, features) view on the feature array.
+        return np.lib.stride_tricks.sliding_window_view(
+            self.values.array, self.timesteps, axis=0
+        ).transpose(0, 2, 1)
+
+    def create_model(self):
+        features = self.values.array.shape[1]
+        model = Sequential()
+        model.add(LSTM(units=64, input_shape=(self.timesteps, features), seed=42))
+        model.add(Dense(1, activation="sigmoid"))  # Binary classification
+        # Compile the model
+        model.compile(
+            loss="binary_crossentropy", optimizer="adam", metrics=["accuracy"]
+        )
+        return model
+
+    def fit(self, X, y):
+        if self.threads is not None:
+            limit_tensorflow(self.threads)
+        if self.random_state is not None:
+            keras.utils.set_random_seed(self.random_state)
+        self.classes_ = np.array([0, 1])
+        self.model_ = self.create_model()
+        sequence = WindowSequence(
+            self.windows(),
+            np.asarray(X).ravel(),
+            np.asarray(y, dtype=np.float32),
+            batch_size=self.batch_size,
+            shuffle=True,
+            seed=self.random_state,
+        )
+        self.model_.fit(sequence, epochs=self.epochs, verbose=0)
+        return self
+
+    def partial_fit(self, X, y, epochs=1):
+        # Keeps training the fitted network (e.g. on the newest windows),
+        # or fits a new one.
+        if not hasattr(self, "model_"):
+            return self.set_params(epochs=epochs).fit(X, y)
+        if self.threads is not None:
+            limit_tensorflow(self.threads)
+        sequence = WindowSequence(
+            self.windows(),
+            np.asarray(X).ravel(),
+            np.asarray(y, dtype=np.float32),
+            batch_size=self.batch_size,
+            shuffle=True,
+            seed=self.random_state,
+        )
+        self.model_.fit(sequence, epochs=epochs, verbose=0)
+        return self
+
+    def predict_proba(self, X):
+        sequence = WindowSequence(
+            self.windows(), np.asarray(X).ravel(), batch_size=self.batch_size
+        )
+        probs = self.model_.predict(sequence, verbose=0).ravel()
+        return np.column_stack([1 - probs, probs])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] > 0.5).astype(int)
+
+
+def limit_tensorflow(threads):
+    # TensorFlow only takes thread counts before it first runs an op, which
+    # is the case in a fresh grid search worker.
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
+    except RuntimeError:
+        pass
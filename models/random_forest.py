@@ -5,20 +5,37 @@ Tuba Opel
 
 This module trains a random forest classifier on each of our target
 companies. It returns the model and various metrics.
+
+The grid search grows one forest per depth and fold and scores it at each
+number of trees in the grid (see `WarmStartGridSearch` in `utils/search.py`),
+which picks the same model as `GridSearchCV` at the cost of fitting the
+largest forests only. `search="exhaustive"` runs the full `GridSearchCV`
+instead. With `search="halving"`, the grid search is replaced by a
+successive halving search that can be capped with `search_seconds` or
+`search_fits`.
 """
 
 from utils.load_data import load_data
 from utils.permutation_importance import permutation_importance
 from utils.split_data import split_data
+from utils import cpu_budget
+from utils.search import (
+    SuccessiveHalvingSearch,
+    WarmStartGridSearch,
+    search_trace,
+    save_trace,
+)
 
 import time
 
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix, accuracy_score, f1_score, roc_auc_score
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import GridSearchCV, ParameterGrid
 
 
-def random_forest_classifier(company):
+def random_forest_classifier(
+    company, search=None, search_seconds=None, search_fits=None
+):
     df = load_data(company)
 
     # Add Index as a column for ordinal encoding of days
@@ -26,8 +43,6 @@ def random_forest_classifier(company):
 
     X_dev, X_test, y_dev, y_test = split_data(df, business_days=True)
 
-    clf = RandomForestClassifier(random_state=42)
-
     # Hyper Parameter Tuning
     param_grid = {
         "n_estimators": [10, 50, 100, 200, 400],
@@ -35,13 +50,52 @@ def random_forest_classifier(company):
     }
 
     start_time = time.time()
-    model_grid_search = GridSearchCV(
-        clf, param_grid=param_grid, cv=5, scoring="f1_micro"
-    )
-
-    model_grid_search.fit(X_dev, y_dev)
+    # One job per fit in the search, up to the core budget. Apart from the
+    # exhaustive search, the numbers of trees share a fit.
+    fits = len(param_grid["max_depth"]) * 5
+    if search == "exhaustive":
+        fits = len(ParameterGrid(param_grid)) * 5
+    with cpu_budget.stage("search", jobs=fits) as allocation:
+        clf = RandomForestClassifier(random_state=42, n_jobs=allocation["threads"])
+        if search == "halving":
+            # The number of trees is the resource that grows from rung to
+            # rung, up to the largest in the grid.
+            model_grid_search = SuccessiveHalvingSearch(
+                clf,
+                {"max_depth": param_grid["max_depth"]},
+                resource="n_estimators",
+                min_resource=min(param_grid["n_estimators"]),
+                max_resource=max(param_grid["n_estimators"]),
+                cv=5,
+                scoring="f1_micro",
+                max_seconds=search_seconds,
+                max_fits=search_fits,
+                n_jobs=allocation["jobs"],
+            )
+        elif search == "exhaustive":
+            model_grid_search = GridSearchCV(
+                clf,
+                param_grid=param_grid,
+                cv=5,
+                scoring="f1_micro",
+                n_jobs=allocation["jobs"],
+            )
+        else:
+            model_grid_search = WarmStartGridSearch(
+                clf,
+                param_grid,
+                warm_param="n_estimators",
+                cv=5,
+                scoring="f1_micro",
+                n_jobs=allocation["jobs"],
+            )
+
+        model_grid_search.fit(X_dev, y_dev)
     end_time = time.time()
     elapsed_time = end_time - start_time
+    save_trace(
+        search_trace(model_grid_search), "random_forest", company, search or "grid"
+    )
 
     # Evaluate Model
 
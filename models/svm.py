@@ -5,14 +5,27 @@ Vi Mai
 
 This module trains a support vector machine (SVM) on each of our target
 companies. It returns the model and various metrics.
+
+With `backend="approx"`, the exact RBF SVC (whose fit grows faster than
+the number of rows, and whose probabilities take five more fits of internal
+cross-validation) is replaced by `ApproximateSVC`: a Nystroem approximation
+of the same kernel feeding a linear SVM, whose probabilities come from a
+sigmoid fitted on a held-out slice of the most recent training rows. See
+`analyses/svm_benchmark.py` for how the two compare as the rows grow.
 """
 
 from utils.load_data import load_data
 from utils.permutation_importance import permutation_importance
 from utils.split_data import split_data
+from utils import cpu_budget
+
+import numpy as np
 
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import StandardScaler
-from sklearn.svm import SVC
+from sklearn.svm import SVC, LinearSVC
 from sklearn.metrics import confusion_matrix, accuracy_score, f1_score, roc_auc_score
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
@@ -20,13 +33,14 @@ from sklearn.pipeline import Pipeline
 # import shap
 
 
-def svm_classifier(company):
+def svm_classifier(company, backend="exact"):
     df = load_data(company)
     df = df.dropna()
     X_train, X_test, y_train, y_test = split_data(df)
 
-    analyzer = SVMAnalyzer()
-    analyzer.fit(X_train, y_train)
+    analyzer = SVMAnalyzer(backend=backend)
+    with cpu_budget.stage("fit"):
+        analyzer.fit(X_train, y_train)
     y_pred = analyzer.pipeline.predict(X_test)
 
     accuracy = accuracy_score(y_test, y_pred)
@@ -36,7 +50,7 @@ def svm_classifier(company):
     # Confusion
     cm = confusion_matrix(y_test, y_pred)
 
-    svm_probs = analyzer.classifier.predict_proba(X_test)[
+    svm_probs = analyzer.pipeline.predict_proba(X_test)[
         :, 1
     ]  # Probabilities for class 1
     roc_auc = roc_auc_score(y_test, svm_probs)
@@ -44,7 +58,7 @@ def svm_classifier(company):
     perm_imp_df = permutation_importance(analyzer.pipeline, X_test, y_test)
 
     return (
-        analyzer.classifier,
+        analyzer.pipeline,
         cm,
         accuracy,
         f1score,
@@ -56,8 +70,13 @@ def svm_classifier(company):
 
 
 class SVMAnalyzer:
-    def __init__(self):
-        self.classifier = SVC(kernel="rbf", random_state=42, probability=True)
+    def __init__(self, backend="exact"):
+        if backend == "exact":
+            self.classifier = SVC(kernel="rbf", random_state=42, probability=True)
+        elif backend == "approx":
+            self.classifier = ApproximateSVC(random_state=42)
+        else:
+            raise ValueError(f"Unknown SVM backend {backend}.")
 
     def fit(self, X_train, y_train):
         preprocessor = ColumnTransformer(
@@ -72,3 +91,56 @@ class SVMAnalyzer:
             ]
         )
         self.pipeline.fit(X_train, y_train)
+
+
+class ApproximateSVC(ClassifierMixin, BaseEstimator):
+    def __init__(
+        self, n_components=300, C=1.0, calibration_size=0.2, random_state=None
+    ):
+        self.n_components = n_components
+        self.C = C
+        self.calibration_size = calibration_size
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y)
+        self.classes_ = np.unique(y)
+        if len(self.classes_) < 2:
+            raise ValueError("ApproximateSVC needs rows of both classes.")
+        # The most recent rows are held out to calibrate the probabilities.
+        split = len(X) - max(1, int(self.calibration_size * len(X)))
+        # The sigmoid needs both classes, so if the most recent rows are all
+        # of one, the slice goes back to the last row of the other.
+        last_rows = [np.flatnonzero(y == label)[-1] for label in self.classes_]
+        split = min(split, *last_rows)
+        if len(np.unique(y[:split])) < 2:
+            raise ValueError(
+                "ApproximateSVC needs rows of both classes before and after "
+                "its calibration split."
+            )
+        # gamma="scale" as in SVC, which is 1 / features on scaled rows
+        self.kernel_ = Nystroem(
+            kernel="rbf",
+            gamma=1 / (X.shape[1] * X[:split].var()),
+            n_components=min(self.n_components, split),
+            random_state=self.random_state,
+        ).fit(X[:split])
+        self.svm_ = LinearSVC(C=self.C, random_state=self.random_state).fit(
+            self.kernel_.transform(X[:split]), y[:split]
+        )
+        # Platt scaling: a sigmoid of the held-out decision values
+        self.calibration_ = LogisticRegression().fit(
+            self.decision_function(X[split:]).reshape(-1, 1), y[split:]
+        )
+        return self
+
+    def decision_function(self, X):
+        return self.svm_.decision_function(self.kernel_.transform(X))
+
+    def predict_proba(self, X):
+        return self.calibration_.predict_proba(self.decision_function(X).reshape(-1, 1))
+
+    def predict(self, X):
+        # Like SVC, by the side of the margin rather than the probability
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
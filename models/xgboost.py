@@ -5,26 +5,55 @@ Vi Mai
 
 This module trains an XGBoost classifier on each of our target companies.
 It returns the model and various metrics.
+
+By default the classifier uses fixed hyperparameters. With `search="grid"`,
+the depth, learning rate and number of boosting rounds are tuned with a grid
+search that fits the most rounds once per configuration and fold and scores
+the predictions after each number of rounds in the grid
+(`search="exhaustive"` runs the same grid with `GridSearchCV`). With
+`search="halving"`, the depth and learning rate are tuned with a successive
+halving search over the number of boosting rounds, which can be capped with
+`search_seconds` or `search_fits`. (See `utils/search.py` for both.)
+
+The feature importances are the mean absolute SHAP values of the test rows,
+from XGBoost's own TreeSHAP (see `utils/explain.py`).
 """
 
+from utils.explain import tree_shap
 from utils.load_data import load_data
-from utils.permutation_importance import permutation_importance
 from utils.split_data import split_data
+from utils import cpu_budget
+from utils.search import (
+    SuccessiveHalvingSearch,
+    WarmStartGridSearch,
+    search_trace,
+    save_trace,
+)
 
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import confusion_matrix, accuracy_score, f1_score, roc_auc_score
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
+from sklearn.model_selection import GridSearchCV
 from xgboost import XGBClassifier
 
 
-def xgboost_classifier(company):
+def xgboost_classifier(company, search=None, search_seconds=None, search_fits=None):
     df = load_data(company)
     # df = df.dropna()
     X_train, X_test, y_train, y_test = split_data(df, business_days=True)
-    analyzer = XGBoostAnalyzer()
-
-    analyzer.fit(X_train, y_train)
+    # A search fits many models at once; a single fit uses every core.
+    with cpu_budget.stage("fit", jobs=1 if search is None else -1) as allocation:
+        analyzer = XGBoostAnalyzer(
+            n_jobs=allocation["threads"],
+            search=search,
+            search_seconds=search_seconds,
+            search_fits=search_fits,
+            search_jobs=allocation["jobs"],
+        )
+        analyzer.fit(X_train, y_train)
+    if search is not None:
+        save_trace(search_trace(analyzer.search), "xgboost", company, search)
     y_pred = analyzer.pipeline.predict(X_test)
 
     accuracy = accuracy_score(y_test, y_pred)
@@ -34,15 +63,21 @@ def xgboost_classifier(company):
     # Confusion
     cm = confusion_matrix(y_test, y_pred)
 
-    xgboost_probs = analyzer.classifier.predict_proba(X_test)[
+    xgboost_probs = analyzer.pipeline.predict_proba(X_test)[
         :, 1
     ]  # Probabilities for class 1
     roc_auc = roc_auc_score(y_test, xgboost_probs)
 
-    perm_imp_df = permutation_importance(analyzer.pipeline, X_test, y_test)
+    # XGBoost's own TreeSHAP on the scaled test rows
+    with cpu_budget.stage("shap"):
+        perm_imp_df = tree_shap(
+            analyzer.classifier,
+            analyzer.pipeline[:-1].transform(X_test),
+            X_test.columns,
+        )
 
     return (
-        analyzer.classifier,
+        analyzer.pipeline,
         cm,
         accuracy,
         f1score,
@@ -54,13 +89,31 @@ def xgboost_classifier(company):
 
 
 class XGBoostAnalyzer:
-    def __init__(self):
+    param_grid = {
+        "classifier__max_depth": [3, 6, 9],
+        "classifier__learning_rate": [0.05, 0.1, 0.3],
+        "classifier__n_estimators": [50, 100, 200, 300],
+    }
+
+    def __init__(
+        self,
+        n_jobs=None,
+        search=None,
+        search_seconds=None,
+        search_fits=None,
+        search_jobs=None,
+    ):
+        self.search_mode = search
+        self.search_seconds = search_seconds
+        self.search_fits = search_fits
+        self.search_jobs = search_jobs
         self.classifier = XGBClassifier(
             n_estimators=100,
             learning_rate=0.1,
             max_depth=6,
             random_state=42,
             eval_metric="logloss",
+            n_jobs=n_jobs,
         )
 
     def fit(self, X_train, y_train):
@@ -76,4 +129,45 @@ class XGBoostAnalyzer:
                 ("classifier", self.classifier),
             ]
         )
-        self.pipeline.fit(X_train, y_train)
+        rounds = self.param_grid["classifier__n_estimators"]
+        if self.search_mode == "grid":
+            self.search = WarmStartGridSearch(
+                self.pipeline,
+                self.param_grid,
+                warm_param="classifier__n_estimators",
+                cv=5,
+                scoring="f1_micro",
+                n_jobs=self.search_jobs,
+            )
+        elif self.search_mode == "exhaustive":
+            self.search = GridSearchCV(
+                self.pipeline,
+                self.param_grid,
+                cv=5,
+                scoring="f1_micro",
+                n_jobs=self.search_jobs,
+            )
+        elif self.search_mode == "halving":
+            self.search = SuccessiveHalvingSearch(
+                self.pipeline,
+                {
+                    key: values
+                    for key, values in self.param_grid.items()
+                    if key != "classifier__n_estimators"
+                },
+                resource="classifier__n_estimators",
+                min_resource=10,
+                max_resource=max(rounds),
+                cv=5,
+                scoring="f1_micro",
+                max_seconds=self.search_seconds,
+                max_fits=self.search_fits,
+                n_jobs=self.search_jobs,
+            )
+        if self.search_mode is not None:
+            self.search.fit(X_train, y_train)
+            self.pipeline = self.search.best_estimator_
+            self.classifier = self.pipeline.named_steps["classifier"]
+            print(f"Best params: {self.search.best_params_}")
+        else:
+            self.pipeline.fit(X_train, y_train)
@@ -0,0 +1,94 @@
+"""
+# Article Commands
+
+Moacir P. de Sá Pereira
+
+The commands that read ProQuest XML articles, run as
+`python -m preprocessing.article_commands COMMAND [options]`:
+
+- `score_articles xml=DIRECTORY` scores their sentiment (see
+  `article_pipeline.py`);
+- `text_store xml=DIRECTORY` parses them once into a text store (see
+  `text_store.py`), and with `tokens` caches their token ids too.
+
+They parse in spawned processes, and a spawned process imports the module
+the command was started from again. So these commands live here rather than
+in `main.py`, whose imports (TensorFlow, XGBoost, scikit-learn and the rest)
+would load again in every parsing process: this module imports nothing
+until a command runs, and the processes only load `lxml` and BeautifulSoup.
+
+The options are given as in `main.py`: `metadata=`, `output=`, `model=`,
+`backend=`, `parse_workers=`, `inference_workers=`, `store=` and `cpus=`.
+"""
+
+import sys
+
+OPTIONS = {
+    "xml": ("xml_path", str),
+    "metadata": ("metadata", str),
+    "output": ("output_path", str),
+    "model": ("model_path", str),
+    "backend": ("backend", str),
+    "parse_workers": ("parse_workers", int),
+    "inference_workers": ("inference_workers", int),
+    "store": ("store_path", str),
+}
+
+
+# Score the sentiment of a local directory of XML articles.
+def score_articles(article_options):
+    # Only this command needs the sentiment model's libraries.
+    from preprocessing.article_pipeline import score_articles as run_pipeline
+
+    run_pipeline(**article_options)
+
+
+# Parse a directory of XML articles once into a compressed text store.
+def build_text_store(article_options, cache_token_ids=False):
+    from preprocessing.text_store import build_text_store as build_store
+    from preprocessing.text_store import cache_tokens
+
+    store = build_store(
+        article_options["xml_path"],
+        article_options.get("store_path"),
+        article_options.get("parse_workers"),
+    )
+    if cache_token_ids:
+        # Only the token ids need the tokenizer's libraries.
+        from transformers import AutoTokenizer
+
+        from preprocessing.sentiment_engine import HUGGINGFACE_MODEL
+
+        model_path = article_options.get("model_path", f"models/{HUGGINGFACE_MODEL}")
+        cache_tokens(
+            store, AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        )
+
+
+def main(args):
+    article_options = {}
+    for arg in args[1:]:
+        name, _, value = arg.partition("=")
+        if name in OPTIONS:
+            option, parse = OPTIONS[name]
+            article_options[option] = parse(value)
+        if name == "cpus":
+            from utils import cpu_budget
+
+            cpu_budget.configure(int(value))
+
+    command = args[0] if args else None
+    if command not in ["score_articles", "text_store"]:
+        print("Give a command, `score_articles` or `text_store`. See README.")
+        return
+    if "xml_path" not in article_options:
+        print("Give the directory of XML articles, as in `xml=data/walmart`.")
+        return
+    if command == "score_articles":
+        score_articles(article_options)
+    else:
+        build_text_store(article_options, cache_token_ids="tokens" in args[1:])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,335 @@
+"""
+# Article Pipeline
+
+Moacir P. de Sá Pereira
+
+This module scores the sentiment of a local directory of ProQuest articles,
+saved as `{goid}.xml` as in TDM Studio, with the sentiment engine (see
+`sentiment_engine.py`). Instead of reading, tokenizing and scoring one
+article at a time, it runs four stages at once, on batches of `batch_size`
+articles:
+
+1. parse: a pool of `parse_workers` processes extracts each article’s text
+   from its XML and the HTML inside it (see `article_text.py`);
+2. tokenize: a thread tokenizes each batch;
+3. infer: `inference_workers` threads score the batches’ chunks with the
+   model, sharing the cores the parsing leaves;
+4. write: the main thread appends the scored batches, in order, to a parquet
+   file, one row group per batch.
+
+The stages pass batches through queues that hold at most `queue_size` of
+them, and at most `queue_size` batches are being parsed at once. A stage
+that gets ahead waits for the next one to catch up, so memory stays bounded
+whatever the size of the corpus, and the parsing processes keep working
+while the model scores. If a stage fails, the others stop working and drain
+their queues, nothing is written and the error is raised.
+
+If the corpus has a text store (see `text_store.py`), by default
+`data/text_store/{directory}.texts`, the batches it holds are read from it
+instead of parsed, and if it caches the token ids of the engine’s
+tokenizer, they are not tokenized either, so scoring a corpus again only
+waits on the model.
+
+With `metadata`, a parquet file of articles such as those the
+`concatenate-corpora` notebook writes, only its articles are scored and its
+columns are kept, as in the notebook’s analyzed files. Otherwise every XML
+file in the directory is scored. Each stage’s busy time is reported, so the
+overlap shows: the wall-clock time is close to the slowest stage’s, not to
+their sum. It runs with
+`python -m preprocessing.article_commands score_articles xml=DIRECTORY`.
+"""
+
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from preprocessing.article_text import parse_files
+from preprocessing.sentiment_engine import SENTIMENT_COLUMNS, SentimentAnalysisEngine
+from preprocessing.text_store import TextStore, default_store_path, tokenizer_key
+from utils import cpu_budget
+
+# Marks the end of a queue
+DONE = None
+
+
+def score_articles(
+    xml_path,
+    output_path=None,
+    metadata=None,
+    parse_workers=None,
+    inference_workers=1,
+    batch_size=256,
+    queue_size=4,
+    store_path=None,
+    **engine_options,
+):
+    name = os.path.basename(os.path.normpath(xml_path))
+    output_path = output_path or f"data/sentiment_data/{name}_scores.parquet"
+    store_path = store_path or default_store_path(name)
+    store = (
+        TextStore(store_path) if os.path.exists(f"{store_path}.index.parquet") else None
+    )
+    if metadata is not None:
+        articles = pd.read_parquet(metadata)
+    else:
+        articles = pd.DataFrame(
+            {
+                "goid": sorted(
+                    int(file[: -len(".xml")])
+                    for file in os.listdir(xml_path)
+                    if file.endswith(".xml")
+                )
+            },
+            dtype="int64",
+        )
+    batches = [
+        articles.iloc[start : start + batch_size]
+        for start in range(0, len(articles), batch_size)
+    ]
+
+    # A model pass takes far longer than parsing its articles, so most of
+    # the cores go to the model, and all of them when the store holds every
+    # text.
+    cores = cpu_budget.cores()
+    parse_workers = parse_workers or max(1, cores // 8)
+    parsing = store is None or not store.covers(articles.goid)
+    engine_options.setdefault(
+        "threads",
+        max(1, (cores - parse_workers * parsing) // inference_workers),
+    )
+    engine = SentimentAnalysisEngine(**engine_options)
+    key = tokenizer_key(engine.tokenizer) if store is not None else None
+    sources = [batch_source(store, rows.goid, key) for rows in batches]
+    print(
+        f"Reading {sources.count('tokens')} batches as token ids and "
+        f"{sources.count('store')} as texts from the store, and parsing "
+        f"{sources.count('xml')}."
+    )
+
+    start = time.perf_counter()
+    busy = {"parse": 0.0, "tokenize": 0.0, "infer": 0.0, "write": 0.0}
+    # The inference workers add to their stage's time at once.
+    infer_lock = threading.Lock()
+    failures = []
+    parsed = queue.Queue(queue_size)
+    tokenized = queue.Queue(queue_size)
+    scored = queue.Queue(queue_size)
+
+    def tokenize(batch):
+        batch_start = time.perf_counter()
+        i, rows, texts = batch
+        if texts is None:
+            input_ids = store.token_ids(rows.goid, key)
+        else:
+            # A file that could not be parsed is scored as an empty text.
+            input_ids = engine.tokenize([text or "" for text in texts])
+        busy["tokenize"] += time.perf_counter() - batch_start
+        return i, rows, input_ids
+
+    def infer(batch):
+        batch_start = time.perf_counter()
+        i, rows, input_ids = batch
+        scores = engine.score(input_ids)
+        with infer_lock:
+            busy["infer"] += time.perf_counter() - batch_start
+        return i, rows, scores
+
+    # Spawned, because forking a process that runs PyTorch's threads can
+    # deadlock. The stage reports how busy the cores were.
+    with cpu_budget.stage("article pipeline"), ProcessPoolExecutor(
+        parse_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        threads = [
+            threading.Thread(
+                target=parse_batches,
+                args=(pool, xml_path, batches, sources, store, parsed, failures, busy),
+                kwargs={"parse_workers": parse_workers, "in_flight": queue_size},
+            ),
+            threading.Thread(
+                target=run_stage,
+                args=(tokenize, parsed, tokenized, failures),
+                kwargs={"receivers": inference_workers},
+            ),
+        ] + [
+            threading.Thread(
+                target=run_stage, args=(infer, tokenized, scored, failures)
+            )
+            for _ in range(inference_workers)
+        ]
+        for thread in threads:
+            thread.start()
+        written = write_batches(
+            scored,
+            output_path,
+            output_schema(articles),
+            failures,
+            busy,
+            senders=inference_workers,
+        )
+        for thread in threads:
+            thread.join()
+
+    if failures:
+        raise failures[0]
+    seconds = time.perf_counter() - start
+    print(
+        f"Scored {written} articles in {seconds:.1f}s "
+        f"({written / seconds:.2f} articles/s) and wrote {output_path}."
+    )
+    print(
+        "Busy time per stage: "
+        + ", ".join(f"{stage} {value:.1f}s" for stage, value in busy.items())
+    )
+    return {"articles": written, "seconds": seconds, **busy}
+
+
+def batch_source(store, goids, key):
+    if store is None:
+        return "xml"
+    if store.covers(goids, key):
+        return "tokens"
+    if store.covers(goids):
+        return "store"
+    return "xml"
+
+
+def parse_batches(
+    pool,
+    xml_path,
+    batches,
+    sources,
+    store,
+    outputs,
+    failures,
+    busy,
+    parse_workers,
+    in_flight,
+):
+    # Each batch is split between the processes, and a few batches are
+    # parsed ahead while the next stage is busy. Batches in the store are
+    # read right away, and batches whose token ids are cached have no texts.
+    pending = deque()
+    try:
+        for i, (rows, source) in enumerate(zip(batches, sources)):
+            if failures:
+                break
+            if source == "xml":
+                paths = [os.path.join(xml_path, f"{goid}.xml") for goid in rows.goid]
+                step = math.ceil(len(paths) / parse_workers)
+                futures = [
+                    pool.submit(parse_files, paths[part : part + step])
+                    for part in range(0, len(paths), step)
+                ]
+            else:
+                batch_start = time.process_time()
+                texts = store.texts(rows.goid) if source == "store" else None
+                futures = [Future()]
+                futures[0].set_result((texts, time.process_time() - batch_start))
+            pending.append((i, rows, futures))
+            if len(pending) >= in_flight:
+                outputs.put(gather(*pending.popleft(), busy))
+        while pending and not failures:
+            outputs.put(gather(*pending.popleft(), busy))
+    except Exception as error:
+        failures.append(error)
+    outputs.put(DONE)
+
+
+def gather(i, rows, futures, busy):
+    texts = []
+    for future in futures:
+        part, seconds = future.result()
+        if part is None:
+            texts = None
+        else:
+            texts.extend(part)
+        busy["parse"] += seconds
+    return i, rows, texts
+
+
+def run_stage(work, inputs, outputs, failures, receivers=1):
+    # After a failure anywhere, the stage keeps emptying its queue without
+    # working, so that no stage waits on a full queue forever.
+    while (batch := inputs.get()) is not DONE:
+        if failures:
+            continue
+        try:
+            outputs.put(work(batch))
+        except Exception as error:
+            failures.append(error)
+    for _ in range(receivers):
+        outputs.put(DONE)
+
+
+def write_batches(inputs, output_path, schema, failures, busy, senders=1):
+    # Inference workers can finish out of order, so batches wait until the
+    # ones before them are written.
+    waiting = {}
+    next_batch = 0
+    written = 0
+    writer = None
+    finished = 0
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    try:
+        while finished < senders:
+            batch = inputs.get()
+            if batch is DONE:
+                finished += 1
+                continue
+            if failures:
+                continue
+            try:
+                batch_start = time.perf_counter()
+                i, rows, scores = batch
+                waiting[i] = (rows, scores)
+                while next_batch in waiting:
+                    rows, scores = waiting.pop(next_batch)
+                    table = batch_table(rows, scores, schema)
+                    if writer is None:
+                        writer = pq.ParquetWriter(f"{output_path}.tmp", schema)
+                    writer.write_table(table)
+                    written += len(rows)
+                    next_batch += 1
+                busy["write"] += time.perf_counter() - batch_start
+            except Exception as error:
+                failures.append(error)
+    finally:
+        if writer is not None:
+            writer.close()
+    if failures:
+        if writer is not None:
+            os.remove(f"{output_path}.tmp")
+    elif writer is not None:
+        os.replace(f"{output_path}.tmp", output_path)
+    else:
+        # No articles: a file with no rows and the same columns
+        pq.write_table(schema.empty_table(), output_path)
+    return written
+
+
+def output_schema(articles):
+    # Inferred from every article at once, so that a batch in which a column
+    # happens to be empty still has the same types as the others
+    schema = pa.Schema.from_pandas(
+        articles.drop(columns=SENTIMENT_COLUMNS, errors="ignore"), preserve_index=False
+    )
+    for column, column_type in zip(
+        SENTIMENT_COLUMNS, [pa.float64(), pa.float64(), pa.int64()]
+    ):
+        schema = schema.append(pa.field(column, column_type))
+    return schema
+
+
+def batch_table(rows, scores, schema):
+    df = rows.reset_index(drop=True).drop(columns=SENTIMENT_COLUMNS, errors="ignore")
+    df[SENTIMENT_COLUMNS] = pd.DataFrame(scores, columns=SENTIMENT_COLUMNS)
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
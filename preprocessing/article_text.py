@@ -0,0 +1,51 @@
+"""
+# Article Text
+
+Moacir P. de Sá Pereira
+
+These functions read the text of a ProQuest article from its XML file, as
+`get_text` does in the `analyze-texts` notebook: the first of its
+`FullText`, `HiddenText` and `Text` elements, without the HTML inside it,
+on one line. A file that cannot be read gives `None`, so that it can be
+told from an article without text (the pipeline scores it as an empty text,
+as the notebook did, and the text store records it as a failure).
+
+They only need `lxml` and BeautifulSoup, so the processes that parse
+articles for `article_pipeline.py` don’t load the model’s libraries.
+"""
+
+import time
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+
+def article_text(path):
+    # The text of the first of these elements, without its HTML
+    text = ""
+    try:
+        root = etree.parse(path).getroot()
+        for tag in ["FullText", "HiddenText", "Text"]:
+            if root.find(f".//{tag}") is not None:
+                text = root.find(f".//{tag}").text or ""
+                break
+
+        text = (
+            BeautifulSoup(text, "lxml")
+            .get_text()
+            .replace("\n", " ")
+            .replace("\\", "")
+            .strip()
+        )
+
+    except Exception as e:
+        print(f"Error while parsing file {path}: {e}")
+        return None
+
+    return text
+
+
+def parse_files(paths):
+    start = time.process_time()
+    texts = [article_text(path) for path in paths]
+    return texts, time.process_time() - start
@@ -0,0 +1,138 @@
+"""
+# Download Cache
+
+Moacir P. de Sá Pereira
+
+This module defines an on-disk cache for the raw tables downloaded from FRED
+and Yahoo! Finance. Each entry is keyed by a hash of (source, series or
+ticker, start date, end date) and is stored as a parquet file in
+`data/cache/{source}/{key}.parquet`. An index in `data/cache/index.json`
+records when each entry was written and last read, and how large it is. It
+is written when entries are stored or evicted and when the cache is closed
+(the downloader closes its cache), not on every read.
+
+- Entries expire after a per-source time to live (`DEFAULT_TTLS`).
+- When the cache grows past `max_bytes`, the least recently read entries are
+  evicted.
+- In offline mode, entries never expire and a miss raises a `LookupError`
+  instead of going to the network.
+- Empty tables (e.g. a Yahoo! response without a result) are not cached, so
+  one bad response doesn't hide the data until the entry expires.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+CACHE_PATH = "data/cache"
+
+DEFAULT_TTLS = {
+    "fred": 24 * 60 * 60,
+    "yahoo": 12 * 60 * 60,
+}
+
+
+class DownloadCache:
+    def __init__(
+        self, path=CACHE_PATH, ttls=None, max_bytes=512 * 1024**2, offline=False
+    ):
+        self.path = path
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(path, "index.json")
+        self.index = {}
+        # Whether reads have changed the index since it was written
+        self.dirty = False
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def key(self, source, name, start_date, end_date):
+        identity = json.dumps(
+            [
+                source,
+                name,
+                f"{pd.Timestamp(start_date):%Y-%m-%d}",
+                f"{pd.Timestamp(end_date):%Y-%m-%d}",
+            ]
+        )
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def entry_path(self, source, key):
+        return os.path.join(self.path, source, f"{key}.parquet")
+
+    def get(self, source, name, start_date, end_date):
+        key = self.key(source, name, start_date, end_date)
+        with self.lock:
+            entry = self.index.get(key)
+            fresh = entry is not None and (
+                self.offline or time.time() - entry["created"] < self.ttls[source]
+            )
+            if fresh:
+                entry["accessed"] = time.time()
+                self.dirty = True
+        if fresh:
+            try:
+                table = pd.read_parquet(self.entry_path(source, key))
+            except FileNotFoundError:
+                # Evicted by another thread since it was looked up
+                table = None
+            # Empty tables cached before they were skipped are misses too.
+            if table is not None and not table.empty:
+                return table
+            with self.lock:
+                self.index.pop(key, None)
+        if self.offline:
+            raise LookupError(
+                f"{source} data for {name} from {start_date} to {end_date} "
+                "is not cached and the cache is in offline mode."
+            )
+        return None
+
+    def put(self, source, name, start_date, end_date, table):
+        if table.empty:
+            return
+        key = self.key(source, name, start_date, end_date)
+        path = self.entry_path(source, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table.to_parquet(path)
+        now = time.time()
+        with self.lock:
+            self.index[key] = {
+                "source": source,
+                "name": name,
+                "created": now,
+                "accessed": now,
+                "size": os.path.getsize(path),
+            }
+            self.evict()
+            self.write_index()
+
+    def evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        by_last_access = sorted(self.index, key=lambda k: self.index[k]["accessed"])
+        for key in by_last_access:
+            if total <= self.max_bytes:
+                break
+            entry = self.index.pop(key)
+            total -= entry["size"]
+            path = self.entry_path(entry["source"], key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        with self.lock:
+            if self.dirty:
+                self.write_index()
+
+    def write_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.index_path, "w") as f:
+            json.dump(self.index, f)
+        self.dirty = False
@@ -0,0 +1,258 @@
+"""
+# Downloads
+
+Moacir P. de Sá Pereira
+
+This module defines the download layer for the FRED indicators and the
+Yahoo! Finance share prices. Every series and every ticker is requested at
+once through a bounded thread pool that shares one keep-alive HTTP session,
+so the wall-clock cost of a download is close to that of the slowest request
+instead of the sum of all of them. Failed requests (connection errors,
+timeouts, 429s and 5xx responses) are retried with exponential backoff.
+
+The requests are not batched, because neither API can batch them: FRED’s
+`series/observations` takes one `series_id`, and Yahoo!’s chart endpoint one
+symbol (its `spark` endpoint takes many, but only returns closes, without
+the open, high, low, volume, dividends and splits). One request per series or
+ticker over shared connections is as close as they allow.
+
+A series or ticker that still fails after its retries doesn’t stop the
+others. It comes back empty (an empty series or frame), its error is printed
+and kept in `failures` under `("fred", series_id)` or `("yahoo", ticker)`, and
+the callers fall back on the data saved by earlier downloads.
+
+The base URLs default to the public APIs but can be overridden with the
+`FRED_API_URL` and `YAHOO_API_URL` environment variables, for example to point
+the downloader at a local stub server.
+
+A `Downloader` holds its threads and connections until it is closed, so it
+is used as a context manager, as in `with Downloader() as downloader:`.
+
+`fetch_share_prices` returns frames shaped like `yf.Ticker(...).history()`
+after `reset_index()` (with `auto_adjust=True`), so the rest of the pipeline
+does not need to know where the data came from.
+
+When a `DownloadCache` is passed in, the raw tables (FRED observations and
+unadjusted Yahoo! bars) are served from and written to it, and only misses go
+to the network.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+FRED_API_URL = "https://api.stlouisfed.org/fred"
+YAHOO_API_URL = "https://query2.finance.yahoo.com"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class Downloader:
+    def __init__(self, max_workers=16, retries=4, backoff=0.5, timeout=30, cache=None):
+        self.fred_url = os.getenv("FRED_API_URL", FRED_API_URL)
+        self.yahoo_url = os.getenv("YAHOO_API_URL", YAHOO_API_URL)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.failures = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.session = requests.Session()
+        # Yahoo! rejects requests without a browser-like user agent.
+        self.session.headers["User-Agent"] = "Mozilla/5.0"
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def get_json(self, url, params):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(
+                    f"{response.status_code} for {response.url}", response=response
+                )
+            if attempt == self.retries:
+                raise error
+            time.sleep(self.backoff * 2**attempt)
+
+    def fetch_each(self, source, names, fetch, empty):
+        # Every name at once; a name that fails comes back as `empty`.
+        def attempt(name):
+            try:
+                result = fetch(name)
+            except requests.RequestException as e:
+                print(f"Could not download {name}: {e}")
+                self.failures[source, name] = str(e)
+                return empty()
+            self.failures.pop((source, name), None)
+            return result
+
+        return dict(zip(names, self.executor.map(attempt, names)))
+
+    def cached(self, source, name, start_date, end_date, fetch):
+        if self.cache is None:
+            return fetch()
+        table = self.cache.get(source, name, start_date, end_date)
+        if table is None:
+            table = fetch()
+            self.cache.put(source, name, start_date, end_date, table)
+        return table
+
+    def fetch_fred_series(self, series_ids, start_date, end_date, api_key):
+        def fetch_table(series_id):
+            observations = self.get_json(
+                f"{self.fred_url}/series/observations",
+                {
+                    "series_id": series_id,
+                    "api_key": api_key,
+                    "file_type": "json",
+                    "observation_start": f"{pd.Timestamp(start_date):%Y-%m-%d}",
+                    "observation_end": f"{pd.Timestamp(end_date):%Y-%m-%d}",
+                },
+            )["observations"]
+            return pd.DataFrame(
+                {
+                    "date": [o["date"] for o in observations],
+                    "value": [o["value"] for o in observations],
+                }
+            )
+
+        def fetch(series_id):
+            table = self.cached(
+                "fred",
+                series_id,
+                start_date,
+                end_date,
+                lambda: fetch_table(series_id),
+            )
+            return fred_table_to_series(table)
+
+        return self.fetch_each(
+            "fred", series_ids, fetch, lambda: pd.Series(dtype=float)
+        )
+
+    def fetch_share_prices(self, tickers, start_date, end_date):
+        # The end date is inclusive, as in the rest of the pipeline.
+        period1 = int(pd.Timestamp(start_date, tz="UTC").timestamp())
+        period2 = int(
+            (pd.Timestamp(end_date, tz="UTC") + pd.Timedelta(days=1)).timestamp()
+        )
+
+        def fetch_table(ticker):
+            chart = self.get_json(
+                f"{self.yahoo_url}/v8/finance/chart/{ticker}",
+                {
+                    "period1": period1,
+                    "period2": period2,
+                    "interval": "1d",
+                    "events": "div,splits",
+                    "includeAdjustedClose": "true",
+                },
+            )["chart"]
+            if not chart.get("result"):
+                return pd.DataFrame()
+            return yahoo_chart_to_table(chart["result"][0])
+
+        def fetch(ticker):
+            table = self.cached(
+                "yahoo",
+                ticker,
+                start_date,
+                end_date,
+                lambda: fetch_table(ticker),
+            )
+            return table_to_history(table)
+
+        return self.fetch_each("yahoo", tickers, fetch, pd.DataFrame)
+
+
+def fred_table_to_series(table):
+    # FRED marks missing observations with ".".
+    return pd.Series(
+        pd.to_numeric(table["value"], errors="coerce").to_numpy(),
+        index=pd.to_datetime(table["date"]),
+        dtype=float,
+    )
+
+
+def yahoo_chart_to_table(result):
+    timestamps = result.get("timestamp")
+    if not timestamps:
+        return pd.DataFrame()
+
+    timezone = result["meta"].get("exchangeTimezoneName", "America/New_York")
+
+    def to_dates(seconds):
+        return (
+            pd.to_datetime(seconds, unit="s", utc=True).tz_convert(timezone).normalize()
+        )
+
+    quote = result["indicators"]["quote"][0]
+    table = pd.DataFrame(
+        {
+            "open": quote["open"],
+            "high": quote["high"],
+            "low": quote["low"],
+            "close": quote["close"],
+            "volume": quote["volume"],
+        },
+        index=to_dates(timestamps),
+        dtype=float,
+    )
+    adjclose = result["indicators"].get("adjclose")
+    table["adjclose"] = adjclose[0]["adjclose"] if adjclose else table["close"]
+
+    events = result.get("events", {})
+    table["dividends"] = 0.0
+    table["stock_splits"] = 0.0
+    for event in events.get("dividends", {}).values():
+        on_date = table.index.isin(to_dates([event["date"]]))
+        table.loc[on_date, "dividends"] = event["amount"]
+    for event in events.get("splits", {}).values():
+        on_date = table.index.isin(to_dates([event["date"]]))
+        table.loc[on_date, "stock_splits"] = event["numerator"] / event["denominator"]
+
+    table.index.name = "date"
+    return table.reset_index()
+
+
+def table_to_history(table):
+    if table.empty:
+        return pd.DataFrame()
+
+    # Adjust for splits and dividends the way yfinance's auto_adjust does.
+    ratio = table["adjclose"] / table["close"]
+    return pd.DataFrame(
+        {
+            "Date": table["date"],
+            "Open": table["open"] * ratio,
+            "High": table["high"] * ratio,
+            "Low": table["low"] * ratio,
+            "Close": table["adjclose"],
+            "Volume": table["volume"],
+            "Dividends": table["dividends"],
+            "Stock Splits": table["stock_splits"],
+        }
+    )
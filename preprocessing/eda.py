@@ -9,12 +9,13 @@ companies.
 """
 
 import pandas as pd
+from utils.load_data import load_data
 
 
 def eda(companies):
     dfs = []
     for company in companies:
-        df = pd.read_parquet(f"data/{company}_merged_data.parquet")
+        df = load_data(company)
         df["company"] = company
         dfs.append(df)
 
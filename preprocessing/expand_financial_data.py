@@ -37,12 +37,50 @@ Column | Type | Description
 `target_price` | float | Next day’s price.
 `target` | int | Buy or sell recommendation (1 or 0)
 
+`add_rolling_features` works on any date-indexed frame of share prices. All
+the windows are computed in one pass over contiguous arrays: the means and
+standard deviations come from shared cumulative sums, so a window costs the
+same whether it is three or 200 days wide, and adding a window only adds a
+few vectorized subtractions. Minimums and maximums, when requested, come from
+a strided sliding-window view. `windows` and `stats` default to the columns
+above; e.g. `add_rolling_features(df, windows=[5, 20, 50, 200],
+stats=["mean", "std", "min", "max"])` adds columns like
+`price_200d_rolling_max`. Bollinger bands are added whenever both the mean
+and the standard deviation are.
+
 """
 
+import numpy as np
 import pandas as pd
 
+WINDOWS = [3, 7, 14]
+STATS = ["mean", "std"]
 
-def expand_financial_data(df):
+PRICE_COLUMNS = [
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+    "dividends",
+    "stock_splits",
+]
+
+
+def rolling_feature_columns(windows, stats=STATS):
+    columns = []
+    for window in windows:
+        for series in ["price", "volume"]:
+            columns += [f"{series}_{window}d_rolling_{stat}" for stat in stats]
+        if "mean" in stats and "std" in stats:
+            columns += [
+                f"bollinger_{window}d_upper_band",
+                f"bollinger_{window}d_lower_band",
+            ]
+    return columns
+
+
+def prepare_share_prices(df):
     new_column_names = {
         "Date": "date",
         "Open": "open",
@@ -56,73 +94,95 @@ def expand_financial_data(df):
     df = df.rename(columns=new_column_names)
 
     # The share price data includes times and timezone offsets,
-    # which get badly parse. We only need the date.
-    df["date"] = df.date.apply(lambda x: x.split(" ")[0])
-    df["date"] = pd.to_datetime(df["date"])
+    # which get badly parse. We only need the date, which is the first
+    # ten characters whether the column holds strings or timestamps.
+    df["date"] = pd.to_datetime(df.date.astype(str).str.slice(0, 10), format="%Y-%m-%d")
     df.set_index("date", inplace=True)
 
+    return df
+
+
+def expand_financial_data(df):
+    return add_rolling_features(prepare_share_prices(df))
+
+
+def rolling_stats(values, windows, stats):
+    # Returns {(window, stat): array}, where the first window - 1 entries
+    # (and any window with a missing value) are NaN, as with pandas.
+    n = len(values)
+    missing = np.isnan(values)
+    # Centering on the mean keeps the cumulative sums of squares small, so
+    # the variances do not lose precision to cancellation.
+    shift = values[~missing].mean() if n > missing.sum() else 0.0
+    centered = np.where(missing, 0.0, values - shift)
+    sums = np.concatenate([[0.0], np.cumsum(centered)])
+    squares = np.concatenate([[0.0], np.cumsum(centered**2)])
+    counts = np.concatenate([[0], np.cumsum(~missing)])
+
+    results = {}
+    for window in windows:
+        for stat in stats:
+            results[(window, stat)] = np.full(n, np.nan)
+        if n < window:
+            continue
+        complete = (counts[window:] - counts[:-window]) == window
+        window_sums = sums[window:] - sums[:-window]
+        window_squares = squares[window:] - squares[:-window]
+        if "mean" in stats:
+            mean = window_sums / window + shift
+            results[(window, "mean")][window - 1 :] = np.where(complete, mean, np.nan)
+        if {"std", "min", "max"} & set(stats):
+            view = np.lib.stride_tricks.sliding_window_view(values, window)
+            lowest = view.min(axis=1)
+            highest = view.max(axis=1)
+        if "std" in stats:
+            variance = (window_squares - window_sums**2 / window) / (window - 1)
+            std = np.sqrt(np.maximum(variance, 0.0))
+            # The sums don't cancel exactly, so a constant window's deviation
+            # is set to 0, as pandas gives.
+            std = np.where(lowest == highest, 0.0, std)
+            results[(window, "std")][window - 1 :] = np.where(complete, std, np.nan)
+        if "min" in stats:
+            results[(window, "min")][window - 1 :] = lowest
+        if "max" in stats:
+            results[(window, "max")][window - 1 :] = highest
+        if "sum" in stats:
+            total = window_sums + window * shift
+            results[(window, "sum")][window - 1 :] = np.where(complete, total, np.nan)
+
+    return results
+
+
+def add_rolling_features(df, windows=WINDOWS, stats=STATS):
+    close = df["close"].to_numpy(dtype=float)
+    volume = df["volume"].to_numpy(dtype=float)
+
     # Ignore days with no closing price for calculating target and rolling values.
-    business_days_df = df.copy()
-    business_days_df = business_days_df.dropna(subset=["close"])
-    business_days_df["target_price"] = business_days_df.close.shift(-1)
-    business_days_df["target"] = (
-        business_days_df.close.shift(-1) > business_days_df.close
-    ).astype(int)
-
-    for window in [3, 7, 14]:
-        business_days_df[f"price_{window}d_rolling_mean"] = (
-            business_days_df.close.rolling(window).mean()
-        )
-        business_days_df[f"price_{window}d_rolling_std"] = (
-            business_days_df.close.rolling(window).std()
-        )
-        business_days_df[f"volume_{window}d_rolling_mean"] = (
-            business_days_df.volume.rolling(window).mean()
-        )
-        business_days_df[f"volume_{window}d_rolling_std"] = (
-            business_days_df.volume.rolling(window).std()
-        )
-        # Bollinger Bands
-        std_dev = 2
-        business_days_df[f"bollinger_{window}d_upper_band"] = business_days_df[
-            f"price_{window}d_rolling_mean"
-        ] + (business_days_df[f"price_{window}d_rolling_std"] * std_dev)
-        business_days_df[f"bollinger_{window}d_lower_band"] = business_days_df[
-            f"price_{window}d_rolling_mean"
-        ] - (business_days_df[f"price_{window}d_rolling_std"] * std_dev)
-
-    # Merge everything back together
-    full_date_range = pd.date_range(start=df.index.min(), end=df.index.max(), freq="D")
-    business_days_df = business_days_df.reindex(full_date_range)
-
-    df = df.merge(
-        business_days_df[
-            [
-                "price_3d_rolling_mean",
-                "price_3d_rolling_std",
-                "volume_3d_rolling_mean",
-                "volume_3d_rolling_std",
-                "bollinger_3d_upper_band",
-                "bollinger_3d_lower_band",
-                "price_7d_rolling_mean",
-                "price_7d_rolling_std",
-                "volume_7d_rolling_mean",
-                "volume_7d_rolling_std",
-                "bollinger_7d_upper_band",
-                "bollinger_7d_lower_band",
-                "price_14d_rolling_mean",
-                "price_14d_rolling_std",
-                "volume_14d_rolling_mean",
-                "volume_14d_rolling_std",
-                "bollinger_14d_upper_band",
-                "bollinger_14d_lower_band",
-                "target",
-                "target_price",
-            ]
-        ],
-        how="left",
-        left_index=True,
-        right_index=True,
-    )
+    business_days = ~np.isnan(close)
+    close = close[business_days]
+    volume = volume[business_days]
 
-    return df
+    features = {}
+    for series, values in [("price", close), ("volume", volume)]:
+        for (window, stat), result in rolling_stats(values, windows, stats).items():
+            features[f"{series}_{window}d_rolling_{stat}"] = result
+    for window in windows:
+        if "mean" in stats and "std" in stats:
+            # Bollinger Bands
+            std_dev = 2
+            mean = features[f"price_{window}d_rolling_mean"]
+            std = features[f"price_{window}d_rolling_std"]
+            features[f"bollinger_{window}d_upper_band"] = mean + (std * std_dev)
+            features[f"bollinger_{window}d_lower_band"] = mean - (std * std_dev)
+
+    target_price = np.append(close[1:], np.nan)
+    features["target"] = (target_price > close).astype(int)
+    features["target_price"] = target_price
+
+    # Spread the business-day values back over every row of df.
+    columns = {}
+    for column in rolling_feature_columns(windows, stats) + ["target", "target_price"]:
+        columns[column] = np.full(len(df), np.nan)
+        columns[column][business_days] = features[column]
+
+    return pd.concat([df, pd.DataFrame(columns, index=df.index)], axis=1)
@@ -32,19 +32,28 @@ indicators are:
 - MCUMFN: Capacity Utilization: Manufacturing
 
 - SP500: S&P 500
+
+All the series are downloaded at once through `preprocessing.downloads`.
 """
 
 import pandas as pd
 import os
 from dotenv import load_dotenv
-from fredapi import Fred
+from preprocessing.downloads import Downloader
+
 
+def get_external_indicators(
+    start_date, end_date, date_range, save=True, downloader=None
+):
+    if downloader is None:
+        with Downloader() as downloader:
+            return get_external_indicators(
+                start_date, end_date, date_range, save=save, downloader=downloader
+            )
 
-def get_external_indicators(start_date, end_date, date_range):
     load_dotenv()
 
     api_key = os.getenv("FRED_API_KEY")
-    fred = Fred(api_key=api_key)
 
     METRICS = [
         "CPIAUCSL",
@@ -60,18 +69,7 @@ def get_external_indicators(start_date, end_date, date_range):
     # Create an empty dataframe with the date range as index
     df = pd.DataFrame(index=date_range)
 
-    # Iterate over all metrics, fetch data, and append to df
-    for m in METRICS:
-        series_data = fred.get_series(
-            m, observation_start=start_date, observation_end=end_date
-        )
-        df[m] = series_data
-
-    # Some indicators are monthly and some are quarterly
-    # Fill the NaN with the last valid value
-    df = df.ffill()
-
-    # Rename columns
+    # The metrics' names in the saved and merged data
     new_column_names = {
         "CPIAUCSL": "cpi",
         "PCE": "pce",
@@ -82,11 +80,31 @@ def get_external_indicators(start_date, end_date, date_range):
         "MCUMFN": "manufacturing",
         "SP500": "sp500",
     }
-    df = df.rename(columns=new_column_names)
 
+    # Fetch all metrics concurrently, then append them to df
+    series_data = downloader.fetch_fred_series(METRICS, start_date, end_date, api_key)
+    for m in METRICS:
+        df[m] = series_data[m]
+
+    # A metric that could not be downloaded is taken from the last saved
+    # indicators, as share prices are.
     path = "data/financial_data/external_indicators.csv"
-    df.to_csv(path, index_label="date")
-    print(f"External indicators saved to {path}")
+    failed = [m for m in METRICS if ("fred", m) in downloader.failures]
+    if failed and os.path.exists(path):
+        saved = pd.read_csv(path, index_col="date", parse_dates=True)
+        for m in failed:
+            print(f"Loading {m} from {path}.")
+            df[m] = saved[new_column_names[m]].reindex(df.index)
+
+    # Some indicators are monthly and some are quarterly
+    # Fill the NaN with the last valid value
+    df = df.ffill()
+
+    df = df.rename(columns=new_column_names)
+
+    if save:
+        df.to_csv(path, index_label="date")
+        print(f"External indicators saved to {path}")
 
     # Use the date as the index for merging
     return df
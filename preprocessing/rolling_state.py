@@ -0,0 +1,135 @@
+"""
+# Rolling State
+
+Moacir P. de Sá Pereira
+
+This module defines `RollingState`, an online version of
+`expand_financial_data.add_rolling_features`. It keeps the last closes and
+volumes of a company in ring buffers as long as the widest window. Adding a
+trading day costs the same no matter how long the history is, and gives
+that day’s row of rolling means, standard deviations and Bollinger bands.
+The values match the batch path to floating point precision.
+
+`update` returns a dictionary of rows keyed by date, and `update_many`
+returns a dataframe. A day’s `target` and `target_price` depend on the next
+close, so each update also returns the previous trading day’s row with its
+target filled in. The newest row gets the same placeholder target as the
+last row of the batch path (`target` 0 and `target_price` NaN).
+
+The state can be turned into a JSON-compatible dictionary and back with
+`to_dict` and `from_dict`.
+"""
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.expand_financial_data import (
+    PRICE_COLUMNS,
+    WINDOWS,
+    rolling_feature_columns,
+)
+
+
+class RollingState:
+    def __init__(self, windows=WINDOWS):
+        self.windows = list(windows)
+        self.closes = deque(maxlen=max(self.windows))
+        self.volumes = deque(maxlen=max(self.windows))
+        self.last_row = None
+        self.columns = (
+            PRICE_COLUMNS
+            + rolling_feature_columns(self.windows)
+            + ["target", "target_price"]
+        )
+
+    @classmethod
+    def from_history(cls, df, windows=WINDOWS):
+        state = cls(windows)
+        history = df.dropna(subset=["close"]).tail(max(state.windows))
+        for date, bar in zip(history.index, history.to_dict("records")):
+            state.update(date, bar)
+        return state
+
+    def features(self):
+        closes = np.array(self.closes)
+        volumes = np.array(self.volumes)
+        row = {}
+        for window in self.windows:
+            if len(closes) < window:
+                mean = std = volume_mean = volume_std = np.nan
+            else:
+                mean = closes[-window:].mean()
+                std = closes[-window:].std(ddof=1)
+                volume_mean = volumes[-window:].mean()
+                volume_std = volumes[-window:].std(ddof=1)
+            row[f"price_{window}d_rolling_mean"] = mean
+            row[f"price_{window}d_rolling_std"] = std
+            row[f"volume_{window}d_rolling_mean"] = volume_mean
+            row[f"volume_{window}d_rolling_std"] = volume_std
+            row[f"bollinger_{window}d_upper_band"] = mean + std * 2
+            row[f"bollinger_{window}d_lower_band"] = mean - std * 2
+        return row
+
+    def update(self, date, bar):
+        date = pd.Timestamp(date)
+        rows = {}
+        if pd.isna(bar["close"]):
+            # Days without a close do not enter the windows, as in the
+            # batch path.
+            rows[date] = {column: bar.get(column, np.nan) for column in PRICE_COLUMNS}
+            return rows
+
+        if self.last_row is not None:
+            last_date, last_row = self.last_row
+            last_row["target_price"] = bar["close"]
+            last_row["target"] = int(bar["close"] > last_row["close"])
+            rows[last_date] = last_row
+
+        self.closes.append(bar["close"])
+        self.volumes.append(bar["volume"])
+        row = {column: bar.get(column, np.nan) for column in PRICE_COLUMNS}
+        row.update(self.features())
+        row["target"] = 0
+        row["target_price"] = np.nan
+        self.last_row = (date, row)
+        rows[date] = dict(row)
+
+        return rows
+
+    def update_many(self, bars):
+        # A day's row is emitted again once the next close fills its
+        # target, and the later version wins.
+        rows = {}
+        for date, bar in zip(bars.index, bars.to_dict("records")):
+            rows.update(self.update(date, bar))
+        df = pd.DataFrame.from_dict(rows, orient="index", columns=self.columns)
+        df.index.name = bars.index.name
+        return df
+
+    def to_dict(self):
+        last_row = None
+        if self.last_row is not None:
+            last_date, row = self.last_row
+            last_row = {
+                "date": last_date.strftime("%Y-%m-%d"),
+                "row": {key: float(value) for key, value in row.items()},
+            }
+        return {
+            "windows": self.windows,
+            "closes": [float(close) for close in self.closes],
+            "volumes": [float(volume) for volume in self.volumes],
+            "last_row": last_row,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        state = cls(d["windows"])
+        state.closes.extend(d["closes"])
+        state.volumes.extend(d["volumes"])
+        if d["last_row"] is not None:
+            row = dict(d["last_row"]["row"])
+            row["target"] = int(row["target"])
+            state.last_row = (pd.Timestamp(d["last_row"]["date"]), row)
+        return state
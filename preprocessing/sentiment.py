@@ -43,36 +43,91 @@ Column | Type | Description
 `sentiment_7d_rolling_mean` | float | Seven-day rolling average for sentiment.
 `sentiment_14d_rolling_mean` | float | Fourteen-day rolling average for sentiment.
 
+The token-weighted means are built from per-article product columns
+(sentiment × BPE tokens and error × BPE tokens) that are summed per day and
+divided by the daily BPE token sum, so the whole aggregation is a single
+grouped sum. With `streaming=True`, the parquet file is read one row group at a
+time and the partial per-day sums are merged at the end, which keeps memory
+bounded by the size of a row group rather than the size of the corpus.
+
 """
 
 import pandas as pd
+import pyarrow.parquet as pq
+
+SENTIMENT_COLUMNS = [
+    "index",
+    "date",
+    "tokens",
+    "daily_article_count",
+    "daily_token_sum",
+    "text_sentiment",
+    "text_error",
+    "text_input_tokens",
+]
 
 
-def weighted_avg(row, value_column, weight_column):
-    return (row[value_column] * row[weight_column]).sum() / row[weight_column].sum()
-
-
-def get_daily_sentiment(company):
-    df = pd.read_parquet(f"data/sentiment_data/{company}_sent.parquet")
-    agg_sent_df = df.groupby("date").agg(
-        analyzed_bpe_tokens=("text_input_tokens", lambda row: row.sum().astype(int)),
-        weighted_sentiment=(
-            "text_input_tokens",
-            lambda row: weighted_avg(
-                df.loc[row.index], "text_sentiment", "text_input_tokens"
-            ),
-        ),
-        weighted_error=(
-            "text_input_tokens",
-            lambda row: weighted_avg(
-                df.loc[row.index], "text_error", "text_input_tokens"
-            ),
-        ),
+def daily_sums(df):
+    # Precompute the numerators of the weighted averages so that every
+    # column can be reduced with a plain grouped sum.
+    df = df.assign(
+        sentiment_product=df.text_sentiment * df.text_input_tokens,
+        error_product=df.text_error * df.text_input_tokens,
+    )
+    return df.groupby("date").agg(
+        analyzed_bpe_tokens=("text_input_tokens", "sum"),
+        sentiment_product=("sentiment_product", "sum"),
+        error_product=("error_product", "sum"),
         analyzed_naive_tokens=("tokens", "sum"),
         daily_naive_token_sum=("daily_token_sum", "first"),
         analyzed_article_count=("index", "count"),
         daily_article_count=("daily_article_count", "first"),
     )
+
+
+def merge_daily_sums(partial_sums):
+    # Partial sums from different row groups can share a date, so they are
+    # combined once more. The per-day corpus totals are identical for every
+    # article of a day, so the first one seen is kept.
+    sums = pd.concat(partial_sums)
+    return sums.groupby(level="date").agg(
+        analyzed_bpe_tokens=("analyzed_bpe_tokens", "sum"),
+        sentiment_product=("sentiment_product", "sum"),
+        error_product=("error_product", "sum"),
+        analyzed_naive_tokens=("analyzed_naive_tokens", "sum"),
+        daily_naive_token_sum=("daily_naive_token_sum", "first"),
+        analyzed_article_count=("analyzed_article_count", "sum"),
+        daily_article_count=("daily_article_count", "first"),
+    )
+
+
+def streaming_daily_sums(path):
+    parquet_file = pq.ParquetFile(path)
+    partial_sums = []
+    for i in range(parquet_file.num_row_groups):
+        row_group = parquet_file.read_row_group(i, columns=SENTIMENT_COLUMNS)
+        partial_sums.append(daily_sums(row_group.to_pandas()))
+    return merge_daily_sums(partial_sums)
+
+
+def get_daily_sentiment(company, streaming=False):
+    path = f"data/sentiment_data/{company}_sent.parquet"
+    if streaming:
+        sums = streaming_daily_sums(path)
+    else:
+        sums = daily_sums(pd.read_parquet(path, columns=SENTIMENT_COLUMNS))
+
+    agg_sent_df = pd.DataFrame(
+        {
+            "analyzed_bpe_tokens": sums.analyzed_bpe_tokens.astype(int),
+            "weighted_sentiment": sums.sentiment_product / sums.analyzed_bpe_tokens,
+            "weighted_error": sums.error_product / sums.analyzed_bpe_tokens,
+            "analyzed_naive_tokens": sums.analyzed_naive_tokens,
+            "daily_naive_token_sum": sums.daily_naive_token_sum,
+            "analyzed_article_count": sums.analyzed_article_count,
+            "daily_article_count": sums.daily_article_count,
+        }
+    )
     agg_sent_df.reset_index(inplace=True)
     agg_sent_df["date"] = pd.to_datetime(agg_sent_df.date)
     agg_sent_df.sort_values("date", inplace=True)  # probably redundant
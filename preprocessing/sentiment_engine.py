@@ -0,0 +1,289 @@
+"""
+# Sentiment Analysis Engine
+
+Vi Mai and Moacir P. de Sá Pereira
+
+`SentimentAnalysisEngine` scores the sentiment of news articles with a
+Hugging Face sequence classifier, by default Miguel Romero’s
+[distilroberta-finetuned-financial-news-sentiment-analysis](https://huggingface.co/mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis),
+stored in `models/`. It was first written in the `analyze-texts` notebook in
+`tdmstudio-notebooks/`, which scored one article at a time.
+
+Each article is tokenized whole and cut into chunks of at most 512 tokens
+(the model’s maximum). Each chunk’s sentiment is the expectation of the
+three labels (-1, 0 and 1) under the model’s probabilities, and its error is
+their standard deviation. An article’s `text_sentiment` is the average of
+its chunks’ sentiments weighted by their length and inverse squared error,
+its `text_error` combines the chunks’ length-weighted inverse squared
+errors (higher is more confident), and `text_input_tokens` is its number of
+tokens.
+
+`analyze_batch` scores many articles at once. It tokenizes a pass of
+`pass_size` articles together, sorts all their chunks by length and packs
+them into padded batches of at most `batch_tokens` tokens, so that a batch
+holds chunks of nearly the same length, and runs the model on each batch
+without autograd and with `threads` CPU threads. The chunks’ results are then
+put back with their articles and combined exactly as before, so
+`analyze(text)` is `analyze_batch([text])` for one article. The model only
+needs to be a local directory saved with `save_pretrained`, so a tiny model
+can stand in for the real one.
+
+`backend` chooses how the model runs:
+
+- `fp32`: the model as it is, in PyTorch.
+- `int8`: PyTorch with the weights of its linear layers quantized to 8-bit
+  integers, and their activations quantized on the fly.
+- `onnx`: the model exported once to an ONNX graph (kept in the model’s
+  directory as `onnx/model.onnx`), with its attention, layer normalization
+  and GELU operations fused, and run by ONNX Runtime.
+- `onnx-int8`: the ONNX graph with dynamically quantized 8-bit weights
+  (`onnx/model-int8.onnx`).
+
+The quantized backends change the scores slightly; `compare_backends` in
+`analyses/sentiment_backends.py` measures by how much, and how fast each
+backend is.
+
+This module needs `torch` and `transformers`, which only the text analysis
+uses, and the ONNX backends need `onnx` and `onnxruntime`.
+"""
+
+import os
+
+import pandas as pd
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from utils import cpu_budget
+
+HUGGINGFACE_MODEL = "distilroberta-finetuned-financial-news-sentiment-analysis"
+SENTIMENT_COLUMNS = ["text_sentiment", "text_error", "text_input_tokens"]
+BACKENDS = ["fp32", "int8", "onnx", "onnx-int8"]
+
+
+class SentimentAnalysisEngine:
+    def __init__(
+        self,
+        huggingface_model=HUGGINGFACE_MODEL,
+        model_path=None,
+        batch_tokens=2048,
+        pass_size=1024,
+        threads=None,
+        backend="fp32",
+    ):
+        self.model_path = model_path or f"models/{huggingface_model}"
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_path, local_files_only=True
+        )
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            self.model_path, local_files_only=True
+        ).eval()
+        self.max_length = 512  # Huggingface maximum
+        # The most tokens, padding included, in one forward pass
+        self.batch_tokens = max(batch_tokens, self.max_length)
+        # The most articles tokenized and sorted together
+        self.pass_size = pass_size
+        self.threads = threads or cpu_budget.cores()
+        self.values = torch.linspace(-1, 1, steps=3)
+        self.backend = backend
+        self.run = load_backend(self, backend)
+
+    def analyze(self, text):
+        return self.analyze_pass([text])[0]
+
+    def analyze_batch(self, texts, index=None):
+        texts = list(texts)
+        results = []
+        for start in range(0, len(texts), self.pass_size):
+            results.extend(self.analyze_pass(texts[start : start + self.pass_size]))
+        return pd.DataFrame(results, columns=SENTIMENT_COLUMNS, index=index)
+
+    def analyze_pass(self, texts):
+        return self.score(self.tokenize(texts))
+
+    def tokenize(self, texts):
+        # Adapted from https://github.com/huggingface/transformers/issues/9321
+        return self.tokenizer(list(texts), verbose=False)["input_ids"]
+
+    def score(self, input_ids):
+        # Chunk each article into max_length-sized pieces, remembering whose
+        # they are.
+        chunks = [
+            (article, ids[i : i + self.max_length])
+            for article, ids in enumerate(input_ids)
+            for i in range(0, len(ids), self.max_length)
+        ]
+        scores = self.score_chunks([chunk for _, chunk in chunks])
+
+        averages = [[] for _ in input_ids]
+        errors = [[] for _ in input_ids]
+        chunk_sizes = [[] for _ in input_ids]
+        for (article, chunk), (average, error) in zip(chunks, scores):
+            averages[article].append(average)
+            errors[article].append(error)
+            chunk_sizes[article].append(len(chunk))
+        return [
+            combine_chunks(*article_chunks, length=len(ids))
+            for *article_chunks, ids in zip(averages, errors, chunk_sizes, input_ids)
+        ]
+
+    def score_chunks(self, chunks):
+        # Longest first, so each batch is padded to about its own length.
+        order = sorted(range(len(chunks)), key=lambda i: -len(chunks[i]))
+        scores = [None] * len(chunks)
+        torch.set_num_threads(self.threads)
+        with torch.inference_mode():
+            for batch in self.batches(order, chunks):
+                probs = torch.softmax(self.run(self.pad(batch, chunks)), dim=1)
+                for i, weights in zip(batch, probs):
+                    scores[i] = self.chunk_score(weights)
+        return scores
+
+    def batches(self, order, chunks):
+        batch = []
+        for i in order:
+            # The first chunk of a batch is its longest.
+            if batch and (len(batch) + 1) * len(chunks[batch[0]]) > self.batch_tokens:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def pad(self, batch, chunks):
+        length = len(chunks[batch[0]])
+        input_ids = torch.full(
+            (len(batch), length), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+        for row, i in enumerate(batch):
+            input_ids[row, : len(chunks[i])] = torch.tensor(chunks[i])
+            attention_mask[row, : len(chunks[i])] = 1
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.tokenizer.model_input_names:
+            inputs["token_type_ids"] = torch.zeros_like(input_ids)
+        return inputs
+
+    def chunk_score(self, weights):
+        average = torch.dot(weights, self.values)  # Weights sum to 1 in softmax
+        deviations = (self.values - average) ** 2
+        variance = torch.dot(weights, deviations)
+        error = torch.sqrt(variance)
+        return average.item(), error.item()
+
+
+def load_backend(engine, backend):
+    if backend == "fp32":
+        return TorchBackend(engine.model)
+    if backend == "int8":
+        return TorchBackend(
+            torch.ao.quantization.quantize_dynamic(
+                engine.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        )
+    if backend in ["onnx", "onnx-int8"]:
+        path = export_onnx(engine, quantized=backend == "onnx-int8")
+        return OnnxBackend(path, engine.threads)
+    raise ValueError(f"Unknown backend {backend}. Choose one of {BACKENDS}.")
+
+
+class TorchBackend:
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, inputs):
+        return self.model(**inputs).logits
+
+
+class OnnxBackend:
+    def __init__(self, path, threads):
+        # Only the ONNX backends need ONNX Runtime.
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, inputs):
+        logits = self.session.run(
+            ["logits"], {name: tensor.numpy() for name, tensor in inputs.items()}
+        )[0]
+        return torch.from_numpy(logits)
+
+
+def export_onnx(engine, quantized=False):
+    # Only the ONNX backends need ONNX and ONNX Runtime.
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.transformers.optimizer import optimize_model
+
+    # Exported (and quantized) once per model directory
+    path = os.path.join(engine.model_path, "onnx", "model.onnx")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # ONNX Runtime only recognizes (and fuses) the attention layers
+        # when they are exported from their plain implementation.
+        model = AutoModelForSequenceClassification.from_pretrained(
+            engine.model_path, local_files_only=True, attn_implementation="eager"
+        ).eval()
+        # One row is padded, so the attention mask is part of the graph.
+        inputs = engine.pad([0, 1], [[0] * 8, [0] * 4])
+        axes = {0: "batch", 1: "sequence"}
+        with torch.inference_mode():
+            torch.onnx.export(
+                model,
+                tuple(inputs.values()),
+                f"{path}.tmp",
+                input_names=list(inputs),
+                output_names=["logits"],
+                dynamic_axes={
+                    **{name: axes for name in inputs},
+                    "logits": {0: "batch"},
+                },
+                opset_version=17,
+                dynamo=False,
+            )
+        # Fuses attention, the skip connections' layer normalizations and
+        # GELU into single CPU kernels
+        optimize_model(
+            f"{path}.tmp",
+            model_type="bert",
+            num_heads=model.config.num_attention_heads,
+            hidden_size=model.config.hidden_size,
+        ).save_model_to_file(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    if not quantized:
+        return path
+
+    quantized_path = os.path.join(engine.model_path, "onnx", "model-int8.onnx")
+    if not os.path.exists(quantized_path):
+        quantize_dynamic(
+            path,
+            f"{quantized_path}.tmp",
+            weight_type=QuantType.QInt8,
+            # The fused operators have no type for shape inference to find.
+            extra_options={"DefaultTensorType": onnx.TensorProto.FLOAT},
+        )
+        os.replace(f"{quantized_path}.tmp", quantized_path)
+    return quantized_path
+
+
+def combine_chunks(averages, errors, chunk_sizes, length):
+    chunk_sizes = torch.tensor(chunk_sizes, dtype=torch.float32)
+    chunk_weighted_averages = torch.tensor(averages, dtype=torch.float32) * chunk_sizes
+    errors = torch.tensor(errors, dtype=torch.float32)
+    inverse_squared_errors = 1 / errors**2
+    chunk_weighted_errors = inverse_squared_errors * chunk_sizes
+    weighted_average = torch.sum(
+        chunk_weighted_averages * inverse_squared_errors
+    ) / torch.sum(chunk_weighted_errors)
+    weighted_error = torch.sqrt(1.0 / torch.sum(1.0 / chunk_weighted_errors))
+
+    # The final weighted average, final weighted error (higher = more
+    # confident), and total number of input tokens.
+    return weighted_average.item(), weighted_error.item(), length
@@ -5,27 +5,50 @@ Julie Meunier
 
 This module defines a function that prepares and saves historical stock price data for five companies: Lululemon, Walmart, Walgreens, Ulta, and Dollartree. 
 The data is gathered from Yahoo Finance and saved to CSV files. 
+
+`get_all_share_prices` downloads every ticker at once through
+`preprocessing.downloads`, which matters once the list of tickers grows
+beyond our five companies.
 """
 
-import yfinance as yf
+from preprocessing.downloads import Downloader
 import pandas as pd
 
 
-def get_share_prices(company, start_date, end_date):
-    tick = yf.Ticker(company.upper())
-    hist = tick.history(period="10y")
+def get_share_prices(company, start_date, end_date, save=True, downloader=None):
+    return get_all_share_prices(
+        [company], start_date, end_date, save=save, downloader=downloader
+    )[company]
+
+
+def get_all_share_prices(companies, start_date, end_date, save=True, downloader=None):
+    if downloader is None:
+        with Downloader() as downloader:
+            return get_all_share_prices(
+                companies, start_date, end_date, save=save, downloader=downloader
+            )
+
+    histories = downloader.fetch_share_prices(
+        [company.upper() for company in companies], start_date, end_date
+    )
+
+    share_prices = {}
+    for company in companies:
+        hist = histories[company.upper()]
+
+        if hist.empty:
+            hist = pd.read_csv(f"data/financial_data/{company}.csv")
+            print(f"Could not download {company} data:")
+            print(f"Loading {company} data from CSV.")
 
-    if hist.empty:
-        hist = pd.read_csv(f"data/financial_data/{company}.csv")
-        print(f"Could not download {company} data:")
-        print(f"Loading {company} data from CSV.")
+            share_prices[company] = hist
+            continue
 
-        return hist
+        if save:
+            path = f"data/financial_data/{company}.csv"
+            hist.to_csv(path, index=False)
+            print(f"{company} data saved to {path}.")
 
-    hist = hist.reset_index() if hist.index.name == "Date" else hist
-    hist = hist[(hist["Date"] >= start_date) & (hist["Date"] <= end_date)]
-    path = f"data/financial_data/{company}.csv"
-    hist.to_csv(path, index=False)
-    print(f"{company} data saved to {path}.")
+        share_prices[company] = hist
 
-    return hist
+    return share_prices
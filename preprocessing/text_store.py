@@ -0,0 +1,334 @@
+"""
+# Text Store
+
+Moacir P. de Sá Pereira
+
+Every article’s XML used to be parsed twice: once by `prepare-texts` to
+count its words, and again before it was scored. A text store keeps the
+parsed text of every article of a corpus, keyed by its goid, so that
+scoring it again reads the texts back instead of parsing them.
+
+The texts are written in order, as UTF-8, into blocks of about
+`block_bytes` (1 MB), and each block is compressed with zstd and appended to
+`{corpus}.texts`. Next to it, `{corpus}.texts.index.parquet` gives each
+goid’s block (its offset and size in the file and its size decompressed)
+and the article’s place in the decompressed block. `TextStore` memory-maps
+the file and decompresses each block a request touches once, which costs
+far less than parsing its articles’ XML and HTML. An article whose XML
+could not be parsed is recorded in the index as failed, without a text, and
+the store does not cover it, so it is parsed from its XML again when it is
+scored.
+
+A store can also cache the token ids of its texts for a tokenizer, in the
+same format, in `{corpus}.{key}.tokens`, where `key` is a hash of the
+tokenizer. Scoring again with the same tokenizer (another backend, other
+settings or a model fine-tuned from the same one) then skips tokenizing as
+well. The ids are kept as 16-bit integers when the vocabulary fits, as
+RoBERTa’s 50,265 tokens do.
+
+`build_text_store` builds a store from a directory of `{goid}.xml` files
+with a pool of processes, and `prepare-texts` writes one as it parses.
+Stores are kept in `data/text_store/`, and `article_pipeline.py` reads from
+the corpus’s store when there is one.
+"""
+
+import hashlib
+import math
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from preprocessing.article_text import parse_files
+from utils import cpu_budget
+
+TEXT_STORE_PATH = "data/text_store"
+CODEC = "zstd"
+
+
+def default_store_path(name):
+    return os.path.join(TEXT_STORE_PATH, f"{name}.texts")
+
+
+def tokens_path(path, key):
+    return f"{path[: -len('.texts')]}.{key}.tokens"
+
+
+def tokenizer_key(tokenizer):
+    # The whole definition of a fast tokenizer (vocabulary, merges,
+    # normalization and special tokens), or at least its vocabulary
+    if hasattr(tokenizer, "backend_tokenizer"):
+        definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        definition = repr(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha256(definition.encode()).hexdigest()[:16]
+
+
+class BlockWriter:
+    def __init__(self, path, block_bytes=2**20, level=3, dtype="bytes"):
+        self.path = path
+        self.block_bytes = block_bytes
+        self.dtype = dtype
+        self.codec = pa.Codec(CODEC, compression_level=level)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(f"{path}.tmp", "wb")
+        self.offset = 0
+        self.block = []
+        self.block_size = 0
+        self.goids = set()
+        self.failed = []
+        self.index = {
+            "goid": [],
+            "offset": [],
+            "size": [],
+            "raw_size": [],
+            "start": [],
+            "end": [],
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        # Nothing is kept from a store that failed halfway.
+        if error_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(f"{self.path}.tmp")
+
+    def add(self, goid, data):
+        self.check(goid)
+        self.block.append((goid, data))
+        self.block_size += len(data)
+        if self.block_size >= self.block_bytes:
+            self.flush()
+
+    def check(self, goid):
+        if goid in self.goids:
+            raise ValueError(f"Article {goid} is already in {self.path}.")
+        self.goids.add(goid)
+
+    def fail(self, goid):
+        self.check(goid)
+        self.failed.append(goid)
+
+    def flush(self):
+        if not self.block:
+            return
+        raw = b"".join(data for _, data in self.block)
+        compressed = self.codec.compress(raw, asbytes=True)
+        self.file.write(compressed)
+        start = 0
+        for goid, data in self.block:
+            for column, value in zip(
+                self.index,
+                [
+                    goid,
+                    self.offset,
+                    len(compressed),
+                    len(raw),
+                    start,
+                    start + len(data),
+                ],
+            ):
+                self.index[column].append(value)
+            start += len(data)
+        self.offset += len(compressed)
+        self.block = []
+        self.block_size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        # Failed articles have no block.
+        failed = [False] * len(self.index["goid"]) + [True] * len(self.failed)
+        self.index["goid"].extend(self.failed)
+        for column in list(self.index)[1:]:
+            self.index[column].extend([0] * len(self.failed))
+        index_df = pd.DataFrame(self.index, dtype="int64").assign(failed=failed)
+        index = pa.Table.from_pandas(index_df, preserve_index=False)
+        pq.write_table(
+            index.replace_schema_metadata({"dtype": self.dtype}),
+            f"{self.path}.index.parquet.tmp",
+        )
+        # The index goes last, so a store with an index is complete.
+        os.replace(f"{self.path}.tmp", self.path)
+        os.replace(f"{self.path}.index.parquet.tmp", f"{self.path}.index.parquet")
+
+
+class BlockReader:
+    def __init__(self, path):
+        self.path = path
+        index = pq.read_table(f"{path}.index.parquet")
+        self.dtype = index.schema.metadata[b"dtype"].decode()
+        goids = index.column("goid").to_numpy()
+        # Stores written before failures were recorded have no column for them.
+        failed = np.zeros(len(goids), dtype=bool)
+        if "failed" in index.column_names:
+            failed = index.column("failed").to_numpy(zero_copy_only=False)
+        self.rows = pd.Index(goids[~failed])
+        self.failed = pd.Index(goids[failed])
+        self.blocks = np.stack(
+            [
+                index.column(column).to_numpy()[~failed]
+                for column in ["offset", "size", "raw_size", "start", "end"]
+            ],
+            axis=1,
+        )
+        self.codec = pa.Codec(CODEC)
+        with open(path, "rb") as f:
+            # An empty file can't be mapped.
+            self.buffer = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.path.getsize(path)
+                else b""
+            )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def covers(self, goids):
+        return bool((self.rows.get_indexer(list(goids)) >= 0).all())
+
+    def read(self, goids):
+        positions = self.rows.get_indexer(list(goids))
+        if (positions < 0).any():
+            missing = np.asarray(list(goids))[positions < 0].tolist()
+            raise KeyError(f"Articles {missing[:5]} are not in {self.path}.")
+        # Each block is decompressed once, however many of its articles are
+        # asked for.
+        blocks = {}
+        results = []
+        for offset, size, raw_size, start, end in self.blocks[positions].tolist():
+            if offset not in blocks:
+                with memoryview(self.buffer)[offset : offset + size] as view:
+                    blocks[offset] = self.codec.decompress(
+                        view, decompressed_size=raw_size, asbytes=True
+                    )
+            results.append(blocks[offset][start:end])
+        return results
+
+
+class TextStore:
+    def __init__(self, path):
+        self.path = path
+        self.texts_file = BlockReader(path)
+        self.token_files = {}
+
+    def __len__(self):
+        return len(self.texts_file)
+
+    @property
+    def goids(self):
+        return self.texts_file.rows.tolist()
+
+    @property
+    def failed(self):
+        # The articles whose XML could not be parsed
+        return self.texts_file.failed.tolist()
+
+    def covers(self, goids, key=None):
+        if key is None:
+            return self.texts_file.covers(goids)
+        return self.has_tokens(key) and self.token_file(key).covers(goids)
+
+    def texts(self, goids):
+        return [data.decode() for data in self.texts_file.read(goids)]
+
+    def has_tokens(self, key):
+        return key in self.token_files or os.path.exists(
+            f"{tokens_path(self.path, key)}.index.parquet"
+        )
+
+    def token_file(self, key):
+        if key not in self.token_files:
+            self.token_files[key] = BlockReader(tokens_path(self.path, key))
+        return self.token_files[key]
+
+    def token_ids(self, goids, key):
+        token_file = self.token_file(key)
+        return [
+            np.frombuffer(data, token_file.dtype).tolist()
+            for data in token_file.read(goids)
+        ]
+
+
+class TextStoreWriter(BlockWriter):
+    def add(self, goid, text):
+        # A text of None is an article that could not be parsed.
+        if text is None:
+            self.fail(int(goid))
+        else:
+            super().add(int(goid), text.encode())
+
+
+def build_text_store(
+    xml_path, store_path=None, parse_workers=None, batch_size=256, block_bytes=2**20
+):
+    name = os.path.basename(os.path.normpath(xml_path))
+    store_path = store_path or default_store_path(name)
+    if os.path.exists(f"{store_path}.index.parquet"):
+        print(f"{store_path} is already built.")
+        return TextStore(store_path)
+
+    goids = sorted(
+        int(file[: -len(".xml")])
+        for file in os.listdir(xml_path)
+        if file.endswith(".xml")
+    )
+    paths = [os.path.join(xml_path, f"{goid}.xml") for goid in goids]
+    parse_workers = parse_workers or cpu_budget.cores()
+    batch_size = min(batch_size, max(1, math.ceil(len(paths) / parse_workers)))
+    # Spawned, as in article_pipeline.py; the batches come back in order.
+    with cpu_budget.stage("text store"), ProcessPoolExecutor(
+        parse_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool, TextStoreWriter(store_path, block_bytes) as writer:
+        parsed = pool.map(
+            parse_files,
+            [
+                paths[start : start + batch_size]
+                for start in range(0, len(paths), batch_size)
+            ],
+        )
+        goid_batches = (
+            goids[start : start + batch_size]
+            for start in range(0, len(goids), batch_size)
+        )
+        for batch_goids, (texts, _) in zip(goid_batches, parsed):
+            for goid, text in zip(batch_goids, texts):
+                writer.add(goid, text)
+
+    store = TextStore(store_path)
+    print(f"Wrote the texts of {len(store)} articles to {store_path}.")
+    if store.failed:
+        print(
+            f"{len(store.failed)} articles could not be parsed and will be "
+            "parsed from their XML when they are scored."
+        )
+    return store
+
+
+def cache_tokens(store, tokenizer, pass_size=1024):
+    key = tokenizer_key(tokenizer)
+    if store.has_tokens(key):
+        print(f"The token ids of {store.path} for {key} are already cached.")
+        return key
+
+    dtype = "uint16" if len(tokenizer) <= 2**16 else "int32"
+    goids = store.goids
+    with BlockWriter(tokens_path(store.path, key), dtype=dtype) as writer:
+        for start in range(0, len(goids), pass_size):
+            part = goids[start : start + pass_size]
+            # Tokenized as SentimentAnalysisEngine.tokenize does
+            input_ids = tokenizer(store.texts(part), verbose=False)["input_ids"]
+            for goid, ids in zip(part, input_ids):
+                writer.add(goid, np.asarray(ids, dtype=dtype).tobytes())
+
+    print(f"Cached the token ids of {len(goids)} articles for {key}.")
+    return key
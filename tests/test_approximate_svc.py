@@ -0,0 +1,38 @@
+"""
+# Approximate SVM
+
+Vi Mai
+
+`ApproximateSVC` calibrates its probabilities on its most recent training
+rows, which must hold both classes even when the last days all moved the
+same way.
+"""
+
+import numpy as np
+import pytest
+
+from models.svm import ApproximateSVC
+
+
+def rows(count=500):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(count, 5))
+    return X, (X[:, 0] > 0).astype(int)
+
+
+def test_one_class_tail_goes_back_to_the_other_class():
+    X, y = rows()
+    y[-150:] = 1
+    model = ApproximateSVC(random_state=0).fit(X, y)
+    np.testing.assert_array_equal(model.calibration_.classes_, [0, 1])
+    assert model.predict_proba(X).shape == (len(X), 2)
+
+
+def test_one_class_raises():
+    X, y = rows()
+    with pytest.raises(ValueError, match="both classes"):
+        ApproximateSVC().fit(X, np.ones_like(y))
+    y = np.zeros_like(y)
+    y[-1] = 1
+    with pytest.raises(ValueError, match="calibration split"):
+        ApproximateSVC().fit(X, y)
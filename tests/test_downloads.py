@@ -0,0 +1,240 @@
+"""
+# Downloads
+
+Moacir P. de Sá Pereira
+
+These tests check the download layer (`preprocessing/downloads.py`) against
+a local stub of the FRED and Yahoo! Finance APIs, without going to the
+network. The stub is a small `http.server` on a free local port, and the
+downloader is pointed at it through the `FRED_API_URL` and `YAHOO_API_URL`
+environment variables, as any other stub server would be.
+
+The stub serves:
+
+- FRED observations with a missing value (`"."`), a `FLAKY` series that
+  answers 503 and then 429 before it succeeds and a `DOWN` series that
+  always answers 500;
+- a Yahoo! Finance chart with a dividend and a split, a `FLAKY` ticker that
+  answers 429 once, a `DOWN` ticker that always answers 500 and an `EMPTY`
+  ticker without results.
+
+The tests fetch all of them and compare the series, the adjusted histories,
+the failures the downloader reports and the number of requests each path
+took (the retries) with what they should be.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing.download_cache import DownloadCache
+from preprocessing.downloads import Downloader
+
+RETRIES = 3
+# 09:30 in New York on three trading days
+TIMESTAMPS = [1704810600, 1704897000, 1704983400]
+CHART = {
+    "open": [10.0, 11.0, 12.0],
+    "high": [11.0, 12.0, 13.0],
+    "low": [9.0, 10.0, 11.0],
+    "close": [10.5, 11.5, 12.5],
+    "volume": [1000, 2000, 3000],
+    "adjclose": [10.0, 11.0, 12.5],
+}
+# Failures each path answers with before it succeeds ("always" never does)
+FAILURES = {
+    "/fred/series/observations?FLAKY": [503, 429],
+    "/fred/series/observations?DOWN": "always",
+    "/yahoo/v8/finance/chart/FLAKY": [429],
+    "/yahoo/v8/finance/chart/DOWN": "always",
+}
+
+
+def fred_observations(series_id):
+    return {
+        "observations": [
+            {"date": "2024-01-01", "value": "1.5"},
+            {"date": "2024-02-01", "value": "."},
+            {"date": "2024-03-01", "value": "2.5"},
+        ]
+    }
+
+
+def yahoo_chart(ticker):
+    if ticker == "EMPTY":
+        return {"chart": {"result": None, "error": None}}
+    return {
+        "chart": {
+            "result": [
+                {
+                    "meta": {"exchangeTimezoneName": "America/New_York"},
+                    "timestamp": TIMESTAMPS,
+                    "events": {
+                        "dividends": {
+                            str(TIMESTAMPS[1]): {
+                                "amount": 0.25,
+                                "date": TIMESTAMPS[1],
+                            }
+                        },
+                        "splits": {
+                            str(TIMESTAMPS[2]): {
+                                "numerator": 2,
+                                "denominator": 1,
+                                "date": TIMESTAMPS[2],
+                            }
+                        },
+                    },
+                    "indicators": {
+                        "quote": [
+                            {
+                                column: CHART[column]
+                                for column in ["open", "high", "low", "close", "volume"]
+                            }
+                        ],
+                        "adjclose": [{"adjclose": CHART["adjclose"]}],
+                    },
+                }
+            ],
+            "error": None,
+        }
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        key = url.path
+        if url.path == "/fred/series/observations":
+            key = f"{url.path}?{query['series_id'][0]}"
+        with self.server.lock:
+            self.server.hits[key] = self.server.hits.get(key, 0) + 1
+            hits = self.server.hits[key]
+
+        failures = FAILURES.get(key, [])
+        if failures == "always" or hits <= len(failures):
+            status = 500 if failures == "always" else failures[hits - 1]
+            return self.respond(status, {"error": "stub failure"})
+        if url.path == "/fred/series/observations":
+            return self.respond(200, fred_observations(query["series_id"][0]))
+        if url.path.startswith("/yahoo/v8/finance/chart/"):
+            return self.respond(200, yahoo_chart(url.path.rsplit("/", 1)[1]))
+        self.respond(404, {"error": "not found"})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.hits = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setenv("FRED_API_URL", f"{url}/fred")
+    monkeypatch.setenv("YAHOO_API_URL", f"{url}/yahoo")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloads(server):
+    with Downloader(retries=RETRIES, backoff=0.01) as downloader:
+        series = downloader.fetch_fred_series(
+            ["CPIAUCSL", "FLAKY", "DOWN"], "2024-01-01", "2024-03-31", api_key="stub"
+        )
+        histories = downloader.fetch_share_prices(
+            ["WMT", "FLAKY", "DOWN", "EMPTY"], "2024-01-09", "2024-01-11"
+        )
+    return series, histories, dict(server.hits), downloader.failures
+
+
+def expected_history():
+    ratio = np.array(CHART["adjclose"]) / np.array(CHART["close"])
+    return pd.DataFrame(
+        {
+            "Date": pd.to_datetime(TIMESTAMPS, unit="s", utc=True)
+            .tz_convert("America/New_York")
+            .normalize(),
+            "Open": np.array(CHART["open"]) * ratio,
+            "High": np.array(CHART["high"]) * ratio,
+            "Low": np.array(CHART["low"]) * ratio,
+            "Close": CHART["adjclose"],
+            "Volume": np.array(CHART["volume"], dtype=float),
+            "Dividends": [0.0, 0.25, 0.0],
+            "Stock Splits": [0.0, 0.0, 2.0],
+        }
+    )
+
+
+@pytest.mark.parametrize("series_id", ["CPIAUCSL", "FLAKY"])
+def test_fred_series_have_missing_values_as_nan(downloads, series_id):
+    series, _, _, _ = downloads
+    expected_series = pd.Series(
+        [1.5, np.nan, 2.5],
+        index=pd.to_datetime(["2024-01-01", "2024-02-01", "2024-03-01"]),
+    )
+    pd.testing.assert_series_equal(
+        series[series_id], expected_series, check_names=False
+    )
+
+
+@pytest.mark.parametrize("ticker", ["WMT", "FLAKY"])
+def test_yahoo_histories_are_adjusted(downloads, ticker):
+    # For the dividend and the split
+    _, histories, _, _ = downloads
+    pd.testing.assert_frame_equal(histories[ticker], expected_history())
+
+
+@pytest.mark.parametrize("ticker", ["DOWN", "EMPTY"])
+def test_missing_yahoo_histories_are_empty(downloads, ticker):
+    _, histories, _, _ = downloads
+    assert histories[ticker].empty
+
+
+def test_failures_are_reported_per_series_and_ticker(downloads):
+    # The series and ticker that never download don't stop the others.
+    series, _, _, failures = downloads
+    assert series["DOWN"].empty
+    assert set(failures) == {("fred", "DOWN"), ("yahoo", "DOWN")}
+
+
+def test_failed_requests_are_retried(downloads):
+    _, _, hits, _ = downloads
+    assert hits == {
+        "/fred/series/observations?CPIAUCSL": 1,
+        "/fred/series/observations?FLAKY": 3,
+        "/fred/series/observations?DOWN": RETRIES + 1,
+        "/yahoo/v8/finance/chart/WMT": 1,
+        "/yahoo/v8/finance/chart/FLAKY": 2,
+        "/yahoo/v8/finance/chart/DOWN": RETRIES + 1,
+        "/yahoo/v8/finance/chart/EMPTY": 1,
+    }
+
+
+def test_empty_results_are_not_cached(server, tmp_path):
+    for _ in range(2):
+        with Downloader(cache=DownloadCache(path=tmp_path)) as downloader:
+            histories = downloader.fetch_share_prices(
+                ["WMT", "EMPTY"], "2024-01-09", "2024-01-11"
+            )
+        assert histories["EMPTY"].empty
+    # WMT comes from the cache the second time, EMPTY from the stub again.
+    assert server.hits["/yahoo/v8/finance/chart/WMT"] == 1
+    assert server.hits["/yahoo/v8/finance/chart/EMPTY"] == 2
@@ -0,0 +1,141 @@
+"""
+# Sentiment engine
+
+Moacir P. de Sá Pereira
+
+These tests score articles with a tiny RoBERTa saved with `save_pretrained`
+to a temporary directory, and compare `analyze_batch` with the notebook’s
+original engine, which ran every chunk of every article on its own (batch
+size 1). The chunks of an article are batched with other articles’ chunks of
+other lengths, so the padding and the attention masks must not change the
+scores.
+"""
+
+import random
+
+import numpy as np
+import pytest
+import torch
+from tokenizers import ByteLevelBPETokenizer
+from tokenizers.processors import RobertaProcessing
+from transformers import (
+    RobertaConfig,
+    RobertaForSequenceClassification,
+    RobertaTokenizerFast,
+)
+
+from preprocessing.sentiment_engine import SentimentAnalysisEngine
+
+WORDS = (
+    "the stock market rose fell sharply investors profit loss earnings retail "
+    "dollar tree walmart quarter revenue growth decline strong weak analysts "
+    "expect shares price sales guidance"
+).split()
+
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("tiny-roberta"))
+    rng = random.Random(0)
+    corpus = [" ".join(rng.choices(WORDS, k=200)) for _ in range(200)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(
+        corpus,
+        vocab_size=300,
+        special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"],
+    )
+    bpe._tokenizer.post_processor = RobertaProcessing(("</s>", 2), ("<s>", 0))
+    tokenizer = RobertaTokenizerFast(
+        tokenizer_object=bpe._tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+        mask_token="<mask>",
+        cls_token="<s>",
+        sep_token="</s>",
+    )
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = RobertaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        max_position_embeddings=514,
+        num_labels=3,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    RobertaForSequenceClassification(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def texts():
+    # Empty, short, and several chunks long, in no order
+    rng = random.Random(1)
+    lengths = [0, 3, 40, 150, 300, 700, 1500] * 3
+    rng.shuffle(lengths)
+    return [
+        " ".join(rng.choices(WORDS, k=k + rng.randint(0, 50) * (k > 0)))
+        for k in lengths
+    ]
+
+
+def reference_analyze(engine, text):
+    # The notebook’s analyze: one forward pass per chunk
+    input_ids = engine.tokenizer(text, return_tensors="pt")["input_ids"][0]
+    values = torch.linspace(-1, 1, steps=3)
+    averages, errors, chunk_sizes = [], [], []
+    with torch.no_grad():
+        for i in range(0, len(input_ids), engine.max_length):
+            chunk = input_ids[i : i + engine.max_length]
+            logits = engine.model(input_ids=chunk.reshape(1, -1)).logits
+            weights = torch.softmax(logits, dim=1)[0]
+            average = torch.dot(weights, values)
+            averages.append(average.item())
+            errors.append(
+                torch.sqrt(torch.dot(weights, (values - average) ** 2)).item()
+            )
+            chunk_sizes.append(len(chunk))
+
+    chunk_sizes = torch.tensor(chunk_sizes, dtype=torch.float32)
+    inverse_squared_errors = 1 / torch.tensor(errors, dtype=torch.float32) ** 2
+    chunk_weighted_errors = inverse_squared_errors * chunk_sizes
+    weighted_average = torch.sum(
+        torch.tensor(averages, dtype=torch.float32)
+        * chunk_sizes
+        * inverse_squared_errors
+    ) / torch.sum(chunk_weighted_errors)
+    weighted_error = torch.sqrt(1.0 / torch.sum(1.0 / chunk_weighted_errors))
+    return weighted_average.item(), weighted_error.item(), len(input_ids)
+
+
+@pytest.fixture(scope="module")
+def engine(model_path):
+    # Small batches and passes, so the articles span several of each
+    return SentimentAnalysisEngine(
+        model_path=model_path, batch_tokens=1024, pass_size=8, threads=1
+    )
+
+
+def test_analyze_batch_matches_one_chunk_at_a_time(engine, texts):
+    expected = np.array([reference_analyze(engine, text) for text in texts])
+    results = engine.analyze_batch(texts).to_numpy()
+
+    # The texts have several chunks and the empty one still has two tokens.
+    assert expected[:, 2].max() > 2 * engine.max_length
+    assert expected[:, 2].min() == 2
+    np.testing.assert_array_equal(results[:, 2], expected[:, 2])
+    np.testing.assert_allclose(results[:, 0], expected[:, 0], rtol=0, atol=1e-7)
+    # The errors are sums of large inverse squares, so they are compared in
+    # 32-bit floats: within two of them.
+    np.testing.assert_allclose(
+        results[:, 1], expected[:, 1], rtol=2 * np.finfo(np.float32).eps, atol=0
+    )
+
+
+def test_analyze_is_analyze_batch_of_one(engine, texts):
+    for text in texts[:3]:
+        assert engine.analyze(text) == tuple(engine.analyze_batch([text]).iloc[0])
@@ -0,0 +1,51 @@
+"""
+# Text store
+
+Moacir P. de Sá Pereira
+
+A text store must give back the texts the XML parses to, and record the
+articles it could not parse instead of keeping an empty text for them, so
+that they are parsed from their XML again when they are scored.
+"""
+
+import pyarrow.parquet as pq
+
+from preprocessing.article_text import article_text
+from preprocessing.text_store import TextStore, TextStoreWriter, build_text_store
+
+
+def write_articles(path):
+    path.mkdir()
+    for goid in [1, 2, 3]:
+        (path / f"{goid}.xml").write_text(
+            f"<Record><FullText>&lt;p&gt;Article {goid}.&lt;/p&gt;</FullText></Record>"
+        )
+    (path / "4.xml").write_text("<Record><FullText>Cut off")
+    return path
+
+
+def test_parse_failures_are_recorded_and_not_covered(tmp_path):
+    xml_path = write_articles(tmp_path / "corpus")
+    store = build_text_store(
+        str(xml_path), str(tmp_path / "corpus.texts"), parse_workers=1
+    )
+
+    assert article_text(str(xml_path / "4.xml")) is None
+    assert store.goids == [1, 2, 3]
+    assert store.failed == [4]
+    assert store.covers([3, 1])
+    assert not store.covers([1, 4])
+    assert store.texts([3, 1]) == ["Article 3.", "Article 1."]
+
+
+def test_stores_without_failures_still_read(tmp_path):
+    path = str(tmp_path / "corpus.texts")
+    with TextStoreWriter(path) as writer:
+        writer.add(5, "A text.")
+    # As written before failures were recorded
+    index = pq.read_table(f"{path}.index.parquet")
+    pq.write_table(index.drop_columns(["failed"]), f"{path}.index.parquet")
+
+    store = TextStore(path)
+    assert store.failed == []
+    assert store.texts([5]) == ["A text."]
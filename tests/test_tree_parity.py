@@ -0,0 +1,43 @@
+"""
+# Tree compiler parity
+
+Moacir P. de Sá Pereira
+
+The compiled trees must score every row as `predict_proba` does, including
+rows with missing values and rows on the split thresholds (see
+`analyses/tree_parity.py`).
+"""
+
+import numpy as np
+import pytest
+
+from analyses.tree_parity import check_tree_parity, synthetic_rows, threshold_rows
+from utils.tree_compiler import compile_trees
+
+
+def test_compiled_trees_match_predict_proba():
+    report_df = check_tree_parity(rows=1000)
+    assert len(report_df) == 5
+    assert (report_df.max_difference <= 1e-5).all()
+    assert (report_df.missing_values > 0).all()
+
+
+def test_rounded_thresholds_fail_the_check():
+    from sklearn.ensemble import RandomForestClassifier
+
+    rng = np.random.default_rng(0)
+    X, y = synthetic_rows(1000, 4, 0.0, rng)
+    model = RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+    compiled = compile_trees(model)
+    # Rounding the thresholds down one 32-bit float sends the rows that sit
+    # on them the other way.
+    compiled.threshold = np.nextafter(
+        compiled.threshold.astype(np.float32), np.float32(-np.inf)
+    )
+    X_edges = threshold_rows(compiled, X, rng)
+    with pytest.raises(AssertionError):
+        np.testing.assert_allclose(
+            compiled.predict_proba(X_edges)[:, 1],
+            model.predict_proba(X_edges)[:, 1],
+            atol=1e-5,
+        )
@@ -0,0 +1,167 @@
+"""
+# CPU budget
+
+Moacir P. de Sá Pereira
+
+These functions share a fixed number of cores between the layers of
+parallelism in the models: joblib workers (grid searches and permutation
+importance), XGBoost and Random Forest threads, TensorFlow’s thread pools
+and the BLAS and OpenMP thread pools. Without them, each layer sizes itself
+to the whole machine and the layers multiply.
+
+The budget defaults to the `CPU_BUDGET` environment variable, or to every
+core, and `configure` changes it for the current process (`main.py` sets it
+with `cpus=N`, and gives each `run_all` worker process an equal share).
+
+A `stage` splits the budget between `jobs` parallel workers of `threads`
+threads each and caps the thread pools to match while it runs. When it ends,
+it prints its wall-clock time and the CPU time used by the process and its
+descendants as a share of the cores it was given. Stages nest, and their
+names are joined (e.g. `random_forest_classifier dltr / search`).
+"""
+
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from joblib import parallel_config
+from threadpoolctl import threadpool_limits
+
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+budget = {"cores": int(os.getenv("CPU_BUDGET", os.cpu_count()))}
+stages = []
+stage_names = []
+
+
+def configure(cores):
+    budget["cores"] = cores
+    # Caps the thread pools already loaded in this process, and those of
+    # processes started from it.
+    threadpool_limits(cores)
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(cores)
+
+
+def cores():
+    return budget["cores"]
+
+
+def split(parts):
+    return max(1, budget["cores"] // parts)
+
+
+@contextmanager
+def stage(name, jobs=1):
+    # More jobs than cores (or -1) means one job per core.
+    if jobs < 1 or jobs > budget["cores"]:
+        jobs = budget["cores"]
+    threads = split(jobs)
+    stage_names.append(name)
+    name = " / ".join(stage_names)
+
+    start = time.perf_counter()
+    start_cpu = cpu_time()
+    try:
+        with threadpool_limits(threads), parallel_config(
+            backend="loky", n_jobs=jobs, inner_max_num_threads=threads
+        ):
+            yield {"jobs": jobs, "threads": threads}
+    finally:
+        stage_names.pop()
+        seconds = time.perf_counter() - start
+        cpu_seconds = cpu_time() - start_cpu
+        allocated = jobs * threads
+        utilization = cpu_seconds / (seconds * allocated) if seconds else 0
+        stages.append(
+            {
+                "stage": name,
+                "cores": allocated,
+                "seconds": seconds,
+                "cpu_seconds": cpu_seconds,
+                "utilization": utilization,
+            }
+        )
+        print(
+            f"{name}: {seconds:.1f}s, {cpu_seconds / seconds if seconds else 0:.1f} "
+            f"of {allocated} cores busy ({utilization:.0%})"
+        )
+
+
+def limit_estimator(model, threads):
+    # Sets n_jobs on an estimator and on every step of a pipeline.
+    model.set_params(**{key: threads for key in n_jobs_params(model)})
+    return model
+
+
+@contextmanager
+def limited_estimator(model, threads):
+    # As limit_estimator, but gives the model back its own n_jobs after, for
+    # models that belong to the caller.
+    previous = n_jobs_params(model)
+    limit_estimator(model, threads)
+    try:
+        yield model
+    finally:
+        model.set_params(**previous)
+
+
+def n_jobs_params(model):
+    return {
+        key: value
+        for key, value in model.get_params().items()
+        if key == "n_jobs" or key.endswith("__n_jobs")
+    }
+
+
+def cpu_time():
+    # CPU seconds used by this process, by the children it has waited for
+    # (and their own waited-for children) and by the descendants still
+    # running (e.g. joblib workers).
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total + descendants_cpu_time()
+
+
+def descendants_cpu_time():
+    if not os.path.isdir("/proc"):
+        return 0
+
+    # Build the process tree from /proc/*/stat.
+    children = {}
+    times = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # The command name can hold spaces, so split after it.
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(pid))
+        # Only utime and stime: the children a descendant has waited for
+        # are counted by RUSAGE_CHILDREN once it is waited for in turn.
+        times[int(pid)] = int(fields[11]) + int(fields[12])
+
+    total = 0
+    pending = list(children.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        total += times[pid]
+        pending.extend(children.get(pid, []))
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def report():
+    return pd.DataFrame(stages)
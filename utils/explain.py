@@ -0,0 +1,180 @@
+"""
+# Explanations
+
+Moacir P. de Sá Pereira
+
+These functions compute the SHAP feature importances of the models quickly
+and cache them.
+
+For the LSTM's network, `explain_network` computes expected gradients, the
+same estimate of SHAP values as `shap.GradientExplainer`: for each row, the
+average over random background rows and random points on the line between
+them and the row of the gradient times the difference. Instead of one small
+batch per row, the points of many rows go through TensorFlow at once, in
+batches sized to stay under `memory_mb`. The background is first summarized
+to `background_size` rows, as k-means centers or as rows sampled evenly over
+time.
+
+For XGBoost, `tree_shap` uses the booster's own TreeSHAP
+(`pred_contribs`), which is exact and takes one pass over the trees.
+
+Both return the mean absolute SHAP value of each feature, in the same
+`Feature`/`Importance` table as the permutation importance, and keep the
+SHAP values in `data/model_metadata/explanations/`, keyed by a hash of the
+model, the rows and the settings, so the same explanation is never
+computed twice.
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import xgboost
+from sklearn.cluster import KMeans
+
+EXPLANATIONS_PATH = "data/model_metadata/explanations"
+
+
+def summarize_background(X, size=100, method="sample", random_state=42):
+    X = np.asarray(X, dtype=np.float32)
+    if len(X) <= size:
+        return X
+    if method == "kmeans":
+        flat = X.reshape(len(X), -1)
+        centers = (
+            KMeans(n_clusters=size, n_init=1, random_state=random_state)
+            .fit(flat)
+            .cluster_centers_
+        )
+        return centers.reshape((size,) + X.shape[1:]).astype(np.float32)
+    if method == "sample":
+        # Evenly spaced rows, so every period of the history is represented
+        return X[np.linspace(0, len(X) - 1, size).round().astype(int)]
+    raise ValueError(f"Unknown background summary {method}.")
+
+
+def expected_gradients(
+    model, background, X, nsamples=50, memory_mb=256, random_state=42
+):
+    X = np.asarray(X, dtype=np.float32)
+    rng = np.random.default_rng(random_state)
+    # The points, their gradients and their differences from the background
+    # take about three copies of nsamples rows per row.
+    batch_rows = max(1, int(memory_mb * 1024**2 // (3 * nsamples * X[0].nbytes)))
+    values = np.empty_like(X)
+    for start in range(0, len(X), batch_rows):
+        batch = X[start : start + batch_rows]
+        references = background[
+            rng.integers(len(background), size=(len(batch), nsamples))
+        ]
+        alphas = rng.random(
+            (len(batch), nsamples) + (1,) * (X.ndim - 1), dtype=np.float32
+        )
+        differences = batch[:, None] - references
+        points = references + alphas * differences
+        gradients = input_gradients(model, points.reshape((-1,) + X.shape[1:]))
+        values[start : start + len(batch)] = (
+            gradients.reshape(differences.shape) * differences
+        ).mean(axis=1)
+    return values
+
+
+def input_gradients(model, X):
+    X = tf.convert_to_tensor(X)
+    with tf.GradientTape() as tape:
+        tape.watch(X)
+        # Each output only depends on its own row, so the gradient of the
+        # sum is every row's gradient.
+        output = model(X, training=False)
+    return tape.gradient(output, X).numpy()
+
+
+def model_hash(model):
+    if hasattr(model, "get_weights"):
+        return fingerprint(*model.get_weights())
+    if hasattr(model, "get_booster"):
+        return fingerprint(bytes(model.get_booster().save_raw("ubj")))
+    return fingerprint(pickle.dumps(model))
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str(part.shape).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()[:16]
+
+
+def cached(key, compute):
+    path = os.path.join(EXPLANATIONS_PATH, f"{key}.npy")
+    if os.path.exists(path):
+        return np.load(path)
+    values = compute()
+    os.makedirs(EXPLANATIONS_PATH, exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(f"{path}.tmp", path)
+    return values
+
+
+def importance_frame(columns, values):
+    # The mean absolute SHAP value of each feature, over the rows (and the
+    # timesteps of each window)
+    importances = np.abs(values).reshape(-1, len(columns)).mean(axis=0)
+    return pd.DataFrame(
+        {"Feature": list(columns), "Importance": importances}
+    ).sort_values(by="Importance", ascending=False)
+
+
+def explain_network(
+    model,
+    background,
+    X,
+    columns,
+    background_size=100,
+    method="sample",
+    nsamples=50,
+    memory_mb=256,
+):
+    background = np.asarray(background, dtype=np.float32)
+    X = np.asarray(X, dtype=np.float32)
+    key = fingerprint(
+        "expected gradients",
+        model_hash(model),
+        background,
+        X,
+        background_size,
+        method,
+        nsamples,
+    )
+    values = cached(
+        key,
+        lambda: expected_gradients(
+            model,
+            summarize_background(background, background_size, method),
+            X,
+            nsamples,
+            memory_mb,
+        ),
+    )
+    return importance_frame(columns, values)
+
+
+def tree_shap(classifier, X, columns):
+    X = np.asarray(X, dtype=np.float32)
+    booster = classifier.get_booster()
+    key = fingerprint("tree shap", model_hash(classifier), X)
+    # The last column is the bias.
+    values = cached(
+        key,
+        lambda: booster.predict(xgboost.DMatrix(X), pred_contribs=True)[:, :-1],
+    )
+    return importance_frame(columns, values)
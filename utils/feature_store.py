@@ -0,0 +1,86 @@
+"""
+# Feature store
+
+Moacir P. de Sá Pereira
+
+These functions read and write the merged data for every company as one
+Hive-partitioned parquet dataset in `data/feature_store/`, laid out as
+`company={company}/year={year}/part-0.parquet`. Each file is written with
+quarterly row groups, so a read that asks for a few columns and a date
+range only touches the matching partitions, row groups and column chunks.
+
+Rewriting a company’s data only replaces the year partitions that are
+passed in, so an incremental update rewrites the current year rather than
+the whole history.
+"""
+
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+FEATURE_STORE_PATH = "data/feature_store"
+ROW_GROUP_SIZE = 92
+
+
+def company_path(company):
+    return os.path.join(FEATURE_STORE_PATH, f"company={company}")
+
+
+def has_company_data(company):
+    return os.path.isdir(company_path(company))
+
+
+def write_company_data(company, df, replace=False):
+    if replace and has_company_data(company):
+        shutil.rmtree(company_path(company))
+    for year, year_df in df.groupby(df.index.year):
+        path = os.path.join(company_path(company), f"year={year}")
+        os.makedirs(path, exist_ok=True)
+        table = pa.Table.from_pandas(year_df.reset_index(), preserve_index=False)
+        # Write to a hidden temporary file first (dataset discovery skips
+        # dot files) so readers never see half a year.
+        pq.write_table(
+            table, os.path.join(path, ".part-0.tmp"), row_group_size=ROW_GROUP_SIZE
+        )
+        os.replace(
+            os.path.join(path, ".part-0.tmp"), os.path.join(path, "part-0.parquet")
+        )
+
+
+def read_company_data(company, columns=None, start=None, end=None, arrow_backed=False):
+    dataset = ds.dataset(company_path(company), format="parquet", partitioning="hive")
+
+    # The year filter prunes whole partitions; the date filter prunes row
+    # groups using their statistics.
+    filter = None
+    if start is not None:
+        start = pd.Timestamp(start)
+        filter = (ds.field("year") >= start.year) & (ds.field("date") >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        end_filter = (ds.field("year") <= end.year) & (ds.field("date") <= end)
+        filter = end_filter if filter is None else filter & end_filter
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != "year"]
+    else:
+        columns = ["date"] + [column for column in columns if column != "date"]
+
+    table = dataset.to_table(columns=columns, filter=filter)
+    if arrow_backed:
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    else:
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+    df = df.set_index("date").sort_index()
+
+    return df
+
+
+def read_company_columns(company):
+    # Only the footers are read to build the dataset schema.
+    dataset = ds.dataset(company_path(company), format="parquet", partitioning="hive")
+    return [name for name in dataset.schema.names if name not in ("date", "year")]
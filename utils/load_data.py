@@ -3,12 +3,126 @@
 
 Moacir P. de Sá Pereira
 
-This function returns a pandas dataframe with the data from the parquet
-file for the target company.
+This function returns a pandas dataframe with the data for the target
+company. The data is read from the feature store (see `feature_store.py`)
+when the company has been written there, and from the parquet file in
+`data/` otherwise.
+
+`columns` restricts the read to a subset of columns, and `start` and `end`
+restrict it to a date range (inclusive). Against the feature store, both are
+pushed down to the partitions and row groups. With `arrow_backed=True`, the
+dataframe is backed by the Arrow buffers instead of copies in NumPy arrays.
+
+Loaded dataframes are kept in a process-wide LRU cache, so the models, the
+EDA and the reports parse each file once per process. An entry is reused as
+long as the files’ paths, modification times and sizes are unchanged, so
+checking an entry never reads the files. When they change, the files are
+hashed, and an entry whose files have the same content (e.g. files rewritten
+with the same rows) is kept.
+Callers get copies, so the cached dataframe never changes: shallow copies
+with pandas 3.0, whose copy-on-write copies the data before changing it,
+and deep copies before it.
+
+`load_columns` returns the column names from the parquet metadata alone,
+without reading any rows.
 """
 
+import glob
+import hashlib
+import os
+from collections import OrderedDict
+
 import pandas as pd
+import pyarrow.parquet as pq
+
+from utils.feature_store import (
+    company_path,
+    has_company_data,
+    read_company_columns,
+    read_company_data,
+)
+
+CACHE_SIZE = 32
+
+cache = OrderedDict()
+
+
+def data_files(company):
+    if has_company_data(company):
+        return sorted(glob.glob(os.path.join(company_path(company), "*", "*.parquet")))
+    return [f"data/{company}_merged_data.parquet"]
+
+
+def files_signature(paths):
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def files_digest(paths):
+    # The content of the files, for caches kept across processes and for
+    # entries whose files were touched
+    digest = hashlib.blake2b()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_data(company, columns, start, end, arrow_backed):
+    if has_company_data(company):
+        return read_company_data(company, columns, start, end, arrow_backed)
+
+    path = f"data/{company}_merged_data.parquet"
+    if arrow_backed:
+        df = pd.read_parquet(path, columns=columns, dtype_backend="pyarrow")
+    else:
+        df = pd.read_parquet(path, columns=columns)
+    return df.loc[start:end]
+
+
+def load_data(company, columns=None, start=None, end=None, arrow_backed=False):
+    key = (
+        company,
+        None if columns is None else tuple(columns),
+        None if start is None else pd.Timestamp(start),
+        None if end is None else pd.Timestamp(end),
+        arrow_backed,
+    )
+    paths = data_files(company)
+    signature = files_signature(paths)
+
+    entry = cache.get(key)
+    digest = None
+    if entry is not None and entry["signature"] != signature:
+        # The hash is only taken when the files change, and kept for the
+        # next change.
+        digest = files_digest(paths)
+        if digest == entry["digest"]:
+            entry["signature"] = signature
+        else:
+            entry = None
+
+    if entry is None:
+        entry = {
+            "signature": signature,
+            "digest": digest,
+            "df": read_data(company, columns, start, end, arrow_backed),
+        }
+        cache[key] = entry
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    cache.move_to_end(key)
+
+    # Copy-on-write is always on from pandas 3.0, and only then are shallow
+    # copies safe to hand out.
+    return entry["df"].copy(deep=int(pd.__version__.split(".")[0]) < 3)
 
 
-def load_data(company):
-    return pd.read_parquet(f"data/{company}_merged_data.parquet")
+def load_columns(company):
+    if has_company_data(company):
+        return read_company_columns(company)
+    schema = pq.read_schema(f"data/{company}_merged_data.parquet")
+    return [name for name in schema.names if name != "date"]
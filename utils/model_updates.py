@@ -0,0 +1,319 @@
+"""
+# Incremental model updates
+
+Moacir P. de Sá Pereira
+
+These functions keep the stored models (the tuned models saved by the
+`rerun` commands, see `results_store.py`) up to date as new trading days
+arrive, without retraining them from scratch every day. Each update finds
+the days the model has not seen yet (only days whose target is known, i.e.
+with a next close) and first scores the model on them. Then it continues
+training the stored model on the most recent rows:
+
+- XGBoost adds boosting rounds to its booster.
+- Random Forest adds trees grown on the recent rows, and drops its oldest
+  trees once it has `random_forest_max_trees`.
+- The LSTM fine-tunes its weights for a few epochs.
+- The SVM cannot be trained incrementally, so between full retrains it is
+  only scored on the new days (which can trigger a retrain on drift).
+
+A model is retrained from scratch on every known day, with its tuned
+hyperparameters, when its last full fit is `full_every_days` old, when it is
+asked to (`full=True`) or when it drifts: its accuracy on the last
+`drift_window` days it was scored on falls `drift_tolerance` below its
+accuracy on the days before them, since its last full fit. A model fresh
+from a `rerun` was trained up to its test days, so its first update scores
+it on them and, if they are more than `full_every_days` old, retrains it.
+
+Every update writes the model back to the results store, so the reports,
+`predict` and `serve` use it. The state of each model (the last day it was
+trained and scored on, its last full fit, how it scored on the new days and
+its tuned size) is kept in `data/model_metadata/updates/state.json`. A model
+replaced by a `rerun` starts over. Every update is logged, with its time, in
+`log.parquet`.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+
+from models.lstm import SharedArray
+from utils import cpu_budget
+from utils.results_store import (
+    load_model,
+    migrate_legacy_results,
+    model_path,
+    test_days,
+    write_model,
+)
+from utils.search import take
+from utils.walk_forward import RECIPES, prepare_rows
+
+UPDATES_PATH = "data/model_metadata/updates"
+
+# When to retrain from scratch, and how much each update trains
+SCHEDULE = {
+    "full_every_days": 30,
+    "drift_window": 20,
+    "drift_tolerance": 0.1,
+    "recent_rows": 250,
+    "xgboost_rounds": 10,
+    "random_forest_trees": 20,
+    "random_forest_max_trees": 400,
+    "lstm_epochs": 2,
+}
+# The tuned parameters that incremental updates change, restored for full
+# retrains
+TUNED_PARAMS = {
+    "random_forest": ["n_estimators", "warm_start", "random_state"],
+    "xgboost": ["classifier__n_estimators"],
+}
+
+
+def state_path():
+    return os.path.join(UPDATES_PATH, "state.json")
+
+
+def log_path():
+    return os.path.join(UPDATES_PATH, "log.parquet")
+
+
+def read_state():
+    if not os.path.exists(state_path()):
+        return {}
+    with open(state_path()) as f:
+        return json.load(f)
+
+
+def write_state(state):
+    os.makedirs(UPDATES_PATH, exist_ok=True)
+    with open(f"{state_path()}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{state_path()}.tmp", state_path())
+
+
+def training_rows(family, company):
+    recipe = RECIPES[family]
+    X, y = prepare_rows(company, recipe, known_targets=True)
+    dates = X.index
+    values = None
+    timesteps = recipe.get("timesteps")
+    if timesteps:
+        # As in the LSTM module, a sample is the index of its window's first
+        # day and is labeled with the day after the window.
+        values = X.to_numpy(dtype=np.float32)
+        dates = X.index[timesteps:]
+        X = np.arange(len(X) - timesteps).reshape(-1, 1)
+        y = y[timesteps:]
+    return X, y.to_numpy(), dates, values
+
+
+def stale_model(family, model):
+    # Models saved before the models kept their preprocessing (or, for the
+    # LSTM, their network) can't be trained on new rows.
+    if family == "lstm":
+        return not hasattr(model, "model_")
+    if family in ["svm", "xgboost"]:
+        return not hasattr(model, "named_steps")
+    return False
+
+
+def new_record(family, company, model, dates):
+    # A model from a rerun was trained on the days before its test days.
+    first_test_day = test_days(family, company)[0]
+    trained_through = f"{dates[dates < first_test_day][-1]:%Y-%m-%d}"
+    params = model.get_params()
+    return {
+        "trained_through": trained_through,
+        "scored_through": trained_through,
+        "last_full_fit": trained_through,
+        "outcomes": [],
+        "params": {name: params[name] for name in TUNED_PARAMS.get(family, [])},
+    }
+
+
+def full_fit(family, model, X, y, values, params, threads):
+    model = clone(model).set_params(**params)
+    if family == "lstm":
+        model.set_params(values=SharedArray(values), threads=threads)
+    return model.fit(X, y)
+
+
+def continue_training(family, model, X, y, values, schedule, seed):
+    if family == "xgboost":
+        classifier = model.named_steps["classifier"]
+        # n_estimators is the number of rounds added to the booster.
+        classifier.set_params(n_estimators=schedule["xgboost_rounds"])
+        classifier.fit(model[:-1].transform(X), y, xgb_model=classifier.get_booster())
+    elif family == "random_forest":
+        trees = len(model.estimators_) + schedule["random_forest_trees"]
+        # Once the forest is capped, it skips the same number of seeds every
+        # day, so each update draws its new trees' seeds from its own.
+        model.set_params(warm_start=True, n_estimators=trees, random_state=seed)
+        model.fit(X, y)
+        excess = len(model.estimators_) - schedule["random_forest_max_trees"]
+        if excess > 0:
+            model.estimators_ = model.estimators_[excess:]
+            model.set_params(n_estimators=len(model.estimators_))
+    elif family == "lstm":
+        model.values = SharedArray(values)
+        model.partial_fit(X, y, epochs=schedule["lstm_epochs"])
+    else:
+        raise ValueError(f"{family} models cannot be trained incrementally.")
+    return model
+
+
+def drifted(outcomes, schedule):
+    window = schedule["drift_window"]
+    if len(outcomes) < 2 * window:
+        return False
+    recent = np.mean(outcomes[-window:])
+    before = np.mean(outcomes[:-window])
+    return recent < before - schedule["drift_tolerance"]
+
+
+def model_size(family, model):
+    if family == "xgboost":
+        return model.named_steps["classifier"].get_booster().num_boosted_rounds()
+    if family == "random_forest":
+        return len(model.estimators_)
+    return None
+
+
+def update_model(family, company, record, threads, schedule, full=False):
+    start = time.perf_counter()
+    row = {"family": family, "company": company}
+    path = model_path(family, company)
+    if not os.path.exists(path):
+        return record, {**row, "mode": "skipped", "reason": "no stored model"}
+    model = load_model(family, company)
+    if stale_model(family, model):
+        return record, {**row, "mode": "skipped", "reason": "needs a rerun"}
+
+    X, y, dates, values = training_rows(family, company)
+    newest = dates[-1]
+    # The stored model keeps its own thread counts.
+    own_threads = cpu_budget.n_jobs_params(model)
+    if family == "lstm":
+        own_threads["threads"] = model.threads
+        model.set_params(values=SharedArray(values), threads=threads)
+    cpu_budget.limit_estimator(model, threads)
+    model_mtime = os.stat(path).st_mtime_ns
+    if record is None or record.get("model_mtime") != model_mtime:
+        # No update yet, or a rerun replaced the model since the last one
+        record = {
+            **new_record(family, company, model, dates),
+            "model_mtime": model_mtime,
+        }
+
+    new = np.asarray(dates > pd.Timestamp(record["scored_through"]))
+    if not new.any() and not full:
+        return record, {
+            **row,
+            "mode": "skipped",
+            "reason": "no new days",
+            "new_rows": 0,
+            "seconds": time.perf_counter() - start,
+        }
+
+    # Score the model on the new days before it learns them.
+    correct = np.array([], dtype=bool)
+    if new.any():
+        correct = model.predict(take(X, new)) == y[new]
+    accuracy = correct.mean() if len(correct) else np.nan
+    outcomes = record["outcomes"] + correct.astype(int).tolist()
+    record = {**record, "outcomes": outcomes, "scored_through": f"{newest:%Y-%m-%d}"}
+
+    reason = None
+    since_full_fit = newest - pd.Timestamp(record["last_full_fit"])
+    if full:
+        reason = "forced"
+    elif since_full_fit.days >= schedule["full_every_days"]:
+        reason = "schedule"
+    elif drifted(outcomes, schedule):
+        reason = "drift"
+
+    if reason is None and family == "svm":
+        # Refitting the SVM is a full retrain, so it waits for one.
+        return record, {
+            **row,
+            "mode": "skipped",
+            "reason": "not incremental",
+            "trained_through": record["trained_through"],
+            "new_rows": int(new.sum()),
+            "new_accuracy": accuracy,
+            "seconds": time.perf_counter() - start,
+        }
+    if reason is None:
+        # The recent rows, and every new one after a long gap
+        rows = max(schedule["recent_rows"], int(new.sum()))
+        recent = np.arange(len(y))[-rows:]
+        continue_training(
+            family,
+            model,
+            take(X, recent),
+            y[recent],
+            values,
+            schedule,
+            seed=int(f"{newest:%Y%m%d}"),
+        )
+        mode = "incremental"
+    else:
+        model = full_fit(family, model, X, y, values, record["params"], threads)
+        record = {**record, "last_full_fit": f"{newest:%Y-%m-%d}", "outcomes": []}
+        mode = "full"
+    record["trained_through"] = f"{newest:%Y-%m-%d}"
+
+    write_model(family, company, model.set_params(**own_threads))
+    record["model_mtime"] = os.stat(path).st_mtime_ns
+
+    return record, {
+        **row,
+        "mode": mode,
+        "reason": reason,
+        "trained_through": record["trained_through"],
+        "new_rows": int(new.sum()),
+        "new_accuracy": accuracy,
+        "size": model_size(family, model),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def update_models(companies, families=None, full=False, **schedule_options):
+    families = families or list(RECIPES)
+    schedule = {**SCHEDULE, **schedule_options}
+    state = read_state()
+    # Once, before the workers load the models
+    migrate_legacy_results()
+
+    tasks = [(family, company) for family in families for company in companies]
+    with cpu_budget.stage("update", jobs=len(tasks)) as allocation:
+        results = Parallel(n_jobs=allocation["jobs"])(
+            delayed(update_model)(
+                family,
+                company,
+                state.get(family, {}).get(company),
+                allocation["threads"],
+                schedule,
+                full,
+            )
+            for family, company in tasks
+        )
+
+    log_df = pd.DataFrame([row for _, row in results])
+    log_df.insert(0, "updated_at", pd.Timestamp.now().floor("s"))
+    for (family, company), (record, _) in zip(tasks, results):
+        if record is not None:
+            state.setdefault(family, {})[company] = record
+    write_state(state)
+    if os.path.exists(log_path()):
+        log_df_all = pd.concat([pd.read_parquet(log_path()), log_df], ignore_index=True)
+    else:
+        log_df_all = log_df
+    log_df_all.to_parquet(log_path())
+    return log_df
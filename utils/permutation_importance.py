@@ -4,26 +4,151 @@
 Vi Mai
 
 This utility is used to evaluate the importance of features in a dataset.
-It is a model-agnostic method. 
+It is a model-agnostic method.
+
+Correlated features (e.g. a window's mean, standard deviation and Bollinger
+bands) are permuted together: features whose absolute correlations with each
+other are all at least `threshold` form a group, and the group's drop in
+accuracy is shared equally between its features, so the table still has one
+row per feature. The unpermuted accuracy is computed once. Each group is
+permuted `batch` times per round, and the permuted copies are scored in one
+prediction; after `min_repeats`, a group stops once the 95% confidence
+interval of its mean drop is narrower than `tolerance` on either side, and
+after `n_repeats` in any case. The groups are split between the parallel
+jobs, which share one memory-mapped copy of the rows.
 """
 
-from sklearn import inspection
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy import stats
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+
+from utils import cpu_budget
 
 
-def permutation_importance(model, X, y):
+def permutation_importance(
+    model,
+    X,
+    y,
+    n_repeats=10,
+    min_repeats=3,
+    batch=3,
+    tolerance=0.005,
+    threshold=0.9,
+    random_state=42,
+):
     if X.ndim == 3:
         X = X.reshape(X.shape[0], -1)
+    columns = list(X.columns) if hasattr(X, "columns") else None
+    values = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y).ravel()
+    groups = feature_groups(values, threshold)
 
-    def model_predict(X):
-        return model.predict(X).flatten()
+    # Groups are scored in parallel, and a model that is threaded itself
+    # (XGBoost) gets its share of the cores in each job.
+    with cpu_budget.stage(
+        "permutation importance", jobs=len(groups)
+    ) as allocation, cpu_budget.limited_estimator(model, allocation["threads"]):
+        baseline = accuracy(model, values, y, columns)
+        jobs = allocation["jobs"]
+        # Each job gets the model once, and every job reads the same
+        # memory-mapped rows.
+        chunks = Parallel(n_jobs=jobs, max_nbytes=0)(
+            delayed(score_groups)(
+                model,
+                values,
+                y,
+                columns,
+                [(i, groups[i]) for i in range(job, len(groups), jobs)],
+                baseline,
+                n_repeats,
+                min_repeats,
+                batch,
+                tolerance,
+                random_state,
+            )
+            for job in range(min(jobs, len(groups)))
+        )
 
-    result = inspection.permutation_importance(
-        model, X, y, n_repeats=10, random_state=42, n_jobs=-1
-    )
-    feature_names = list(X.columns)
+    importances = np.zeros(values.shape[1])
+    for chunk in chunks:
+        for group, drop in chunk:
+            importances[group] = drop / len(group)
+    feature_names = columns or list(range(values.shape[1]))
     importance_df = pd.DataFrame(
-        {"Feature": feature_names, "Importance": result.importances_mean}
+        {"Feature": feature_names, "Importance": importances}
     ).sort_values(by="Importance", ascending=False)
 
     return importance_df
+
+
+def feature_groups(X, threshold=0.9):
+    # Complete linkage keeps every pair in a group at least this correlated.
+    # Missing values are left out pair by pair, and constant features don't
+    # correlate with anything and stay alone.
+    correlation = np.nan_to_num(pd.DataFrame(X).corr().to_numpy())
+    distance = np.clip(1 - np.abs(correlation), 0, None)
+    np.fill_diagonal(distance, 0)
+    if len(distance) < 2:
+        return [np.arange(len(distance))]
+    labels = fcluster(
+        linkage(squareform(distance, checks=False), "complete"),
+        1 - threshold,
+        criterion="distance",
+    )
+    return [np.flatnonzero(labels == label) for label in np.unique(labels)]
+
+
+def accuracy(model, X, y, columns):
+    return (predict(model, X, columns) == y).mean()
+
+
+def predict(model, X, columns):
+    if columns is not None:
+        X = pd.DataFrame(X, columns=columns)
+    return np.asarray(model.predict(X)).ravel()
+
+
+def score_groups(
+    model,
+    X,
+    y,
+    columns,
+    groups,
+    baseline,
+    n_repeats,
+    min_repeats,
+    batch,
+    tolerance,
+    random_state,
+):
+    rows = len(X)
+    results = []
+    for i, group in groups:
+        # Seeded by group, so the result doesn't depend on the jobs.
+        rng = np.random.default_rng([random_state, i])
+        drops = []
+        while len(drops) < n_repeats:
+            repeats = min(batch, n_repeats - len(drops))
+            permuted = np.tile(X, (repeats, 1))
+            for repeat in range(repeats):
+                # One shuffle of the rows for the whole group keeps its
+                # features' relationships to each other.
+                order = rng.permutation(rows)
+                permuted[repeat * rows : (repeat + 1) * rows, group] = X[order][
+                    :, group
+                ]
+            correct = predict(model, permuted, columns) == np.tile(y, repeats)
+            drops.extend(baseline - correct.reshape(repeats, rows).mean(axis=1))
+            if len(drops) >= min_repeats and confident(drops, tolerance):
+                break
+        results.append((group, np.mean(drops)))
+    return results
+
+
+def confident(drops, tolerance):
+    # The half-width of the 95% confidence interval of the mean drop
+    spread = np.std(drops, ddof=1) / np.sqrt(len(drops))
+    return stats.t.ppf(0.975, len(drops) - 1) * spread < tolerance
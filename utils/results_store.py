@@ -0,0 +1,184 @@
+"""
+# Results store
+
+Moacir P. de Sá Pereira
+
+These functions keep the results of the models in `data/model_metadata/`
+without pickling everything together:
+
+- `results.parquet` has one row per model family and company with the
+  scalar metrics, the confusion matrix, the predicted probabilities and the
+  test labels (with their dates).
+- `importances.parquet` has the permutation (or SHAP) importance of every
+  feature for every family and company.
+- Each fitted model is pickled on its own in
+  `models/{family}/{company}.pkl` and only read by `load_model`.
+  `write_model` replaces it, as the daily updates do (see
+  `model_updates.py`).
+
+So the reports read two small columnar files instead of every fitted model.
+`read_results` returns the same dataframe as the old pickles (without the
+`model` column). Writing a family’s results replaces its earlier rows.
+
+Results that only exist as the old `{family}_results.pkl` files are copied
+into the store the first time they are read.
+"""
+
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+RESULTS_PATH = "data/model_metadata"
+MODEL_NAMES = {
+    "lstm": "LSTM",
+    "svm": "SVM",
+    "random_forest": "Random Forest",
+    "xgboost": "XGBoost",
+}
+
+
+def results_path():
+    return os.path.join(RESULTS_PATH, "results.parquet")
+
+
+def importances_path():
+    return os.path.join(RESULTS_PATH, "importances.parquet")
+
+
+def model_path(family, company):
+    return os.path.join(RESULTS_PATH, "models", family, f"{company}.pkl")
+
+
+def write_table(table, path):
+    # Written to a temporary file first so readers never see half a table.
+    pq.write_table(table, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def replace_rows(path, family, companies, table):
+    if os.path.exists(path):
+        old = pq.read_table(path)
+        replaced = pc.and_(
+            pc.equal(old["family"], family),
+            pc.is_in(old["company"], value_set=pa.array(companies)),
+        )
+        # Permissive, since tables built from dataframes or from lists can
+        # differ in string and number types.
+        table = pa.concat_tables(
+            [old.filter(pc.invert(replaced)), table], promote_options="permissive"
+        )
+    write_table(table, path)
+
+
+def write_model(family, company, model):
+    path = model_path(family, company)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to a temporary file first, as the tables are, so a model being
+    # updated can still be loaded.
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(model, f)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def write_results(family, results):
+    rows = []
+    importances = []
+    for result in results:
+        path = write_model(family, result["company"], result["model"])
+
+        y_test = result["y_test"]
+        rows.append(
+            {
+                "family": family,
+                "model_name": MODEL_NAMES[family],
+                "company": result["company"],
+                "accuracy": float(result["accuracy"]),
+                "f1score": float(result["f1score"]),
+                "roc_auc": float(result["roc_auc"]),
+                "cm": np.asarray(result["cm"]).tolist(),
+                "probs": np.asarray(result["probs"], dtype=float).ravel().tolist(),
+                "y_test": np.asarray(y_test).ravel().astype(int).tolist(),
+                "y_test_dates": list(pd.DatetimeIndex(y_test.index)),
+                "model_path": path,
+            }
+        )
+        importance_df = result["perm_imp_df"].reset_index(drop=True)
+        importances.append(
+            importance_df.assign(family=family, company=result["company"])
+        )
+
+    companies = [result["company"] for result in results]
+    replace_rows(results_path(), family, companies, pa.Table.from_pylist(rows))
+    replace_rows(
+        importances_path(),
+        family,
+        companies,
+        pa.Table.from_pandas(pd.concat(importances), preserve_index=False),
+    )
+
+
+def migrate_legacy_results():
+    families = set()
+    if os.path.exists(results_path()):
+        families = set(
+            pq.read_table(results_path(), columns=["family"])["family"].to_pylist()
+        )
+    for family in MODEL_NAMES:
+        path = os.path.join(RESULTS_PATH, f"{family}_results.pkl")
+        if family not in families and os.path.exists(path):
+            with open(path, "rb") as f:
+                write_results(family, pickle.load(f))
+
+
+def read_results(families=None):
+    migrate_legacy_results()
+    results_df = pq.read_table(results_path()).to_pandas()
+    importances_df = pq.read_table(importances_path()).to_pandas()
+    if families is not None:
+        results_df = results_df[results_df["family"].isin(families)]
+
+    # Back to the types the models returned
+    results_df["cm"] = [np.array([list(row) for row in cm]) for cm in results_df["cm"]]
+    results_df["probs"] = [np.asarray(probs) for probs in results_df["probs"]]
+    results_df["y_test"] = [
+        pd.Series(np.asarray(y_test), index=pd.DatetimeIndex(dates), name="target")
+        for y_test, dates in zip(results_df["y_test"], results_df["y_test_dates"])
+    ]
+    importances = {
+        key: df.drop(columns=["family", "company"]).reset_index(drop=True)
+        for key, df in importances_df.groupby(["family", "company"])
+    }
+    results_df["perm_imp_df"] = [
+        importances.get((family, company))
+        for family, company in zip(results_df["family"], results_df["company"])
+    ]
+    # In the order of MODEL_NAMES, as the pickles were concatenated
+    results_df = results_df.sort_values(
+        "family", key=lambda family: family.map(list(MODEL_NAMES).index), kind="stable"
+    )
+    return results_df.drop(columns=["y_test_dates"]).reset_index(drop=True)
+
+
+def test_days(family, company):
+    # The days a stored model was tested on, after the days it was trained on
+    migrate_legacy_results()
+    table = pq.read_table(
+        results_path(),
+        columns=["y_test_dates"],
+        filters=[("family", "=", family), ("company", "=", company)],
+    )
+    if not len(table):
+        return None
+    return pd.DatetimeIndex(table["y_test_dates"][0].as_py())
+
+
+def load_model(family, company):
+    migrate_legacy_results()
+    with open(model_path(family, company), "rb") as f:
+        return pickle.load(f)
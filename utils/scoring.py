@@ -0,0 +1,269 @@
+"""
+# Scoring service
+
+Moacir P. de Sá Pereira
+
+`ScoringService` predicts tomorrow's direction for every company with every
+model family. When it starts, it loads each company's fitted models into
+memory once: the models saved by the `rerun` commands (the SVM and XGBoost
+pipelines, the tuned Random Forest and each company's LSTM), as kept up to
+date by `model_updates.py`.
+
+It also builds the most recent feature rows of each company the way each
+family prepares them (and, for the LSTM, their 30-day windows) and runs the
+pipelines' preprocessing on them, so a request only runs the classifiers.
+Each classifier scores all the days asked of it in one batch, with one
+thread, since a few rows are too few to share between threads. The Random
+Forest and XGBoost models are compiled into NumPy arrays (see
+`tree_compiler.py`), and the originals are dropped. The LSTMs of
+all the companies are stacked into one NumPy network (`StackedLSTM`) that
+scores every company at once, without TensorFlow's per-call overhead.
+`load` rebuilds the models and rows (e.g. after new data is collected) and
+swaps them in at once.
+
+Every request's latency is recorded, and `stats` reports its percentiles.
+`serve` puts the service behind a local HTTP server:
+
+- `/predict?companies=dltr,wmt&models=svm,xgboost&days=1` returns the
+  predictions as JSON (every company and model by default).
+- `/stats` returns the latency percentiles.
+- `/reload` reloads the models and rows.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from utils import cpu_budget
+from utils.load_data import load_data
+from utils.results_store import MODEL_NAMES, load_model
+from utils.search import take
+from utils.tree_compiler import TREE_FAMILIES, compile_trees
+from utils.walk_forward import RECIPES
+
+
+class ScoringService:
+    def __init__(self, companies, families=None, history=30):
+        self.companies = list(companies)
+        self.families = list(families or RECIPES)
+        # The most days a request can score per company
+        self.history = history
+        self.latencies = deque(maxlen=100000)
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        models = {}
+        rows = {}
+        for family in self.families:
+            for company in self.companies:
+                model = load_scoring_model(family, company)
+                inputs, dates = scoring_rows(company, RECIPES[family], self.history)
+                if hasattr(model, "steps"):
+                    # The rows don't change between loads, so neither does
+                    # their preprocessing.
+                    inputs = model[:-1].transform(inputs)
+                    model = model[-1]
+                if family in TREE_FAMILIES:
+                    model = compile_trees(model)
+                models[family, company] = model
+                rows[family, company] = inputs, dates
+        if "lstm" in self.families:
+            models["lstm"] = StackedLSTM(
+                [models["lstm", company].model_ for company in self.companies]
+            )
+            rows["lstm"] = np.stack(
+                [rows["lstm", company][0] for company in self.companies]
+            )
+        self.models, self.rows = models, rows
+
+    def score(self, companies=None, families=None, days=1):
+        start = time.perf_counter()
+        models, rows = self.models, self.rows
+        if days < 1 or days > self.history:
+            raise ValueError(f"days must be between 1 and {self.history}.")
+
+        companies = companies or self.companies
+        predictions = []
+        for family in families or self.families:
+            for company in companies:
+                if (family, company) not in models:
+                    raise KeyError(f"No {family} model for {company}.")
+            if family == "lstm":
+                members = [self.companies.index(company) for company in companies]
+                probs = models["lstm"](rows["lstm"][members, -days:], members)
+            else:
+                probs = [
+                    models[family, company].predict_proba(
+                        take(rows[family, company][0], slice(-days, None))
+                    )[:, 1]
+                    for company in companies
+                ]
+            for company, company_probs in zip(companies, probs):
+                dates = rows[family, company][1]
+                for date, prob in zip(dates[-days:], company_probs):
+                    predictions.append(
+                        {
+                            "company": company,
+                            "model": family,
+                            "model_name": MODEL_NAMES[family],
+                            "date": f"{date:%Y-%m-%d}",
+                            "probability": float(prob),
+                            "signal": int(prob > 0.5),
+                        }
+                    )
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return pd.DataFrame(predictions)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        if not len(latencies):
+            return {"requests": 0}
+        return {
+            "requests": len(latencies),
+            "mean_ms": latencies.mean(),
+            **{f"p{q}_ms": np.percentile(latencies, q) for q in [50, 90, 95, 99]},
+            "max_ms": latencies.max(),
+        }
+
+
+def load_scoring_model(family, company):
+    model = load_model(family, company)
+    # Results saved before the models kept their preprocessing can't score
+    # new rows.
+    if family == "lstm" and not hasattr(model, "model_"):
+        raise ValueError(f"No saved LSTM for {company}. Run `lstm rerun` first.")
+    if family in ["svm", "xgboost"] and not hasattr(model, "named_steps"):
+        raise ValueError(
+            f"The {family} model for {company} has no scaler. "
+            f"Run `{family} rerun` first."
+        )
+    return cpu_budget.limit_estimator(model, 1)
+
+
+def scoring_rows(company, recipe, days):
+    df = load_data(company)
+    if recipe["index"]:
+        # Add Index as a column for ordinal encoding of days
+        df.insert(0, "Index", range(len(df)))
+    X = df.drop(["target", "target_price"], axis=1)
+    # Unlike in training, the last day counts even though its target is
+    # unknown: it is the day to predict from.
+    if recipe["rows"] == "business_days":
+        X = X[df["close"].notna()]
+    else:
+        X = X.dropna()
+
+    timesteps = recipe.get("timesteps")
+    if not timesteps:
+        X = X.tail(days)
+        return X, X.index
+    X = X.tail(days + timesteps - 1)
+    windows = np.lib.stride_tricks.sliding_window_view(
+        X.to_numpy(dtype=np.float32), timesteps, axis=0
+    ).transpose(0, 2, 1)
+    # Each window is dated by its last day.
+    return np.ascontiguousarray(windows), X.index[timesteps - 1 :]
+
+
+class StackedLSTM:
+    # The forward pass of the LSTM model's network (an LSTM layer and a
+    # sigmoid output) in NumPy, with the weights of several networks
+    # stacked so that one batch of matrix products runs all of them.
+    def __init__(self, networks):
+        weights = [network.get_weights() for network in networks]
+        self.kernel, self.recurrent_kernel, self.bias, self.dense, self.dense_bias = (
+            np.stack(parts) for parts in zip(*weights)
+        )
+
+    def __call__(self, windows, members):
+        # windows: (networks, days, timesteps, features) -> (networks, days)
+        kernel = self.kernel[members]
+        recurrent_kernel = self.recurrent_kernel[members]
+        # The input part of the gates for every timestep at once
+        inputs = np.matmul(windows, kernel[:, None]) + self.bias[members, None, None]
+        units = recurrent_kernel.shape[1]
+        h = np.zeros(windows.shape[:2] + (units,), dtype=np.float32)
+        c = np.zeros_like(h)
+        for t in range(windows.shape[2]):
+            gates = inputs[:, :, t] + np.matmul(h, recurrent_kernel)
+            # Keras orders the gates input, forget, cell, output.
+            i, f, g, o = np.split(gates, 4, axis=-1)
+            c = sigmoid(f) * c + sigmoid(i) * np.tanh(g)
+            h = sigmoid(o) * np.tanh(c)
+        output = np.matmul(h, self.dense[members]) + self.dense_bias[members, None]
+        return sigmoid(output[..., 0])
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        service = self.server.service
+        try:
+            if url.path == "/predict":
+                start = time.perf_counter()
+                predictions = service.score(
+                    companies=query_list(query, "companies"),
+                    families=query_list(query, "models"),
+                    days=int(query.get("days", ["1"])[0]),
+                )
+                self.respond(
+                    200,
+                    {
+                        "predictions": predictions.to_dict("records"),
+                        "seconds": time.perf_counter() - start,
+                    },
+                )
+            elif url.path == "/stats":
+                self.respond(200, service.stats())
+            elif url.path == "/reload":
+                service.load()
+                self.respond(200, {"reloaded": True})
+            else:
+                self.respond(404, {"error": f"Unknown path {url.path}."})
+        except (KeyError, ValueError) as error:
+            self.respond(400, {"error": str(error)})
+
+    def respond(self, status, body):
+        content = json.dumps(body, default=float).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Requests are counted in the latency statistics instead.
+        pass
+
+
+def query_list(query, key):
+    if key not in query:
+        return None
+    return [value for values in query[key] for value in values.split(",") if value]
+
+
+def serve(service, host="127.0.0.1", port=8000):
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.service = service
+    print(f"Serving predictions on http://{host}:{port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(service.stats())
@@ -0,0 +1,382 @@
+"""
+# Hyperparameter search
+
+Moacir P. de Sá Pereira
+
+This module defines `SuccessiveHalvingSearch`, a hyperparameter search for
+the tree models that can run under a budget. Every configuration in the grid
+is cross-validated with a small amount of a resource (fewer trees or
+boosting rounds with e.g. `resource="n_estimators"`, or fewer of the most
+recent training rows with `resource="n_samples"`). Only the best third (with
+`factor=3`) move on to the next rung, which gets three times as much, until
+the last rung is cross-validated with `max_resource`.
+
+The search stops early, keeping the best configuration of the last complete
+rung, once it has used `max_seconds` of wall-clock time or `max_fits` fits.
+(If that happens in the first rung, the best configuration scored so far is
+kept.)
+It mirrors the parts of `GridSearchCV` the models use: the same folds and
+scorer, `best_params_`, `best_score_`, `best_estimator_` (refit on all the
+data with `max_resource`) and `score`.
+
+`WarmStartGridSearch` gives the same results as `GridSearchCV` (same folds,
+scores and best configuration) for grids over the number of trees of a
+forest or the number of rounds of XGBoost. Instead of fitting a model for
+every value, it fits one model per configuration and fold and scores it at
+every value: a forest grows with `warm_start`, and XGBoost fits the most
+rounds once and predicts with fewer.
+
+Each search leaves a `trace_` dataframe with the cost (fits and seconds) and
+the score of every configuration at every rung. `search_trace` builds the
+same table from a `GridSearchCV`, and `save_trace` and `read_traces` keep
+them in `data/model_metadata/search/` so search modes can be compared.
+"""
+
+import glob
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone, is_classifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterGrid, check_cv
+
+SEARCH_PATH = "data/model_metadata/search"
+
+
+class SuccessiveHalvingSearch:
+    def __init__(
+        self,
+        estimator,
+        param_grid,
+        resource,
+        max_resource,
+        min_resource=1,
+        factor=3,
+        cv=5,
+        scoring=None,
+        max_seconds=None,
+        max_fits=None,
+        n_jobs=None,
+    ):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.resource = resource
+        self.max_resource = max_resource
+        self.min_resource = min_resource
+        self.factor = factor
+        self.cv = cv
+        self.scoring = scoring
+        self.max_seconds = max_seconds
+        self.max_fits = max_fits
+        self.n_jobs = n_jobs
+
+    def resources(self, n_candidates):
+        # Enough rungs to get down to one configuration, ending at the
+        # maximum resource.
+        rungs = math.ceil(math.log(n_candidates, self.factor)) + 1
+        return [
+            max(self.min_resource, round(self.max_resource / self.factor**rung))
+            for rung in reversed(range(rungs))
+        ]
+
+    def exhausted(self, start, fits):
+        if (
+            self.max_seconds is not None
+            and time.perf_counter() - start > self.max_seconds
+        ):
+            return True
+        return self.max_fits is not None and fits >= self.max_fits
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        scorer = check_scoring(self.estimator, self.scoring)
+        folds = list(
+            check_cv(self.cv, y, classifier=is_classifier(self.estimator)).split(X, y)
+        )
+        n_jobs = self.n_jobs or 1
+
+        start = time.perf_counter()
+        fits = 0
+        trace = []
+        self.best_params_ = None
+        for rung, amount in enumerate(self.resources(len(candidates))):
+            tasks = [
+                (candidate, train, test)
+                for candidate in range(len(candidates))
+                for train, test in folds
+            ]
+            scores = {candidate: [] for candidate in range(len(candidates))}
+            seconds = {candidate: 0 for candidate in range(len(candidates))}
+            # Tasks go out in batches of n_jobs so the budget can stop the
+            # search between them. It is only checked once at least one
+            # configuration has a complete score.
+            for batch_start in range(0, len(tasks), n_jobs):
+                if trace and self.exhausted(start, fits):
+                    break
+                batch = tasks[batch_start : batch_start + n_jobs]
+                results = Parallel(n_jobs=n_jobs)(
+                    delayed(fit_and_score)(
+                        self.estimator,
+                        candidates[candidate],
+                        X,
+                        y,
+                        train,
+                        test,
+                        scorer,
+                        self.resource,
+                        amount,
+                    )
+                    for candidate, train, test in batch
+                )
+                fits += len(batch)
+                for (candidate, _, _), (score, fit_seconds) in zip(batch, results):
+                    scores[candidate].append(score)
+                    seconds[candidate] += fit_seconds
+                    if len(scores[candidate]) == len(folds):
+                        trace.append(
+                            {
+                                "rung": rung,
+                                "resource": amount,
+                                "params": str(candidates[candidate]),
+                                "score": pd.Series(scores[candidate]).mean(),
+                                "score_std": pd.Series(scores[candidate]).std(ddof=0),
+                                "fit_seconds": seconds[candidate],
+                                "fits": fits,
+                                "elapsed_seconds": time.perf_counter() - start,
+                            }
+                        )
+
+            complete = [c for c in scores if len(scores[c]) == len(folds)]
+            # Best first; ties go to the earlier configuration in the grid.
+            ranked = sorted(complete, key=lambda c: (-pd.Series(scores[c]).mean(), c))
+            # A rung cut short by the budget only counts if it is the first.
+            if len(complete) == len(candidates) or self.best_params_ is None:
+                self.best_params_ = candidates[ranked[0]]
+                self.best_score_ = pd.Series(scores[ranked[0]]).mean()
+            if len(complete) < len(candidates):
+                break
+            candidates = [
+                candidates[c] for c in ranked[: math.ceil(len(ranked) / self.factor)]
+            ]
+
+        self.trace_ = pd.DataFrame(trace)
+        self.n_fits_ = fits
+
+        if self.resource != "n_samples":
+            self.best_params_ = {**self.best_params_, self.resource: self.max_resource}
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(X, y)
+        self.scorer_ = scorer
+        self.elapsed_seconds_ = time.perf_counter() - start
+        return self
+
+    def score(self, X, y):
+        return self.scorer_(self.best_estimator_, X, y)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+class WarmStartGridSearch:
+    def __init__(
+        self, estimator, param_grid, warm_param, cv=5, scoring=None, n_jobs=None
+    ):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.warm_param = warm_param
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        candidates = list(ParameterGrid(self.param_grid))
+        values = sorted(self.param_grid[self.warm_param])
+        others = list(
+            ParameterGrid(
+                {
+                    key: value
+                    for key, value in self.param_grid.items()
+                    if key != self.warm_param
+                }
+            )
+        )
+        scorer = check_scoring(self.estimator, self.scoring)
+        folds = list(
+            check_cv(self.cv, y, classifier=is_classifier(self.estimator)).split(X, y)
+        )
+
+        start = time.perf_counter()
+        # One model per configuration (without the warm parameter) and fold,
+        # scored at every value of the warm parameter
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(fit_and_score_checkpoints)(
+                self.estimator,
+                params,
+                X,
+                y,
+                train,
+                test,
+                scorer,
+                self.warm_param,
+                values,
+            )
+            for params in others
+            for train, test in folds
+        )
+
+        scores = {}
+        seconds = {}
+        for i, params in enumerate(others):
+            for fold in range(len(folds)):
+                for value, (score, fit_seconds) in zip(
+                    values, results[i * len(folds) + fold]
+                ):
+                    key = str({**params, self.warm_param: value})
+                    scores.setdefault(key, []).append(score)
+                    seconds[key] = seconds.get(key, 0) + fit_seconds
+
+        # The candidates in GridSearchCV's order, so ties go the same way
+        means = [np.mean(scores[str(params)]) for params in candidates]
+        self.best_index_ = int(np.argmax(means))
+        self.best_params_ = candidates[self.best_index_]
+        self.best_score_ = means[self.best_index_]
+
+        trace = pd.DataFrame(
+            {
+                "rung": 0,
+                "resource": [params[self.warm_param] for params in candidates],
+                "params": [str(params) for params in candidates],
+                "score": means,
+                "score_std": [np.std(scores[str(params)]) for params in candidates],
+                "fit_seconds": [seconds[str(params)] for params in candidates],
+            }
+        )
+        # Each configuration and fold is one fit, however many checkpoints
+        # it is scored at.
+        trace["fits"] = [
+            (
+                others.index({k: v for k, v in params.items() if k != self.warm_param})
+                + 1
+            )
+            * len(folds)
+            for params in candidates
+        ]
+        trace["elapsed_seconds"] = trace["fit_seconds"].cumsum()
+        self.trace_ = trace
+        self.n_fits_ = len(others) * len(folds)
+
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(X, y)
+        self.scorer_ = scorer
+        self.elapsed_seconds_ = time.perf_counter() - start
+        return self
+
+    def score(self, X, y):
+        return self.scorer_(self.best_estimator_, X, y)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def take(data, rows):
+    if hasattr(data, "iloc"):
+        return data.iloc[rows]
+    return data[rows]
+
+
+def fit_and_score(estimator, params, X, y, train, test, scorer, resource, amount):
+    start = time.perf_counter()
+    if resource == "n_samples":
+        # The most recent rows of the training fold
+        train = train[-amount:]
+    else:
+        params = {**params, resource: amount}
+    model = clone(estimator).set_params(**params)
+    model.fit(take(X, train), take(y, train))
+    fit_seconds = time.perf_counter() - start
+    return scorer(model, take(X, test), take(y, test)), fit_seconds
+
+
+def fit_and_score_checkpoints(
+    estimator, params, X, y, train, test, scorer, param, values
+):
+    results = []
+    start = time.perf_counter()
+    for value, model in checkpoints(
+        clone(estimator).set_params(**params),
+        take(X, train),
+        take(y, train),
+        param,
+        values,
+    ):
+        fit_seconds = time.perf_counter() - start
+        results.append((scorer(model, take(X, test), take(y, test)), fit_seconds))
+        start = time.perf_counter()
+    return results
+
+
+def checkpoints(model, X, y, param, values):
+    # Yields the model as if it had been fitted with each of the values of
+    # param (the number of trees or boosting rounds), in increasing order,
+    # while only fitting about as much as the largest one needs.
+    prefix = param.rsplit("__", 1)[0] + "__" if "__" in param else ""
+    final = model.steps[-1][1] if hasattr(model, "steps") else model
+
+    if hasattr(final, "get_booster"):
+        # XGBoost: fit all the rounds once. Predictions stop at the booster's
+        # best iteration, so setting it gives the predictions of a model
+        # with fewer rounds.
+        model.set_params(**{param: max(values)})
+        model.fit(X, y)
+        for value in values:
+            final.get_booster().best_iteration = value - 1
+            yield value, model
+    else:
+        # Forests: add trees to the same forest. With a fixed random_state,
+        # the new trees are the ones a larger forest would have had.
+        model.set_params(**{f"{prefix}warm_start": True})
+        for value in values:
+            model.set_params(**{param: value})
+            model.fit(X, y)
+            yield value, model
+
+
+def search_trace(search):
+    if hasattr(search, "trace_"):
+        return search.trace_
+
+    # The same table for a GridSearchCV, as one rung with the full resource
+    results = search.cv_results_
+    n_splits = search.n_splits_
+    fit_seconds = pd.Series(results["mean_fit_time"]) * n_splits
+    return pd.DataFrame(
+        {
+            "rung": 0,
+            "resource": None,
+            "params": [str(params) for params in results["params"]],
+            "score": results["mean_test_score"],
+            "score_std": results["std_test_score"],
+            "fit_seconds": fit_seconds,
+            "fits": [n_splits * (i + 1) for i in range(len(fit_seconds))],
+            "elapsed_seconds": fit_seconds.cumsum(),
+        }
+    )
+
+
+def save_trace(trace, model_name, company, mode):
+    os.makedirs(SEARCH_PATH, exist_ok=True)
+    trace = trace.assign(model=model_name, company=company, mode=mode)
+    trace.to_parquet(
+        os.path.join(SEARCH_PATH, f"{model_name}_{company}_{mode}.parquet")
+    )
+
+
+def read_traces():
+    paths = sorted(glob.glob(os.path.join(SEARCH_PATH, "*.parquet")))
+    if not paths:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
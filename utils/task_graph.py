@@ -0,0 +1,159 @@
+"""
+# Task graph
+
+Moacir P. de Sá Pereira
+
+This module defines `TaskGraph`, a small scheduler for work that forms a
+directed acyclic graph. Each task names the tasks it depends on and receives
+their results as extra positional arguments once they finish. Tasks run as
+soon as their dependencies are done:
+
+- Tasks run on a process pool with `workers` processes, except for `local`
+  tasks (cheap steps like saving and plotting), which run in the calling
+  process.
+- Ready tasks are started in order of the longest chain of `cost` between
+  them and the end of the graph, so the slowest chains start first and the
+  total time approaches that of the longest chain.
+- The files listed as a task’s `inputs` are read ahead into the operating
+  system’s page cache while the task waits for a worker.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+
+class TaskGraph:
+    def __init__(self, workers=None, initializer=None, initargs=()):
+        self.workers = workers or os.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.tasks = {}
+
+    def add(
+        self, name, function, *args, dependencies=(), inputs=(), cost=1, local=False
+    ):
+        for dependency in dependencies:
+            if dependency not in self.tasks:
+                raise ValueError(f"{name} depends on unknown task {dependency}.")
+        self.tasks[name] = {
+            "function": function,
+            "args": args,
+            "dependencies": list(dependencies),
+            "inputs": list(inputs),
+            "cost": cost,
+            "local": local,
+        }
+        return name
+
+    def priorities(self):
+        # The cost of the longest chain from each task to the end of the
+        # graph. Tasks can only depend on tasks added before them (so the
+        # graph has no cycles), and walking the tasks backwards visits
+        # dependents first.
+        priorities = {}
+        for name in reversed(list(self.tasks)):
+            priorities[name] = self.tasks[name]["cost"] + max(
+                (
+                    priorities[dependent]
+                    for dependent, task in self.tasks.items()
+                    if name in task["dependencies"]
+                ),
+                default=0,
+            )
+        return priorities
+
+    def run(self):
+        priorities = self.priorities()
+        waiting = {name: set(task["dependencies"]) for name, task in self.tasks.items()}
+        results = {}
+        timings = {}
+        ready = []
+        running = {}
+        prefetched = set()
+        start = time.perf_counter()
+
+        def finish(name, result, elapsed):
+            results[name] = result
+            timings[name] = elapsed
+            print(f"{name} finished in {elapsed:.1f}s")
+            for dependencies in waiting.values():
+                dependencies.discard(name)
+
+        def arguments(name):
+            task = self.tasks[name]
+            return task["args"] + tuple(results[d] for d in task["dependencies"])
+
+        # Spawned workers do not inherit the parent's threads and locks
+        # (TensorFlow, BLAS and the download pool all start threads).
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            self.workers,
+            mp_context=context,
+            initializer=self.initializer,
+            initargs=self.initargs,
+        ) as pool, ThreadPoolExecutor(max_workers=1) as prefetcher:
+            while waiting or ready or running:
+                for name in [name for name, d in waiting.items() if not d]:
+                    ready.append(name)
+                    del waiting[name]
+                ready.sort(key=lambda name: priorities[name], reverse=True)
+
+                for name in [name for name in ready if not self.tasks[name]["local"]]:
+                    if len(running) == self.workers:
+                        break
+                    ready.remove(name)
+                    future = pool.submit(
+                        timed, self.tasks[name]["function"], arguments(name)
+                    )
+                    running[future] = name
+
+                # Warm the inputs of the tasks that will get the next free
+                # workers.
+                for name in ready[: self.workers]:
+                    if name not in prefetched:
+                        prefetched.add(name)
+                        prefetcher.submit(prefetch, self.tasks[name]["inputs"])
+
+                # Local tasks run here while the workers are busy.
+                local = [name for name in ready if self.tasks[name]["local"]]
+                if local:
+                    name = local[0]
+                    ready.remove(name)
+                    function = self.tasks[name]["function"]
+                    finish(name, *timed(function, arguments(name)))
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result, elapsed = future.result()
+                    finish(name, result, elapsed)
+
+        total = time.perf_counter() - start
+        print(
+            f"Ran {len(self.tasks)} tasks in {total:.1f}s "
+            f"({sum(timings.values()):.1f}s of task time on {self.workers} workers)."
+        )
+        return results
+
+
+def timed(function, args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def prefetch(paths):
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            while f.read(1024**2):
+                pass
@@ -0,0 +1,294 @@
+"""
+# Tree compiler
+
+Moacir P. de Sá Pereira
+
+These functions flatten a fitted Random Forest or XGBoost classifier into
+`CompiledTrees`: the nodes of every tree in contiguous NumPy arrays (the
+feature and threshold of each split, the indexes of its children, the side
+missing values go to, and the value of each leaf). Its `predict_proba` scores
+a whole batch of rows against every tree at once, one tree level at a time,
+instead of going through scikit-learn's or XGBoost's per-call machinery, and
+it keeps none of the statistics that make the pickled models large.
+
+The comparisons follow the libraries exactly. Both compare the rows as
+32-bit floats, so the thresholds are stored as the nearest 32-bit floats that
+keep every comparison the same (scikit-learn goes left when a value is at
+most the threshold, and XGBoost when it is below it). A forest averages the
+class 1 share of its leaves, and a booster adds its leaves' margins to the
+base score.
+
+`compile_stored_models` exports the stored models to
+`data/model_metadata/compiled/` as `.npz` files. It checks each compiled
+model against the model's `predict_proba` on every row of its company and
+reports the sizes and single-row latencies of both.
+"""
+
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.results_store import load_model
+from utils.walk_forward import RECIPES, prepare_rows
+
+COMPILED_PATH = "data/model_metadata/compiled"
+TREE_FAMILIES = ["random_forest", "xgboost"]
+
+
+class CompiledTrees:
+    def __init__(
+        self,
+        feature,
+        threshold,
+        left,
+        right,
+        missing_left,
+        value,
+        roots,
+        average,
+        base_margin=0.0,
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.missing_left = missing_left
+        self.value = value
+        self.roots = roots
+        # Forests average probabilities, boosters add up margins.
+        self.average = bool(average)
+        self.base_margin = float(base_margin)
+        self.classes_ = np.array([0, 1])
+        self.depth = tree_depth(left, right, roots)
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, None]
+        # The node each row has reached in each tree
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.depth):
+            values = X[rows, self.feature[nodes]]
+            go_left = np.where(
+                np.isnan(values),
+                self.missing_left[nodes],
+                values <= self.threshold[nodes],
+            )
+            # Leaves are their own children, so finished rows stay put.
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        leaves = self.value[nodes]
+        if self.average:
+            probs = leaves.mean(axis=1)
+        else:
+            probs = 1 / (1 + np.exp(-(self.base_margin + leaves.sum(axis=1))))
+        return np.column_stack([1 - probs, probs])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] > 0.5).astype(int)
+
+    def arrays(self):
+        return {
+            "feature": self.feature,
+            "threshold": self.threshold,
+            "left": self.left,
+            "right": self.right,
+            "missing_left": self.missing_left,
+            "value": self.value,
+            "roots": self.roots,
+        }
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(
+            path,
+            **self.arrays(),
+            average=self.average,
+            base_margin=self.base_margin,
+        )
+
+
+def load_compiled(path):
+    with np.load(path) as arrays:
+        return CompiledTrees(**{key: arrays[key] for key in arrays.files})
+
+
+def tree_depth(left, right, roots):
+    # Walks down from the roots a level at a time until only leaves are left.
+    depth = 0
+    nodes = roots
+    while True:
+        nodes = nodes[left[nodes] != nodes]
+        if not len(nodes):
+            return depth
+        nodes = np.concatenate([left[nodes], right[nodes]])
+        depth += 1
+
+
+def float32_at_most(threshold):
+    # The largest 32-bit float that is not above each threshold, so that
+    # x <= threshold gives the same answer for every 32-bit x.
+    rounded = threshold.astype(np.float32)
+    above = rounded > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def flatten(trees):
+    # trees: (feature, threshold, left, right, missing_left, value) per tree,
+    # with -1 children for leaves and indexes local to the tree
+    parts = {
+        key: []
+        for key in ["feature", "threshold", "left", "right", "missing_left", "value"]
+    }
+    roots = []
+    offset = 0
+    for feature, threshold, left, right, missing_left, value in trees:
+        nodes = np.arange(len(feature)) + offset
+        leaf = left < 0
+        parts["feature"].append(np.where(leaf, 0, feature))
+        parts["threshold"].append(np.where(leaf, 0, threshold))
+        parts["left"].append(np.where(leaf, nodes, left + offset))
+        parts["right"].append(np.where(leaf, nodes, right + offset))
+        parts["missing_left"].append(missing_left.astype(bool))
+        parts["value"].append(value)
+        roots.append(offset)
+        offset += len(feature)
+    return {
+        "feature": np.concatenate(parts["feature"]).astype(np.int32),
+        "threshold": np.concatenate(parts["threshold"]).astype(np.float32),
+        "left": np.concatenate(parts["left"]).astype(np.int32),
+        "right": np.concatenate(parts["right"]).astype(np.int32),
+        "missing_left": np.concatenate(parts["missing_left"]),
+        "value": np.concatenate(parts["value"]).astype(np.float32),
+        "roots": np.array(roots, dtype=np.int32),
+    }
+
+
+def compile_forest(forest):
+    trees = []
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        # The class 1 share of the (weighted) samples in each node
+        counts = tree.value[:, 0, :]
+        value = counts[:, 1] / counts.sum(axis=1)
+        trees.append(
+            (
+                tree.feature,
+                float32_at_most(tree.threshold),
+                tree.children_left,
+                tree.children_right,
+                tree.missing_go_to_left,
+                value,
+            )
+        )
+    return CompiledTrees(**flatten(trees), average=True)
+
+
+def compile_booster(classifier):
+    booster = classifier.get_booster()
+    learner = json.loads(booster.save_raw("json"))["learner"]
+    if learner["objective"]["name"] != "binary:logistic":
+        raise ValueError("Only binary:logistic boosters can be compiled.")
+    model = learner["gradient_booster"]["model"]
+    if int(model["gbtree_model_param"]["num_parallel_tree"]) != 1:
+        raise ValueError("Only boosters with one tree per round can be compiled.")
+    trees = model["trees"]
+    # Predictions stop at the best iteration, when there is one.
+    try:
+        trees = trees[: booster.best_iteration + 1]
+    except AttributeError:
+        pass
+
+    compiled = []
+    for tree in trees:
+        left = np.array(tree["left_children"])
+        split = np.array(tree["split_conditions"], dtype=np.float32)
+        # x < split is x <= the next 32-bit float below it.
+        threshold = np.nextafter(split, np.float32(-np.inf))
+        compiled.append(
+            (
+                np.array(tree["split_indices"]),
+                threshold,
+                left,
+                np.array(tree["right_children"]),
+                np.array(tree["default_left"]),
+                # Leaves keep their value in split_conditions.
+                np.where(left < 0, split, 0),
+            )
+        )
+    # The base score is a probability; the leaves add to its log odds.
+    base_score = float(learner["learner_model_param"]["base_score"].strip("[]"))
+    return CompiledTrees(
+        **flatten(compiled),
+        average=False,
+        base_margin=np.log(base_score / (1 - base_score)),
+    )
+
+
+def compile_trees(model):
+    if hasattr(model, "get_booster"):
+        return compile_booster(model)
+    if hasattr(model, "estimators_"):
+        return compile_forest(model)
+    raise ValueError(f"Cannot compile a {type(model).__name__}.")
+
+
+def compiled_path(family, company):
+    return os.path.join(COMPILED_PATH, family, f"{company}.npz")
+
+
+def single_row_seconds(model, X, repeats=20):
+    row = X[-1:]
+    model.predict_proba(row)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict_proba(row)
+    return (time.perf_counter() - start) / repeats
+
+
+def compile_stored_models(companies, families=None):
+    report = []
+    for family in families or TREE_FAMILIES:
+        for company in companies:
+            model = load_model(family, company)
+            X, _ = prepare_rows(company, RECIPES[family])
+            if hasattr(model, "steps"):
+                # Only the classifier is compiled; its preprocessing stays.
+                X = model[:-1].transform(X)
+                model = model[-1]
+            if hasattr(model, "n_jobs"):
+                model.set_params(n_jobs=1)
+            compiled = compile_trees(model)
+
+            # Parity on every row of the company
+            difference = np.abs(
+                compiled.predict_proba(X)[:, 1] - model.predict_proba(X)[:, 1]
+            ).max()
+            if difference > 1e-5:
+                raise ValueError(
+                    f"The compiled {family} model for {company} differs from "
+                    f"the original by {difference}."
+                )
+            compiled.save(compiled_path(family, company))
+            report.append(
+                {
+                    "model": family,
+                    "company": company,
+                    "trees": len(compiled.roots),
+                    "nodes": len(compiled.feature),
+                    "depth": compiled.depth,
+                    "max_difference": difference,
+                    "pickle_bytes": len(pickle.dumps(model)),
+                    "compiled_bytes": compiled.nbytes,
+                    "original_ms": single_row_seconds(model, X) * 1000,
+                    "compiled_ms": single_row_seconds(compiled, X) * 1000,
+                }
+            )
+    return pd.DataFrame(report)
@@ -0,0 +1,243 @@
+"""
+# Walk-forward evaluation
+
+Moacir P. de Sá Pereira
+
+These functions backtest the four model families with walk-forward splits.
+Each fold trains on the days before a test window and tests on the window.
+With `mode="expanding"`, the training window always starts at the first day.
+With `mode="rolling"`, it keeps the length of the first fold’s training
+window (or `train_size`) and moves forward with the test window.
+
+Each family prepares its rows the way its model module does (business days
+or complete rows, the day index, scaling). The matrices of every fold are
+built once, with the scaler fitted on the fold’s training rows, and cached
+as `.npy` files in `data/walk_forward/`. The cache is keyed by the company’s
+data, the preparation and the splits, so families that prepare the same
+way, and later runs, share it. The LSTM caches its feature matrix once and
+the window start indexes for each fold.
+
+The folds of every family and company then run in parallel within the CPU
+budget (see `cpu_budget.py`). Each worker memory-maps its fold’s matrices,
+and each fold reports its dates, sizes, fit time, accuracy, F1 score and ROC
+AUC (computed from probabilities). The models use fixed hyperparameters
+close to the tuned ones rather than a search per fold.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+from xgboost import XGBClassifier
+
+from utils import cpu_budget
+from utils.load_data import data_files, files_digest, load_data
+
+CACHE_PATH = "data/walk_forward"
+
+# How each family prepares its rows, as in its model module
+RECIPES = {
+    "random_forest": {"rows": "business_days", "index": True, "scale": False},
+    "xgboost": {"rows": "business_days", "index": False, "scale": True},
+    "svm": {"rows": "complete", "index": False, "scale": True},
+    "lstm": {"rows": "complete", "index": True, "scale": False, "timesteps": 30},
+}
+
+
+def walk_forward_splits(n, folds=5, test_size=None, mode="expanding", train_size=None):
+    # The last folds * test_size rows are the test windows.
+    test_size = test_size or n // (folds + 1)
+    train_size = train_size or n - folds * test_size
+    splits = []
+    for fold in range(folds):
+        test_start = n - (folds - fold) * test_size
+        train_start = 0 if mode == "expanding" else max(0, test_start - train_size)
+        splits.append(
+            (
+                np.arange(train_start, test_start),
+                np.arange(test_start, test_start + test_size),
+            )
+        )
+    return splits
+
+
+def prepare_rows(company, recipe, known_targets=False):
+    df = load_data(company)
+    if recipe["index"]:
+        # Add Index as a column for ordinal encoding of days
+        df.insert(0, "Index", range(len(df)))
+    if recipe["rows"] == "business_days":
+        df = df.dropna(subset=["close"])
+    else:
+        df = df.dropna()
+    if known_targets:
+        # The last day's target is a placeholder until the next close.
+        df = df.dropna(subset=["target_price"])
+    X = df.drop(["target", "target_price"], axis=1)
+    y = df["target"]
+    return X, y
+
+
+def fold_cache_path(company, recipe, split_options):
+    key = json.dumps(
+        [company, recipe, split_options, files_digest(data_files(company))],
+        sort_keys=True,
+    )
+    return os.path.join(
+        CACHE_PATH, company, hashlib.sha256(key.encode()).hexdigest()[:16]
+    )
+
+
+def build_folds(company, recipe, split_options):
+    path = fold_cache_path(company, recipe, split_options)
+    if os.path.exists(os.path.join(path, "folds.json")):
+        return path
+
+    X, y = prepare_rows(company, recipe)
+    os.makedirs(path, exist_ok=True)
+    timesteps = recipe.get("timesteps")
+    if timesteps:
+        # Windows are built from one feature matrix; a fold is a set of
+        # window start indexes.
+        np.save(os.path.join(path, "values.npy"), X.to_numpy(dtype=np.float32))
+        dates = X.index[timesteps:]
+        y = y[timesteps:]
+        n = len(X) - timesteps
+    else:
+        dates = X.index
+        n = len(X)
+
+    folds = []
+    for fold, (train, test) in enumerate(walk_forward_splits(n, **split_options)):
+        if timesteps:
+            X_train = train.reshape(-1, 1)
+            X_test = test.reshape(-1, 1)
+        else:
+            X_train = X.iloc[train].to_numpy(dtype=float)
+            X_test = X.iloc[test].to_numpy(dtype=float)
+            if recipe["scale"]:
+                scaler = StandardScaler().fit(X_train)
+                X_train = scaler.transform(X_train)
+                X_test = scaler.transform(X_test)
+        arrays = {
+            "X_train": X_train,
+            "X_test": X_test,
+            "y_train": y.iloc[train].to_numpy(),
+            "y_test": y.iloc[test].to_numpy(),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"fold-{fold}-{name}.npy"), array)
+        folds.append(
+            {
+                "fold": fold,
+                "train_start": f"{dates[train[0]]:%Y-%m-%d}",
+                "train_end": f"{dates[train[-1]]:%Y-%m-%d}",
+                "test_start": f"{dates[test[0]]:%Y-%m-%d}",
+                "test_end": f"{dates[test[-1]]:%Y-%m-%d}",
+            }
+        )
+
+    # Written last, so a cache directory without it is incomplete.
+    with open(os.path.join(path, "folds.json"), "w") as f:
+        json.dump(folds, f)
+    return path
+
+
+def make_model(family, threads, values=None):
+    if family == "random_forest":
+        return RandomForestClassifier(
+            n_estimators=200, max_depth=10, random_state=42, n_jobs=threads
+        )
+    if family == "xgboost":
+        return XGBClassifier(
+            n_estimators=100,
+            learning_rate=0.1,
+            max_depth=6,
+            random_state=42,
+            eval_metric="logloss",
+            n_jobs=threads,
+        )
+    if family == "svm":
+        return SVC(kernel="rbf", random_state=42, probability=True)
+    if family == "lstm":
+        # Only the LSTM needs TensorFlow, which the tree models' callers
+        # (the tree compiler and the scoring service) shouldn't load.
+        from models.lstm import SharedArray, WindowedLSTMClassifier
+
+        return WindowedLSTMClassifier(
+            values=SharedArray(values),
+            timesteps=RECIPES["lstm"]["timesteps"],
+            epochs=10,
+            batch_size=32,
+            random_state=42,
+            threads=threads,
+        )
+    raise ValueError(f"Unknown model family {family}.")
+
+
+def run_fold(family, company, path, fold, threads):
+    arrays = {
+        name: np.load(
+            os.path.join(path, f"fold-{fold['fold']}-{name}.npy"), mmap_mode="r"
+        )
+        for name in ["X_train", "X_test", "y_train", "y_test"]
+    }
+    values = None
+    if family == "lstm":
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+    model = make_model(family, threads, values)
+
+    start = time.perf_counter()
+    model.fit(arrays["X_train"], arrays["y_train"])
+    fit_seconds = time.perf_counter() - start
+
+    y_test = arrays["y_test"]
+    y_pred = model.predict(arrays["X_test"])
+    probs = model.predict_proba(arrays["X_test"])[:, 1]
+    return {
+        "model": family,
+        "company": company,
+        **fold,
+        "train_rows": len(arrays["y_train"]),
+        "test_rows": len(y_test),
+        "fit_seconds": fit_seconds,
+        "accuracy": accuracy_score(y_test, y_pred),
+        "f1score": f1_score(y_test, y_pred),
+        # A test window with one class has no ROC curve.
+        "roc_auc": (
+            roc_auc_score(y_test, probs) if len(np.unique(y_test)) == 2 else np.nan
+        ),
+    }
+
+
+def walk_forward(companies, families=None, **split_options):
+    families = families or list(RECIPES)
+
+    tasks = []
+    for company in companies:
+        for family in families:
+            path = build_folds(company, RECIPES[family], split_options)
+            with open(os.path.join(path, "folds.json")) as f:
+                folds = json.load(f)
+            tasks.extend((family, company, path, fold) for fold in folds)
+
+    with cpu_budget.stage("walk forward", jobs=len(tasks)) as allocation:
+        results = Parallel(n_jobs=allocation["jobs"])(
+            delayed(run_fold)(family, company, path, fold, allocation["threads"])
+            for family, company, path, fold in tasks
+        )
+    return pd.DataFrame(results)
+
+
+def summarize(results_df):
+    return results_df.groupby("model")[
+        ["accuracy", "f1score", "roc_auc", "fit_seconds"]
+    ].agg(["mean", "std"])
@@ -0,0 +1,34 @@
+"""
+# Watermarks
+
+Moacir P. de Sá Pereira
+
+These functions keep track of the last date ingested for each company and
+for the external indicators, so that `collect_data` can fetch only what is
+missing. The watermarks live in `data/watermarks.json`, which maps a key (a
+company’s ticker or `external_indicators`) to a `%Y-%m-%d` date.
+"""
+
+import json
+import os
+
+import pandas as pd
+
+WATERMARKS_PATH = "data/watermarks.json"
+
+
+def read_watermarks():
+    if not os.path.exists(WATERMARKS_PATH):
+        return {}
+    with open(WATERMARKS_PATH) as f:
+        watermarks = json.load(f)
+    return {key: pd.Timestamp(value) for key, value in watermarks.items()}
+
+
+def write_watermarks(watermarks):
+    with open(WATERMARKS_PATH, "w") as f:
+        json.dump(
+            {key: value.strftime("%Y-%m-%d") for key, value in watermarks.items()},
+            f,
+            indent=2,
+        )